@@ -5,6 +5,23 @@ This is the package of Pyx, yet another asynchronous web server.
 
 from .http import *
 from .io import *
+from .cache import *
+from .manifest import *
+from .bundle import *
+from .router import *
+from .watch import *
+from .metrics import *
+from .hooks import *
+from .accesslog import *
+from .monitor import *
+from .concurrency import *
+from .offloading import *
+from .response_cache import *
 from .version import *
 
-__all__ = http.__all__ + io.__all__ + version.__all__
+__all__ = (http.__all__ + io.__all__ + cache.__all__ + manifest.__all__ +
+           bundle.__all__ + router.__all__ + watch.__all__ +
+           metrics.__all__ + hooks.__all__ +
+           accesslog.__all__ + monitor.__all__ + concurrency.__all__ +
+           offloading.__all__ + response_cache.__all__ +
+           version.__all__)
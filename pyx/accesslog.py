@@ -0,0 +1,195 @@
+"""
+Access logs, written from a background thread.
+
+An ``AccessLog`` is registered in a ``pyx.hooks.RequestHooks`` object. It
+only appends a tuple to a bounded ring buffer for every request, and the
+lines are formatted and written in batches by a separate thread, so slow
+disks never block the event loop::
+
+    from pyx.hooks import RequestHooks
+    from pyx.accesslog import AccessLog
+
+    access_log = AccessLog(open('access.log', 'a'))
+    access_log.start()
+    hooks = RequestHooks()
+    hooks.add(access_log)
+    conn_cb = HttpConnectionCB(req_cb, hooks=hooks)
+    ...
+    access_log.close()
+
+When the ring buffer is full, new records are dropped and counted in
+``AccessLog.dropped``, instead of waiting for the writer thread.
+
+"""
+
+
+import collections
+import threading
+import time
+from .log import logger
+
+
+__all__ = ['AccessLog']
+
+
+_Record = collections.namedtuple(
+    '_Record', ['time', 'host', 'method', 'path', 'query', 'version',
+                'status', 'bytes', 'referer', 'user_agent', 'duration'])
+
+
+def _peer_host(conn):
+    peer = conn.writer.get_extra_info('peername')
+    if isinstance(peer, tuple):
+        return peer[0]
+    return peer
+
+
+class AccessLog:
+    """Write a line to ``stream`` for every request.
+
+    ``stream`` is a text file object. ``fmt`` is a ``str.format`` template,
+    or one of the names in ``AccessLog.PRESETS``. The available fields are
+    ``host``, ``time``, ``request``, ``method``, ``path``, ``query``,
+    ``status``, ``bytes`` (the size of the response body, without the
+    headers), ``referer``, ``user_agent`` and ``duration`` (in seconds).
+    Missing values are rendered as ``-``.
+
+    Requests rejected before being fully parsed, e.g. with *431 Request
+    Header Fields Too Large*, and requests shed with *503 Service
+    Unavailable* are logged too, with ``-`` for the parts of the request
+    that are unknown.
+
+    At most ``capacity`` records are kept in memory. The writer thread wakes
+    up when ``batch_size`` records are pending, or every ``flush_interval``
+    seconds.
+    """
+
+    COMMON = '{host} - - [{time}] "{request}" {status} {bytes}'
+    COMBINED = COMMON + ' "{referer}" "{user_agent}"'
+    PRESETS = {'common': COMMON, 'combined': COMBINED}
+
+    TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+
+    def __init__(self, stream, fmt='combined', capacity=65536,
+                 batch_size=1024, flush_interval=0.5):
+        self.stream = stream
+        self.fmt = self.PRESETS.get(fmt, fmt)
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._ring = collections.deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._last_sec = None
+        self._last_time_str = None
+
+    def on_response_finished(self, req, t):
+        ring = self._ring
+        if len(ring) >= self.capacity:
+            self.dropped += 1
+            return
+
+        resp = req.response
+        if resp is not None:
+            status = resp.code
+            nbytes = resp.bytes_written + resp.bytes_sent_file - \
+                resp.head_size
+        else:
+            status = nbytes = None
+        ring.append(_Record(
+            time.time(), _peer_host(req.connection),
+            getattr(req, 'method', None), getattr(req, 'path', None),
+            getattr(req, 'query', None), getattr(req, 'version', None),
+            status, nbytes,
+            req.get_first_header('Referer'),
+            req.get_first_header('User-Agent'),
+            t - req.timings['start']))
+        if len(ring) == self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='pyx-access-log', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Write all pending records, and stop the writer thread. The
+        stream is not closed."""
+        if self._thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        else:
+            self.flush()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Format and write all pending records. Normally called from the
+        writer thread only."""
+        ring = self._ring
+        lines = []
+        try:
+            while True:
+                lines.append(self.format(ring.popleft()))
+        except IndexError:
+            pass
+
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            logger('AccessLog').warning('Dropped %d access log records',
+                                        dropped - self._reported_dropped)
+            self._reported_dropped = dropped
+
+        if not lines:
+            return
+        lines.append('')
+        try:
+            self.stream.write('\n'.join(lines))
+            self.stream.flush()
+        except Exception:
+            logger('AccessLog').exception('Failed to write access log')
+
+    def _format_time(self, t):
+        sec = int(t)
+        if sec != self._last_sec:
+            self._last_sec = sec
+            self._last_time_str = time.strftime(self.TIME_FORMAT,
+                                                time.localtime(sec))
+        return self._last_time_str
+
+    def format(self, record):
+        """Return the log line for ``record``, without a line break."""
+        def _or_dash(value):
+            return '-' if value is None else value
+
+        if record.method is None:
+            request = '-'
+        else:
+            request = '{} {}{}{}'.format(
+                record.method, record.path,
+                '' if record.query is None else '?' + record.query,
+                '' if record.version is None else
+                    ' HTTP/{}.{}'.format(*record.version))
+        return self.fmt.format(
+            host=_or_dash(record.host),
+            time=self._format_time(record.time),
+            request=request,
+            method=_or_dash(record.method),
+            path=_or_dash(record.path),
+            query=_or_dash(record.query),
+            status=_or_dash(record.status),
+            bytes=_or_dash(record.bytes),
+            referer=_or_dash(record.referer),
+            user_agent=_or_dash(record.user_agent),
+            duration='{:.6f}'.format(record.duration))
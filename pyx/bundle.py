@@ -0,0 +1,203 @@
+"""
+Packed bundles of static files.
+
+A bundle concatenates all files in a static tree into one file, followed by
+an index of offsets, sizes and MIME types, so that serving a file needs no
+``open(...)`` or path lookup at all. Bundles are built with the
+``pyx-pack`` command::
+
+    pyx-pack -r /some/where -o /some/where.bundle
+    pyx --bundle /some/where.bundle
+
+The layout of a bundle file is:
+
+    * A fixed-size header, containing ``StaticBundle.MAGIC``, and the offset
+      and size of the index;
+    * The content of all files, back to back;
+    * The index, in JSON.
+
+"""
+
+
+import asyncio
+import os
+import json
+import mmap
+import struct
+from .log import logger
+from .io import default_buffer_pool
+from .manifest import StaticManifest
+from .http import (HttpHeader, HttpError, PathResource, methods)
+
+
+__all__ = ['StaticBundle', 'BundleResource']
+
+
+# magic, index offset, index size
+_HEADER = struct.Struct('>8sQQ')
+
+
+def _pread_exact(fd, size, offset):
+    chunks = []
+    while size > 0:
+        data = os.pread(fd, size, offset)
+        if not data:
+            raise ValueError('Truncated bundle file')
+        chunks.append(data)
+        size -= len(data)
+        offset += len(data)
+    return b''.join(chunks)
+
+
+class StaticBundle:
+    """A bundle file opened for serving.
+
+    ``fname`` is the bundle file to open. It's kept open until ``close`` is
+    called, and all files are served from the same file descriptor. The
+    whole bundle is also mapped into memory, so that files no larger than
+    ``tiny_size`` bytes can be sent along with their response headers in a
+    single write.
+
+    File metadata is available as ``self.manifest``, a
+    ``pyx.manifest.StaticManifest``.
+    """
+
+    MAGIC = b'PYXBNDL1'
+    VERSION = 1
+
+    def __init__(self, fname, tiny_size=4096):
+        self.tiny_size = tiny_size
+        self._fd = os.open(fname, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            magic, index_offset, index_size = \
+                _HEADER.unpack(_pread_exact(self._fd, _HEADER.size, 0))
+            if magic != self.MAGIC:
+                raise ValueError('Not a bundle file: {}'.format(repr(fname)))
+            index = json.loads(
+                _pread_exact(self._fd, index_size, index_offset).decode())
+            if index.get('version') != self.VERSION:
+                raise ValueError('Unsupported bundle version: {}'.format(
+                                    repr(index.get('version'))))
+            self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        except:
+            os.close(self._fd)
+            raise
+
+        files = {}
+        self._offsets = {}
+        for rel_path, (offset, size, mtime, mimetype) in \
+                index['files'].items():
+            files[rel_path] = (size, mtime, mimetype)
+            self._offsets[rel_path] = offset
+        self.manifest = StaticManifest(files, index['indexes'])
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def fileno(self):
+        return self._fd
+
+    def lookup(self, rel_path):
+        """Return the ``pyx.manifest.ManifestEntry`` for ``rel_path``, or
+        None. See ``StaticManifest.lookup``."""
+        return self.manifest.lookup(rel_path)
+
+    def offset(self, entry):
+        """Return the offset of the content of ``entry`` in the bundle."""
+        return self._offsets[entry.rel_path]
+
+    def read(self, entry):
+        """Return the content of ``entry`` as bytes."""
+        offset = self._offsets[entry.rel_path]
+        return self._mmap[offset:(offset+entry.size)]
+
+    def close(self):
+        if self._fd is not None:
+            self._mmap.close()
+            os.close(self._fd)
+            self._fd = None
+
+    @classmethod
+    def pack(cls, root, fname, index_names=('index.html', 'index.htm')):
+        """Pack the files in directory ``root`` into the bundle file
+        ``fname``. Returns the number of packed files."""
+        manifest = StaticManifest.scan(root, index_names)
+        files = {}
+        with open(fname, 'wb') as out_f:
+            out_f.write(_HEADER.pack(cls.MAGIC, 0, 0))
+            for entry in sorted(manifest, key=lambda e: e.rel_path):
+                offset = out_f.tell()
+                copied = cls._copy_file(os.path.join(root, entry.rel_path),
+                                        out_f, entry.size)
+                if copied != entry.size:
+                    raise RuntimeError(
+                        '{} changed while packing'.format(
+                            repr(entry.rel_path)))
+                files[entry.rel_path] = \
+                    [offset, entry.size, entry.mtime, entry.mimetype]
+
+            index = json.dumps({
+                'version': cls.VERSION,
+                'files': files,
+                'indexes': manifest.indexes,
+            }, separators=(',', ':'), sort_keys=True).encode()
+            index_offset = out_f.tell()
+            out_f.write(index)
+            out_f.seek(0)
+            out_f.write(_HEADER.pack(cls.MAGIC, index_offset, len(index)))
+        return len(files)
+
+    @classmethod
+    def _copy_file(cls, path, out_f, size):
+        copied = 0
+        with open(path, 'rb') as in_f, default_buffer_pool.lease() as lease, \
+                memoryview(lease.buffer) as view:
+            while copied < size:
+                n = in_f.readinto(view[0:min(len(view), size - copied)])
+                if not n:
+                    break
+                out_f.write(view[0:n])
+                copied += n
+            if in_f.read(1):
+                copied += 1
+        return copied
+
+
+class BundleResource(PathResource):
+    """A resource class for serving files from a ``StaticBundle``.
+
+    Like ``pyx.http.StaticRootResource``, a new object should be created for
+    every request, while ``bundle`` is shared. Larger files are sent with
+    ``sendfile`` from the bundle's file descriptor, and tiny ones are copied
+    from the mapped bundle.
+    """
+
+    def __init__(self, bundle):
+        super().__init__()
+        self.bundle = bundle
+
+    @methods(['GET'])
+    @asyncio.coroutine
+    def handle_request(self, req):
+        rel_path = '/'.join(s for s in self.path if len(s) > 0)
+        entry = self.bundle.lookup(rel_path)
+        if entry is None:
+            raise HttpError(404, '{} not found'.format(repr(rel_path)))
+
+        entry = self.bundle.manifest.select_variant(
+            entry, req.get_first_header('Accept-Encoding'))
+        if req.get_first_header('If-None-Match') == entry.etag:
+            resp = req.respond(304)
+            resp.headers.append(HttpHeader('ETag', entry.etag))
+            yield from resp.send()
+            return
+
+        logger('BundleResource').debug('Serving file: %r', entry.rel_path)
+        resp = req.respond(200)
+        if entry.size <= self.bundle.tiny_size:
+            yield from resp.send_serialized(
+                resp._encode_head(entry.header_block) + self.bundle.read(entry))
+        else:
+            yield from resp.send_preencoded(entry.header_block)
+            yield from resp.send_file(self.bundle, self.bundle.offset(entry),
+                                      entry.size)
@@ -0,0 +1,326 @@
+"""
+Caches used by the static file server.
+
+"""
+
+
+import collections
+import posixpath
+import time
+
+
+__all__ = ['StaticPathCache', 'StaticIndexCache', 'StaticFileCache']
+
+
+class StaticPathCache:
+    """A bounded cache mapping traversed paths to resolved outcomes.
+
+    Keys are the normalized paths relative to the static root, as built by
+    ``StaticRootResource`` after unquoting and handling ``..``, so that all
+    spellings of a path share one entry.
+
+    An outcome is a tuple ``(kind, rel_path)``, where ``kind`` is one of
+    ``FILE``, ``INDEX`` and ``NOT_FOUND``, and ``rel_path`` is the resolved
+    path relative to the static root.
+
+    Positive outcomes expire after ``ttl`` seconds, and at most
+    ``max_entries`` of them are kept. Negative (``NOT_FOUND``) outcomes are
+    kept separately, with their own ``negative_ttl`` and
+    ``max_negative_entries``, so that floods of missing paths cannot evict
+    the entries for existing files. A TTL of None means entries never
+    expire, which is only safe if ``invalidate`` gets called for every
+    change in the static root. See ``pyx.watch.InotifyWatcher``.
+    """
+
+    FILE = 'file'
+    INDEX = 'index'
+    NOT_FOUND = 'not_found'
+
+    def __init__(self, max_entries=4096, ttl=5.0,
+                 max_negative_entries=4096, negative_ttl=5.0,
+                 clock=time.monotonic):
+        self._entries = collections.OrderedDict()
+        self._negative_entries = collections.OrderedDict()
+        # Resolved paths -> raw request paths, for invalidation
+        self._by_path = {}
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_negative_entries = max_negative_entries
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+
+    def _outcome_paths(self, outcome):
+        kind, rel_path = outcome
+        if kind == self.INDEX:
+            # Also affected by changes in the directory
+            return (rel_path, posixpath.dirname(rel_path))
+        return (rel_path,)
+
+    def _link(self, key, outcome):
+        for rel_path in self._outcome_paths(outcome):
+            keys = self._by_path.get(rel_path)
+            if keys is None:
+                self._by_path[rel_path] = {key}
+            else:
+                keys.add(key)
+
+    def _unlink(self, key, outcome):
+        for rel_path in self._outcome_paths(outcome):
+            keys = self._by_path.get(rel_path)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_path[rel_path]
+
+    def _remove_from(self, entries, key):
+        entry = entries.pop(key, None)
+        if entry is not None:
+            self._unlink(key, entry[0])
+
+    def _get_from(self, entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        outcome, expires = entry
+        if expires is not None and expires <= self._clock():
+            self._remove_from(entries, key)
+            return None
+        entries.move_to_end(key)
+        return outcome
+
+    def get(self, key):
+        """Return the cached outcome for ``key``, or None."""
+        outcome = self._get_from(self._entries, key)
+        if outcome is None:
+            outcome = self._get_from(self._negative_entries, key)
+        if outcome is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return outcome
+
+    def put(self, key, outcome):
+        """Cache ``outcome`` for ``key``."""
+        self.discard(key)
+
+        if outcome[0] == self.NOT_FOUND:
+            entries = self._negative_entries
+            ttl = self.negative_ttl
+            max_entries = self.max_negative_entries
+        else:
+            entries = self._entries
+            ttl = self.ttl
+            max_entries = self.max_entries
+
+        expires = None if ttl is None else self._clock() + ttl
+        entries[key] = (outcome, expires)
+        self._link(key, outcome)
+        while len(entries) > max_entries:
+            old_key, (old_outcome, _expires) = entries.popitem(last=False)
+            self._unlink(old_key, old_outcome)
+
+    def discard(self, key):
+        """Remove the cached outcome for ``key``, if any."""
+        self._remove_from(self._entries, key)
+        self._remove_from(self._negative_entries, key)
+
+    def invalidate(self, rel_path, is_dir=False):
+        """Remove all outcomes that may be affected by a change to
+        ``rel_path``, a path relative to the static root.
+
+        If ``is_dir`` is True, outcomes for paths under ``rel_path`` are
+        removed too. All outcomes are removed if ``rel_path`` is None.
+        """
+        if rel_path is None or (is_dir and rel_path == ''):
+            self.clear()
+            return
+
+        paths = [rel_path, posixpath.dirname(rel_path)]
+        if is_dir:
+            prefix = rel_path + '/'
+            paths.extend(p for p in self._by_path if p.startswith(prefix))
+        for p in paths:
+            for key in list(self._by_path.get(p, ())):
+                self.discard(key)
+
+    def clear(self):
+        """Remove all cached outcomes."""
+        self._entries.clear()
+        self._negative_entries.clear()
+        self._by_path.clear()
+
+    def __len__(self):
+        return len(self._entries) + len(self._negative_entries)
+
+
+class StaticIndexCache:
+    """A bounded cache remembering the index file name of directories.
+
+    Directories are identified by ``(st_dev, st_ino)``, and entries are
+    validated against the modification time of the directory, which changes
+    whenever a file is added to, removed from or renamed within it. The
+    cached name is None if a directory has no index file.
+
+    Directories modified less than ``min_age`` seconds ago are not cached,
+    since a later change may not update a coarse-grained modification time.
+    """
+
+    def __init__(self, max_entries=4096, min_age=1.0, clock=time.time):
+        self._entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.min_age = min_age
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dir_stat):
+        """Look up the directory described by the ``os.stat_result``
+        ``dir_stat``.
+
+        Returns a tuple ``(found, name)``, where ``found`` is False if the
+        directory is not cached, or its cached entry is outdated.
+        """
+        key = (dir_stat.st_dev, dir_stat.st_ino)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == dir_stat.st_mtime_ns:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return (True, entry[1])
+        self.misses += 1
+        return (False, None)
+
+    def put(self, dir_stat, name):
+        """Remember ``name`` as the index file of a directory."""
+        if self._clock() - dir_stat.st_mtime < self.min_age:
+            return
+        key = (dir_stat.st_dev, dir_stat.st_ino)
+        self._entries[key] = (dir_stat.st_mtime_ns, name)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached entries."""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class StaticFileCache:
+    """A memory-bounded LRU cache for complete responses of small files.
+
+    Keys are tuples starting with the path of the file relative to the
+    static root, such as ``(rel_path, http_version)``, and values are fully
+    serialized responses (status line, headers and body) as bytes.
+
+    Only files no larger than ``max_entry_size`` bytes should be cached, and
+    the total size of all cached responses is kept under ``max_size``.
+    Entries expire after ``ttl`` seconds (never if ``ttl`` is None), and are
+    also invalidated if the size or modification time of the file changes.
+    """
+
+    def __init__(self, max_entry_size=16384, max_size=16777216, ttl=5.0,
+                 clock=time.monotonic):
+        self._entries = collections.OrderedDict()
+        # Relative paths -> keys, for invalidation
+        self._by_path = {}
+        self.max_entry_size = max_entry_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, file_stat=None):
+        """Return the cached response for ``key``, or None.
+
+        If ``file_stat`` is specified, the entry is validated against it,
+        and a valid entry gets a new lease of ``ttl`` seconds.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        data, file_id, expires = entry
+        if file_stat is not None:
+            if file_id != (file_stat.st_mtime_ns, file_stat.st_size):
+                self.discard(key)
+                self.misses += 1
+                return None
+            if self.ttl is not None:
+                self._entries[key] = (data, file_id, self._clock() + self.ttl)
+        elif expires is not None and expires <= self._clock():
+            self.discard(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data, file_stat=None):
+        """Cache the serialized response ``data`` for ``key``.
+
+        ``file_stat`` is the ``os.stat_result`` of the file when ``data`` was
+        read.
+        """
+        if len(data) > self.max_size:
+            return
+        self.discard(key)
+
+        if file_stat is None:
+            file_id = None
+        else:
+            file_id = (file_stat.st_mtime_ns, file_stat.st_size)
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        self._entries[key] = (data, file_id, expires)
+        keys = self._by_path.get(key[0])
+        if keys is None:
+            self._by_path[key[0]] = {key}
+        else:
+            keys.add(key)
+        self.size += len(data)
+        while self.size > self.max_size:
+            self.discard(next(iter(self._entries)))
+
+    def discard(self, key):
+        """Remove the cached response for ``key``, if any."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+            keys = self._by_path[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._by_path[key[0]]
+
+    def invalidate(self, rel_path, is_dir=False):
+        """Remove the cached responses for the file ``rel_path``.
+
+        If ``is_dir`` is True, responses for all files under ``rel_path`` are
+        removed. All responses are removed if ``rel_path`` is None.
+        """
+        if rel_path is None or (is_dir and rel_path == ''):
+            self.clear()
+            return
+
+        paths = [rel_path]
+        if is_dir:
+            prefix = rel_path + '/'
+            paths.extend(p for p in self._by_path if p.startswith(prefix))
+        for p in paths:
+            for key in list(self._by_path.get(p, ())):
+                self.discard(key)
+
+    def clear(self):
+        """Remove all cached responses."""
+        self._entries.clear()
+        self._by_path.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -6,12 +6,26 @@ Command line entry points.
 
 import asyncio
 import logging
+import os
 import argparse
+import glob
+import sys
 from .log import logger
-from .http import (HttpConnectionCB, HttpRequestCB, StaticRootResource)
+from .io import (warm_up_files, BandwidthScheduler)
+from .cache import (StaticPathCache, StaticFileCache)
+from .manifest import StaticManifest
+from .bundle import (StaticBundle, BundleResource)
+from .watch import InotifyWatcher
+from .router import (Router, mount)
+from .metrics import (ServerMetrics, MetricsResource)
+from .hooks import (RequestHooks, SlowRequestLogger)
+from .accesslog import AccessLog
+from .monitor import (LoopLagMonitor, BlockingWatchdog)
+from .http import (HttpConnectionCB, HttpRequestCB, HttpRequestLimits,
+                   LazyHttpRequest, StaticRootResource, default_index_cache)
 
 
-__all__ = ['main']
+__all__ = ['main', 'manifest_main', 'pack_main']
 
 
 def _parse_arguments():
@@ -32,6 +46,136 @@ def _parse_arguments():
                         help='Backlog for the listening socket (default: 128)',
                         default=128,
                         type=int)
+    parser.add_argument('--no-follow-symlinks',
+                        help='Do not serve symbolic links',
+                        dest='follow_symlinks',
+                        default=True,
+                        action='store_false')
+    parser.add_argument('--allow-put',
+                        help='Accept file uploads with PUT requests',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--max-upload-size',
+                        help='Max size of files uploaded with PUT requests '
+                             'in bytes, 0 for no limit (default: 1073741824)',
+                        default=1073741824,
+                        type=int)
+    parser.add_argument('--immutable',
+                        help='Scan the root dir at startup, and assume it '
+                             'never changes',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--manifest',
+                        help='Serve files listed in this manifest, '
+                             'see pyx-manifest (implies --immutable)',
+                        default=None,
+                        type=str)
+    parser.add_argument('--bundle',
+                        help='Serve files packed in this bundle, '
+                             'see pyx-pack (--root is ignored)',
+                        default=None,
+                        type=str)
+    parser.add_argument('--warm-up',
+                        help='Load files matching this glob pattern (relative '
+                             'to the root dir) into the page cache at startup. '
+                             'Can be specified multiple times. With --bundle, '
+                             'the whole bundle is loaded',
+                        dest='warm_up',
+                        default=[],
+                        action='append',
+                        type=str)
+    parser.add_argument('--warm-up-read',
+                        help='Warm up by reading the files, instead of '
+                             'asking the kernel to read ahead',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--cache-ttl',
+                        help='Seconds to cache resolved paths, '
+                             '0 to disable (default: 5)',
+                        default=5.0,
+                        type=float)
+    parser.add_argument('--watch',
+                        help='Watch the root dir with inotify, and keep '
+                             'cached entries until the files change',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--file-cache-size',
+                        help='Memory for caching small files in bytes, '
+                             '0 to disable (default: 16777216)',
+                        default=16777216,
+                        type=int)
+    parser.add_argument('--file-cache-max-entry',
+                        help='Max size of cached files in bytes '
+                             '(default: 16384)',
+                        default=16384,
+                        type=int)
+    parser.add_argument('--rate-limit',
+                        help='Max total sending rate of file transfers, '
+                             'in bytes per second (default: no limit)',
+                        default=None,
+                        type=int)
+    parser.add_argument('--conn-rate-limit',
+                        help='Max sending rate of file transfers per '
+                             'connection, in bytes per second '
+                             '(default: no limit)',
+                        default=None,
+                        type=int)
+    parser.add_argument('--metrics-path',
+                        help='Serve metrics in the Prometheus text format '
+                             'at this path, e.g. /metrics (default: disabled)',
+                        default=None,
+                        type=str)
+    parser.add_argument('--slow-request-threshold',
+                        help='Log requests taking longer than this many '
+                             'seconds, with per-stage timing '
+                             '(default: disabled)',
+                        default=None,
+                        type=float)
+    parser.add_argument('--access-log',
+                        help='Write an access log to this file, '
+                             'or - for stdout (default: disabled)',
+                        default=None,
+                        type=str)
+    parser.add_argument('--access-log-format',
+                        help='Access log format, either "common", '
+                             '"combined", or a str.format template '
+                             '(default: combined)',
+                        default='combined',
+                        type=str)
+    parser.add_argument('--shed-lag',
+                        help='Answer new requests with 503 while the event '
+                             'loop lags behind by this many seconds '
+                             '(default: disabled)',
+                        default=None,
+                        type=float)
+    parser.add_argument('--retry-after',
+                        help='Retry-After value for shed requests, '
+                             'in seconds (default: 1)',
+                        default=1,
+                        type=int)
+    parser.add_argument('--debug-blocking',
+                        help='Log the stack of callbacks blocking the event '
+                             'loop for more than this many seconds, and '
+                             'report the top offenders on exit '
+                             '(default: disabled)',
+                        default=None,
+                        type=float)
+    parser.add_argument('--max-request-line',
+                        help='Max length of request lines (default: 8192)',
+                        default=8192,
+                        type=int)
+    parser.add_argument('--max-header-line',
+                        help='Max length of header lines (default: 8192)',
+                        default=8192,
+                        type=int)
+    parser.add_argument('--max-headers',
+                        help='Max number of request headers (default: 100)',
+                        default=100,
+                        type=int)
+    parser.add_argument('--max-head-size',
+                        help='Max size of request heads (default: 65536)',
+                        default=65536,
+                        type=int)
     parser.add_argument('--loglevel',
                         help='Log level (default: info)',
                         default='info',
@@ -44,22 +188,97 @@ def _parse_arguments():
     return parser.parse_args()
 
 
-def main():
-    args = _parse_arguments()
+def _start_warm_up(args, loop, file_names):
+    def _done(future):
+        if not future.cancelled() and future.exception() is None:
+            logger().info('Warmed up {} bytes in {} files'.format(
+                            future.result(), len(file_names)))
 
-    logging.basicConfig(level=args.loglevel.upper())
+    future = loop.run_in_executor(None, warm_up_files,
+                                  file_names, args.warm_up_read)
+    future.add_done_callback(_done)
 
-    loop = asyncio.get_event_loop()
 
-    def root_factory(req):
-        return StaticRootResource(args.root)
+def _warm_up_list(root, patterns):
+    file_names = []
+    for pattern in patterns:
+        for fname in glob.iglob(os.path.join(root, pattern), recursive=True):
+            if os.path.isfile(fname):
+                file_names.append(fname)
+    return file_names
+
+
+def _run_server(args, loop, make_root, caches=()):
+    limits = HttpRequestLimits(max_request_line=args.max_request_line,
+                               max_header_line=args.max_header_line,
+                               max_headers=args.max_headers,
+                               max_head_size=args.max_head_size)
+    logger().info('Request head memory ceiling: {} bytes per connection'.format(
+                    limits.memory_ceiling()))
+
+    if args.rate_limit is not None or args.conn_rate_limit is not None:
+        scheduler = BandwidthScheduler(rate=args.rate_limit,
+                                       conn_rate=args.conn_rate_limit)
+    else:
+        scheduler = None
+
+    if args.shed_lag is not None or args.metrics_path is not None:
+        monitor = LoopLagMonitor(loop=loop, threshold=args.shed_lag,
+                                 retry_after=args.retry_after)
+        monitor.start()
+    else:
+        monitor = None
+
+    if args.debug_blocking is not None:
+        watchdog = BlockingWatchdog(loop=loop, threshold=args.debug_blocking)
+        watchdog.start()
+    else:
+        watchdog = None
+
+    if args.metrics_path is not None:
+        metrics = ServerMetrics()
+        metrics.watch_loop(monitor)
+        for name, c in caches:
+            if c is not None:
+                metrics.watch_cache(name, c)
+        router = Router({
+            args.metrics_path: MetricsResource(metrics.registry),
+            '': mount(make_root),
+        })
+        root_factory = lambda req: router
+    else:
+        metrics = None
+        root_factory = lambda req: make_root()
+
+    if args.slow_request_threshold is not None or args.access_log is not None:
+        hooks = RequestHooks()
+    else:
+        hooks = None
+    if args.slow_request_threshold is not None:
+        hooks.add(SlowRequestLogger(args.slow_request_threshold))
+    if args.access_log is not None:
+        if args.access_log == '-':
+            access_log_file = sys.stdout
+        else:
+            access_log_file = open(args.access_log, 'a')
+        access_log = AccessLog(access_log_file, args.access_log_format)
+        access_log.start()
+        hooks.add(access_log)
+    else:
+        access_log = None
 
-    req_cb = HttpRequestCB(root_factory)
-    conn_cb = HttpConnectionCB(req_cb)
+    req_cb = HttpRequestCB(root_factory, metrics=metrics)
+    conn_cb = HttpConnectionCB(req_cb, limits=limits,
+                               request_class=LazyHttpRequest,
+                               scheduler=scheduler,
+                               metrics=metrics,
+                               hooks=hooks,
+                               monitor=monitor)
 
     starter = asyncio.start_server(conn_cb, args.bind, args.port,
                                    backlog=args.backlog,
                                    reuse_address=True,
+                                   limit=limits.stream_limit,
                                    loop=loop)
     server = loop.run_until_complete(starter)
 
@@ -75,7 +294,134 @@ def main():
 
     server.close()
     loop.run_until_complete(server.wait_closed())
+    if monitor is not None:
+        monitor.stop()
+    if watchdog is not None:
+        watchdog.stop()
+        logger().info(watchdog.format_report())
+
+    if access_log is not None:
+        access_log.close()
+        if access_log_file is not sys.stdout:
+            access_log_file.close()
+
+
+def main():
+    args = _parse_arguments()
+
+    logging.basicConfig(level=args.loglevel.upper())
+
+    loop = asyncio.get_event_loop()
+
+    if args.bundle is not None:
+        bundle = StaticBundle(args.bundle)
+        logger().info('{} files in bundle'.format(len(bundle)))
+        if args.warm_up:
+            _start_warm_up(args, loop, [args.bundle])
+        _run_server(args, loop, lambda: BundleResource(bundle))
+        loop.close()
+        bundle.close()
+        return
+
+    if args.manifest is not None:
+        manifest = StaticManifest.load(args.manifest)
+    elif args.immutable:
+        manifest = StaticManifest.scan(args.root,
+                                       StaticRootResource.INDEX_NAMES)
+    else:
+        manifest = None
+    if manifest is not None:
+        logger().info('{} files in manifest'.format(len(manifest)))
+
+    watch = args.watch and manifest is None
+    cache_ttl = None if watch else args.cache_ttl
+
+    if (watch or args.cache_ttl > 0) and manifest is None:
+        path_cache = StaticPathCache(ttl=cache_ttl, negative_ttl=cache_ttl)
+    else:
+        path_cache = None
+
+    if args.file_cache_size > 0:
+        # Cached files are validated against a fresh stat on every hit, so
+        # entries don't need to expire
+        file_cache = StaticFileCache(max_entry_size=args.file_cache_max_entry,
+                                     max_size=args.file_cache_size,
+                                     ttl=None)
+    else:
+        file_cache = None
+
+    if watch:
+        watcher = InotifyWatcher(args.root, loop=loop)
+        for c in (path_cache, file_cache):
+            if c is not None:
+                watcher.subscribe(c.invalidate)
+        watcher.start()
+    else:
+        watcher = None
+
+    if args.warm_up:
+        _start_warm_up(args, loop, _warm_up_list(args.root, args.warm_up))
+
+    root_fd = os.open(args.root, os.O_RDONLY | os.O_DIRECTORY)
+
+    def make_root():
+        return StaticRootResource(args.root,
+                                  path_cache=path_cache,
+                                  root_fd=root_fd,
+                                  follow_symlinks=args.follow_symlinks,
+                                  manifest=manifest,
+                                  file_cache=file_cache,
+                                  writable=args.allow_put,
+                                  max_upload_size=args.max_upload_size or None)
+
+    _run_server(args, loop, make_root,
+                [('path', path_cache), ('file', file_cache),
+                 ('index', default_index_cache)])
+
+    if watcher is not None:
+        watcher.close()
     loop.close()
+    os.close(root_fd)
+
+
+def manifest_main():
+    parser = argparse.ArgumentParser(
+        description='Generate a manifest for an immutable static tree')
+    parser.add_argument('-r', '--root',
+                        help='Root dir to scan (default: .)',
+                        default='.',
+                        type=str)
+    parser.add_argument('-o', '--output',
+                        help='The manifest file to write',
+                        required=True,
+                        type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+
+    manifest = StaticManifest.scan(args.root, StaticRootResource.INDEX_NAMES)
+    manifest.save(args.output)
+    logger().info('{} files written to {}'.format(len(manifest), args.output))
+
+
+def pack_main():
+    parser = argparse.ArgumentParser(
+        description='Pack a static tree into a bundle file')
+    parser.add_argument('-r', '--root',
+                        help='Root dir to pack (default: .)',
+                        default='.',
+                        type=str)
+    parser.add_argument('-o', '--output',
+                        help='The bundle file to write',
+                        required=True,
+                        type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+
+    count = StaticBundle.pack(args.root, args.output,
+                              StaticRootResource.INDEX_NAMES)
+    logger().info('{} files packed into {}'.format(count, args.output))
 
 
 if __name__ == '__main__':
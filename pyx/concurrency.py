@@ -0,0 +1,146 @@
+"""
+Concurrency limits for expensive resources.
+
+A ``ConcurrencyLimiter`` caps the number of requests handled at the same
+time. It's applied to request handlers with ``limit_concurrency``, below
+``methods(...)``::
+
+    from pyx.http import (UrlResource, methods)
+    from pyx.concurrency import (ConcurrencyLimiter, limit_concurrency)
+
+    report_limiter = ConcurrencyLimiter('reports', 2, queue_size=16,
+                                        timeout=10)
+
+    class ReportResource(UrlResource):
+        @methods(['GET'])
+        @limit_concurrency(report_limiter)
+        @asyncio.coroutine
+        def handle_request(self, req):
+            ...
+
+Requests over the limit wait in a bounded queue. They're rejected with
+*503 Service Unavailable* when the queue is full, or when they have waited
+for too long. The statistics of a limiter can be exported with
+``pyx.metrics.ServerMetrics.watch_limiter``.
+
+"""
+
+
+import asyncio
+import collections
+import functools
+from .log import logger
+from .http import HttpError
+
+
+__all__ = ['ConcurrencyLimiter', 'limit_concurrency']
+
+
+class ConcurrencyLimiter:
+    """Allow at most ``limit`` concurrent holders.
+
+    At most ``queue_size`` callers wait for a free slot, in FIFO order, for
+    no longer than ``timeout`` seconds (forever if it's None). ``name``
+    identifies the limiter in logs and metrics.
+
+    The number of holders and waiters are available as ``active`` and
+    ``queue_depth``. ``queued`` counts all callers that had to wait, and
+    ``wait_time`` is their total waiting time. ``rejected`` maps reasons
+    (``'queue_full'`` or ``'timeout'``) to the number of rejected callers.
+    """
+
+    def __init__(self, name, limit, queue_size=0, timeout=None):
+        assert limit > 0
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+        self._waiters = collections.deque()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        logger('ConcurrencyLimiter').debug('%s: rejected, %s',
+                                           self.name, reason)
+        raise HttpError(503, '{}: {}'.format(self.name, reason))
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Take a slot, waiting in the queue if necessary. Raises
+        ``HttpError(503)`` if no slot is available in time."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            self._reject('queue_full')
+
+        loop = asyncio.get_event_loop()
+        waiter = asyncio.Future(loop=loop)
+        self._waiters.append(waiter)
+        if self.timeout is not None:
+            timer = loop.call_later(self.timeout, self._expire, waiter)
+        else:
+            timer = None
+
+        start = loop.time()
+        try:
+            yield from waiter
+        except asyncio.TimeoutError:
+            self._reject('timeout')
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and \
+                    waiter.exception() is None:
+                # The slot was handed over, but we're not going to use it
+                self.release()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            self.queued += 1
+            self.wait_time += loop.time() - start
+
+    def _expire(self, waiter):
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            waiter.set_exception(asyncio.TimeoutError())
+
+    def release(self):
+        """Release a slot, and hand it over to the first waiter."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # self.active is unchanged, the slot is passed on
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+def limit_concurrency(limiter):
+    """A decorator to run a request handler with a slot from ``limiter``,
+    a ``ConcurrencyLimiter``. The same limiter can be shared by handlers
+    of different methods or resources."""
+
+    def deco(handler):
+        @functools.wraps(handler)
+        @asyncio.coroutine
+        def _limited_handler(self, req):
+            yield from limiter.acquire()
+            try:
+                return (yield from handler(self, req))
+            finally:
+                limiter.release()
+        return _limited_handler
+
+    return deco
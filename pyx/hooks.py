@@ -0,0 +1,119 @@
+"""
+Request lifecycle hooks.
+
+Hooks are registered in a ``RequestHooks`` object, which is passed to
+``HttpConnectionCB``::
+
+    from pyx.http import HttpConnectionCB
+    from pyx.hooks import (RequestHooks, SlowRequestLogger)
+
+    hooks = RequestHooks()
+    hooks.add(SlowRequestLogger(threshold=0.5))
+    hooks.on_response_finished.append(
+        lambda req, t: print(req.path, t - req.timings['start']))
+
+    conn_cb = HttpConnectionCB(req_cb, hooks=hooks)
+
+When no hooks object is passed, no timestamps are taken at all.
+
+"""
+
+
+import time
+from .log import logger
+
+
+__all__ = ['RequestHooks', 'SlowRequestLogger']
+
+
+class RequestHooks:
+    """A registry of callbacks for the stages of request processing.
+
+    The stages are, in order:
+
+        * ``request_parsed``: the request head is parsed;
+        * ``resource_resolved``: the path is traversed, and the resource is
+          available as ``req.resource``;
+        * ``response_started``: the response head is being sent;
+        * ``response_finished``: the request is completely handled.
+
+    Callbacks are appended to the lists named ``on_<stage>``, and called as
+    ``cb(req, timestamp)``, where ``timestamp`` is taken with
+    ``time.monotonic()``. All timestamps of a request are also recorded in
+    the dict ``req.timings``, keyed by stage name, plus ``'start'`` for the
+    time the request line was received. Stages may be missing, e.g. when
+    the request is rejected before a resource is found.
+    """
+
+    STAGES = ['request_parsed', 'resource_resolved',
+              'response_started', 'response_finished']
+
+    def __init__(self):
+        self.on_request_parsed = []
+        self.on_resource_resolved = []
+        self.on_response_started = []
+        self.on_response_finished = []
+
+    def add(self, obj):
+        """Register all the ``on_<stage>`` methods of ``obj``."""
+        for stage in self.STAGES:
+            cb = getattr(obj, 'on_' + stage, None)
+            if cb is not None:
+                getattr(self, 'on_' + stage).append(cb)
+
+    def _fire(self, callbacks, stage, req):
+        t = time.monotonic()
+        req.timings[stage] = t
+        for cb in callbacks:
+            try:
+                cb(req, t)
+            except Exception:
+                logger('RequestHooks').exception('Hook failed for %s', stage)
+
+    def request_parsed(self, req):
+        self._fire(self.on_request_parsed, 'request_parsed', req)
+
+    def resource_resolved(self, req):
+        self._fire(self.on_resource_resolved, 'resource_resolved', req)
+
+    def response_started(self, req):
+        self._fire(self.on_response_started, 'response_started', req)
+
+    def response_finished(self, req):
+        self._fire(self.on_response_finished, 'response_finished', req)
+
+
+class SlowRequestLogger:
+    """Log requests taking longer than ``threshold`` seconds, with the time
+    spent in every stage. Register with ``RequestHooks.add``.
+    """
+
+    # (label, from, to)
+    BREAKDOWN = [
+        ('parse', 'start', 'request_parsed'),
+        ('traverse', 'request_parsed', 'resource_resolved'),
+        ('handler', 'resource_resolved', 'response_started'),
+        ('send', 'response_started', 'response_finished'),
+    ]
+
+    def __init__(self, threshold=1.0):
+        self.threshold = threshold
+
+    def on_response_finished(self, req, t):
+        total = t - req.timings['start']
+        if total < self.threshold:
+            return
+
+        timings = dict(req.timings, response_finished=t)
+        parts = []
+        for label, begin, end in self.BREAKDOWN:
+            if begin in timings and end in timings:
+                parts.append('{} {:.3f}s'.format(
+                    label, timings[end] - timings[begin]))
+            else:
+                parts.append('{} -'.format(label))
+        code = req.response.code if req.response is not None else '-'
+        logger('SlowRequestLogger').warning(
+            'Slow request: %s %s -> %s in %.3fs (%s)',
+            getattr(req, 'method', '-'), getattr(req, 'path', '-'), code,
+            total, ', '.join(parts))
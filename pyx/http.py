@@ -27,23 +27,33 @@ A basic HTTP server can be assembled in a simple way::
 
 import asyncio
 import collections
-import urllib
+import collections.abc
+import urllib.parse
 import mimetypes
 import os
-import glob
+import errno
+import stat
 import traceback
+import time
+import uuid
 from .log import logger
-from .io import (AsyncFile, sendfile_async, BoundaryReader)
+from .cache import (StaticPathCache, StaticIndexCache)
+from .io import (AsyncFile, sendfile_async, splice_to_file,
+                 LengthReader, BoundaryReader)
 from .version import __version__
 
 
 __all__ = ['BadHttpRequestError', 'BadHttpHeaderError', 'HttpError',
            'HttpHeader', 'parse_http_header', 'get_kv', 'get_first_kv',
            'HttpConnection', 'HttpMessage', 'HttpRequest', 'HttpResponse',
+           'HttpHeaderView', 'LazyHttpRequest', 'MultiDict',
+           'HttpRequestLimits', 'default_request_limits',
            'DefaultHttpErrorHandler', 'default_error_page',
            'HttpRequestCB', 'HttpConnectionCB',
-           'UrlResource', 'StaticRootResource', 'methods',
-           'parse_multipart_formdata',
+           'UrlResource', 'PathResource', 'StaticRootResource',
+           'default_index_cache', 'methods',
+           'parse_multipart_formdata', 'parse_urlencoded_form',
+           'save_request_body',
            'status_messages', ]
 
 
@@ -82,15 +92,48 @@ class HttpError(Exception):
 
 status_messages = {
     200: "OK",
+    201: "Created",
+    204: "No Content",
     303: "See Other",
+    304: "Not Modified",
     400: "Bad Request",
     403: "Forbidden",
     404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    411: "Length Required",
+    413: "Payload Too Large",
+    414: "URI Too Long",
+    431: "Request Header Fields Too Large",
     500: "Internal Error",
     501: "Not Implemented",
+    503: "Service Unavailable",
 }
 
 
+# asyncio.Task.current_task() is gone since Python 3.9
+_current_task = getattr(asyncio, 'current_task', None) or \
+    asyncio.Task.current_task
+
+
+class _ConnectionLostProtocol:
+    """A protocol wrapper, calling ``on_lost`` after the wrapped protocol
+    has been notified of the connection loss."""
+
+    def __init__(self, protocol, on_lost):
+        self._protocol = protocol
+        self._on_lost = on_lost
+
+    def __getattr__(self, name):
+        return getattr(self._protocol, name)
+
+    def connection_lost(self, exc):
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._on_lost()
+
+
 class HttpConnection:
     """Connection level data & operations.
 
@@ -98,18 +141,55 @@ class HttpConnection:
     interface.
     ``writer`` should be an ``asyncio.StreamWriter``, or implementing the same
     interface.
+
+    ``throttle`` is used to limit the rate of file transfers on this
+    connection, see ``pyx.io.BandwidthScheduler``. ``hooks`` is a
+    ``pyx.hooks.RequestHooks`` object for requests on this connection. Both
+    are None by default.
     """
 
     def __init__(self, reader, writer):
         self._reader = reader
         self._writer = writer
         self._closed = False
+        self._handling = False
+        self._disconnected = False
+        self.throttle = None
+        self.hooks = None
+
+    def _watch_disconnect(self, task):
+        """Cancel ``task`` if the connection is lost while a request is being
+        handled.
+
+        The protocol of the writer's transport is wrapped to be notified in
+        ``connection_lost``. A half-closed connection, where the peer only
+        shut down its sending side, is not lost: the response is still
+        delivered.
+        """
+        transport = getattr(self._writer, 'transport', None)
+        get_protocol = getattr(transport, 'get_protocol', None)
+        if get_protocol is None:
+            return
+
+        def _lost():
+            if self._handling and not task.done():
+                logger('HttpConnection').debug(
+                    'Connection lost, cancelling request')
+                self._disconnected = True
+                task.cancel()
+
+        transport.set_protocol(_ConnectionLostProtocol(get_protocol(), _lost))
 
     @property
     def closed(self):
         """True if ``close()`` has been called."""
         return self._closed
 
+    @property
+    def disconnected(self):
+        """True if a request was cancelled because the peer went away."""
+        return self._disconnected
+
     def close(self):
         """Close this connection."""
         logger('HttpConnection').debug('Closing connection....')
@@ -175,6 +255,113 @@ def get_first_kv(kv_list, key):
     return None
 
 
+class HttpRequestLimits:
+    """Size limits for request heads.
+
+    ``max_request_line`` and ``max_header_line`` are the maximum lengths (in
+    bytes, including the line terminator) of the request line and each
+    header line. ``max_headers`` is the maximum number of header lines, and
+    ``max_head_size`` is the maximum size of the whole request head.
+
+    A request line exceeding its limit results in *414 URI Too Long*, and
+    all other violations result in *431 Request Header Fields Too Large*.
+
+    ``max_form_size``, ``max_form_fields`` and ``max_form_field_size`` limit
+    the size of urlencoded form bodies, the number of fields in them, and the
+    size of each encoded field. Violations result in *413 Payload Too Large*.
+    See ``HttpRequest.read_form``.
+    """
+
+    # Rough per-header cost of an ``HttpHeader`` tuple and its two strings,
+    # on top of the header data itself
+    HEADER_OVERHEAD = 256
+
+    def __init__(self, max_request_line=8192, max_header_line=8192,
+                 max_headers=100, max_head_size=65536,
+                 max_form_size=1048576, max_form_fields=1000,
+                 max_form_field_size=65536):
+        self.max_request_line = max_request_line
+        self.max_header_line = max_header_line
+        self.max_headers = max_headers
+        self.max_head_size = max_head_size
+        self.max_form_size = max_form_size
+        self.max_form_fields = max_form_fields
+        self.max_form_field_size = max_form_field_size
+
+    @property
+    def stream_limit(self):
+        """A suitable ``limit`` for the ``asyncio.StreamReader`` of each
+        connection, so that over-long lines are not buffered beyond what the
+        limits allow.
+        """
+        return max(self.max_request_line, self.max_header_line)
+
+    def memory_ceiling(self, stream_limit=None):
+        """Estimate the worst-case memory (in bytes) held by one connection
+        while its request head is being read and parsed.
+
+        ``stream_limit`` is the ``limit`` of the connection's
+        ``asyncio.StreamReader``, and defaults to ``self.stream_limit``.
+        A stream reader buffers up to twice its limit before pausing the
+        transport.
+        """
+        if stream_limit is None:
+            stream_limit = self.stream_limit
+        return (2 * stream_limit +
+                # raw lines plus their decoded copies
+                2 * self.max_head_size +
+                self.max_headers * self.HEADER_OVERHEAD)
+
+
+default_request_limits = HttpRequestLimits()
+
+
+@asyncio.coroutine
+def _read_head_line(reader, max_len, code):
+    try:
+        line = yield from reader.readline()
+    except ValueError:
+        # asyncio.StreamReader raises ValueError when a line overruns its
+        # own buffer limit
+        raise HttpError(code, 'Line too long')
+    if len(line) > max_len:
+        raise HttpError(code, 'Line too long: {} bytes'.format(len(line)))
+    return line
+
+
+class MultiDict(collections.abc.Mapping):
+    """A read-only mapping in which a key may have multiple values.
+
+    ``items`` should be an iterable of ``(key, value)`` pairs. Indexing
+    returns the first value for a key, and ``get_all`` returns all of them.
+    """
+
+    def __init__(self, items=()):
+        self._values = {}
+        for k, v in items:
+            vlist = self._values.get(k)
+            if vlist is None:
+                self._values[k] = [v]
+            else:
+                vlist.append(v)
+
+    def __getitem__(self, key):
+        return self._values[key][0]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get_all(self, key):
+        """Return all values for ``key`` as a list."""
+        return list(self._values.get(key, []))
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._values)
+
+
 class HttpMessage:
     """Base class for requests and responses."""
 
@@ -224,13 +411,24 @@ class HttpRequest(HttpMessage):
         ``version``:  HTTP version, as a tuple (major, minor)
         ``protocol``: Should always be "HTTP"
         ``headers``:  HTTP headers for this request.
+
+    The parsed query string is available as ``args``, and urlencoded form
+    bodies can be read with ``read_form()``.
     """
 
     def __init__(self, conn):
         super().__init__(conn)
         self._responded = False
+        self.limits = default_request_limits
+        self._args = None
+        self._form = None
+        self._continued = False
+        self.response = None
+        self.resource = None
+        self.timings = None
 
     def _parse_req_line(self, req_line):
+        self._args = None
         req_line = req_line.decode().strip()
         # Shortcut for client disconnection
         if len(req_line) == 0:
@@ -284,8 +482,93 @@ class HttpRequest(HttpMessage):
         resp.request = self
         if hasattr(self, 'version'):
             resp.version = self.version
+        self.response = resp
         return resp
 
+    @property
+    def args(self):
+        """The query arguments as a ``MultiDict``.
+
+        The query string is parsed on first access, and the result is cached.
+        """
+        if self._args is None:
+            if self.query:
+                self._args = MultiDict(urllib.parse.parse_qsl(
+                    self.query, keep_blank_values=True))
+            else:
+                self._args = MultiDict()
+        return self._args
+
+    @property
+    def form(self):
+        """The form fields as a ``MultiDict``, or None if ``read_form()`` was
+        not called yet.
+        """
+        return self._form
+
+    @asyncio.coroutine
+    def read_form(self):
+        """Read the request body and parse it as urlencoded form data.
+
+        The body is parsed incrementally, and the result is cached and
+        returned as a ``MultiDict``. An empty ``MultiDict`` is returned if
+        the body is not ``application/x-www-form-urlencoded``.
+
+        May raise ``HttpError`` (400, 411 or 413) according to the
+        Content-Length header and ``self.limits``.
+        """
+        if self._form is not None:
+            return self._form
+
+        ctype = self.get_first_header('Content-Type') or ''
+        if ctype.split(';', 1)[0].strip().lower() != \
+                'application/x-www-form-urlencoded':
+            self._form = MultiDict()
+            return self._form
+
+        length = self._get_content_length(self.limits.max_form_size,
+                                          'form data')
+        yield from self.send_continue()
+        reader = LengthReader(self.connection.reader, length)
+        self._form = yield from parse_urlencoded_form(
+            reader,
+            max_fields=self.limits.max_form_fields,
+            max_field_size=self.limits.max_form_field_size)
+        return self._form
+
+    @asyncio.coroutine
+    def send_continue(self):
+        """Send *100 Continue* if the client is waiting for it before sending
+        the request body, as asked with ``Expect: 100-continue``.
+
+        Call this right before reading the body, once the request is known
+        to be acceptable. It does nothing if it was called already, or a
+        response was sent.
+        """
+        if self._continued or self._responded or self.version < (1, 1):
+            return
+        expect = self.get_first_header('Expect')
+        if expect is None or expect.strip().lower() != '100-continue':
+            return
+        self._continued = True
+        self.connection.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        yield from self.connection.writer.drain()
+
+    def _get_content_length(self, max_size, what):
+        length = self.get_first_header('Content-Length')
+        if length is None:
+            raise HttpError(411, 'No Content-Length for {}'.format(what))
+        try:
+            length = int(length, 10)
+        except ValueError:
+            raise HttpError(400, 'Bad Content-Length: {}'.format(repr(length)))
+        if length < 0:
+            raise HttpError(400, 'Bad Content-Length: {}'.format(length))
+        if max_size is not None and length > max_size:
+            raise HttpError(413, '{} too large: {} bytes'.format(
+                                    what[0].upper() + what[1:], length))
+        return length
+
     @property
     def responded(self):
         """True if ``HttpResponse.send(...)`` is called."""
@@ -294,37 +577,184 @@ class HttpRequest(HttpMessage):
     @responded.setter
     def responded(self, value):
         assert (type(value) is bool)
+        if value and not self._responded and self.timings is not None:
+            self.connection.hooks.response_started(self)
         self._responded = value
 
     @classmethod
     @asyncio.coroutine
-    def parse(cls, conn):
+    def parse(cls, conn, limits=None):
         """Read a request from the HTTP connection ``conn``.
 
-        May raise ``BadHttpRequestError``.
+        ``limits`` should be an ``HttpRequestLimits`` object. The
+        ``default_request_limits`` are used if it's omitted.
+
+        May raise ``BadHttpRequestError``, or ``HttpError`` (414 or 431) when
+        the request head exceeds ``limits``.
         """
 
+        limits = limits or default_request_limits
         req = cls(conn)
-        req_line = yield from conn.reader.readline()
+        req.limits = limits
+        req_line = yield from _read_head_line(
+            conn.reader, limits.max_request_line, 414)
+        if conn.hooks is not None:
+            req.timings = {'start': time.monotonic()}
         logger('HttpRequest').debug('req_line = %r', req_line)
         req._parse_req_line(req_line)
 
-        header_line = yield from conn.reader.readline()
+        head_size = len(req_line)
+        header_count = 0
+        header_line = yield from _read_head_line(
+            conn.reader, limits.max_header_line, 431)
         while len(header_line) > 0 and header_line != b'\r\n':
+            head_size += len(header_line)
+            header_count += 1
+            if head_size > limits.max_head_size:
+                raise HttpError(431, 'Request head too large')
+            if header_count > limits.max_headers:
+                raise HttpError(431, 'Too many headers')
+
             try:
                 req._parse_header(header_line)
             except BadHttpHeaderError as e:
                 # Tolerating 'minor' mistakes
                 logger('HttpRequest').debug(traceback.format_exc())
-            header_line = yield from conn.reader.readline()
+            header_line = yield from _read_head_line(
+                conn.reader, limits.max_header_line, 431)
         return req
 
 
+class HttpHeaderView(collections.abc.Sequence):
+    """A read-only sequence of ``HttpHeader`` objects, backed by raw header
+    lines.
+
+    Header lines are kept as bytes, together with the offsets of their
+    colons. Names and values are only decoded (as latin-1) when accessed, and
+    the decoded ``HttpHeader`` objects are memoized.
+    """
+
+    def __init__(self):
+        self._raw = bytearray()
+        # (start, colon, end) offsets in self._raw, one for each header
+        self._offsets = []
+        self._decoded = []
+        # Lower-cased names -> header indices, built on first lookup
+        self._names = None
+
+    def append_line(self, header_line):
+        """Append a raw header line.
+
+        ``BadHttpHeaderError`` is raised if ``header_line`` is not a valid
+        header line.
+        """
+        col_idx = header_line.find(b':')
+        if col_idx < 1 or not header_line[0:col_idx].strip():
+            raise BadHttpHeaderError('Bad header: {}'.format(repr(header_line)))
+
+        start = len(self._raw)
+        self._raw.extend(header_line)
+        self._offsets.append((start, start + col_idx, len(self._raw)))
+        self._decoded.append(None)
+        self._names = None
+
+    def _decode(self, idx):
+        header = self._decoded[idx]
+        if header is None:
+            start, colon, end = self._offsets[idx]
+            raw = self._raw
+            header = HttpHeader(key=raw[start:colon].decode('latin-1').strip(),
+                                value=raw[(colon+1):end].decode('latin-1').strip())
+            self._decoded[idx] = header
+        return header
+
+    def _build_names(self):
+        names = {}
+        raw = self._raw
+        for idx, (start, colon, _end) in enumerate(self._offsets):
+            name = bytes(raw[start:colon].strip().lower())
+            names.setdefault(name, []).append(idx)
+        self._names = names
+        return names
+
+    def _lookup(self, key):
+        names = self._names
+        if names is None:
+            names = self._build_names()
+        try:
+            name = key.encode('latin-1').lower()
+        except UnicodeEncodeError:
+            # Decoded header names are always latin-1
+            return []
+        return names.get(name, [])
+
+    def get_all(self, key):
+        """Return the values of all headers named ``key`` as a list.
+
+        ``key`` is case-insensitive.
+        """
+        return [self._decode(idx).value for idx in self._lookup(key)]
+
+    def get_first(self, key):
+        """Return the value of the first header named ``key``, or None.
+
+        ``key`` is case-insensitive.
+        """
+        indices = self._lookup(key)
+        if indices:
+            return self._decode(indices[0]).value
+        return None
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._decode(i) for i in range(len(self))[idx]]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('Header index out of range')
+        return self._decode(idx)
+
+
+class LazyHttpRequest(HttpRequest):
+    """An ``HttpRequest`` that decodes its headers on demand.
+
+    The ``headers`` member is an ``HttpHeaderView`` instead of a list, so
+    that headers never read by the request handlers are never decoded. Note
+    that headers are decoded as latin-1 here, as specified by the RFC.
+
+    Pass this class as ``request_class`` to ``HttpConnectionCB`` to use it.
+    """
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self.headers = HttpHeaderView()
+
+    def _parse_header(self, header_line):
+        self.headers.append_line(header_line)
+
+    def get_header(self, key):
+        if isinstance(self.headers, HttpHeaderView):
+            return self.headers.get_all(key)
+        return super().get_header(key)
+
+    def get_first_header(self, key):
+        if isinstance(self.headers, HttpHeaderView):
+            return self.headers.get_first(key)
+        return super().get_first_header(key)
+
+
 class HttpResponse(HttpMessage):
     """An HTTP response.
 
     You should use ``HttpRequest.respond(...)`` to start a response, instead
     of invoking the constructor of this class directly.
+
+    ``bytes_written`` and ``bytes_sent_file`` count the bytes sent with the
+    ``send*`` methods, and with ``send_file``, respectively. ``head_size``
+    is the size of the status line and headers among them.
     """
 
     def __init__(self, code, conn):
@@ -333,6 +763,9 @@ class HttpResponse(HttpMessage):
         self.protocol = 'HTTP'
         self.version = (1, 1)
         self.headers = [HttpHeader('Server', 'Pyx ' + __version__)]
+        self.bytes_written = 0
+        self.bytes_sent_file = 0
+        self.head_size = 0
 
     def write(self):
         """Construct the response header.
@@ -363,9 +796,52 @@ class HttpResponse(HttpMessage):
 
         if hasattr(self, 'request'):
             self.request.responded = True
-        self.connection.writer.write(str(self).encode())
+        data = str(self).encode()
+        self.head_size = len(data)
+        self.bytes_written += len(data)
+        self.connection.writer.write(data)
         yield from self.connection.writer.drain()
 
+    @asyncio.coroutine
+    def send_preencoded(self, header_block):
+        """Send the response header, with some of the HTTP headers already
+        encoded.
+
+        ``header_block`` should be a bytes object containing header lines,
+        terminated by an empty line. It's sent after the status line and
+        the headers in ``self.headers``.
+        """
+
+        if hasattr(self, 'request'):
+            self.request.responded = True
+        data = self._encode_head(header_block)
+        self.head_size = len(data)
+        self.bytes_written += len(data)
+        self.connection.writer.write(data)
+        yield from self.connection.writer.drain()
+
+    @asyncio.coroutine
+    def send_serialized(self, data):
+        """Send a complete response, which is already serialized.
+
+        ``data`` should be a bytes-like object containing the status line, the
+        headers and the body. It should agree with ``self.code``.
+        """
+
+        if hasattr(self, 'request'):
+            self.request.responded = True
+        self.head_size = data.find(b'\r\n\r\n') + 4
+        self.bytes_written += len(data)
+        self.connection.writer.write(data)
+        yield from self.connection.writer.drain()
+
+    def _encode_head(self, header_block=None):
+        if header_block is None:
+            return str(self).encode()
+        slist = self.write()
+        slist[-1] = ''
+        return b''.join(['\r\n'.join(slist).encode(), header_block])
+
     @asyncio.coroutine
     def send_body(self, data):
         """Send the response body.
@@ -375,9 +851,23 @@ class HttpResponse(HttpMessage):
 
         if type(data) is str:
             data = data.encode()
+        self.bytes_written += len(data)
         self.connection.writer.write(data)
         yield from self.connection.writer.drain()
 
+    @asyncio.coroutine
+    def send_file(self, in_f, offset, nbytes):
+        """Send ``nbytes`` bytes from ``in_f`` as (part of) the response body,
+        starting at ``offset``, with ``pyx.io.sendfile_async``.
+
+        ``in_f`` can be any object with a ``fileno()`` method, or a file
+        descriptor. The throttle of the connection is respected.
+        """
+        sock = self.connection.writer.get_extra_info('socket')
+        yield from sendfile_async(sock, in_f, offset, nbytes,
+                                  throttle=self.connection.throttle)
+        self.bytes_sent_file += nbytes
+
 
 def default_error_page(code):
     """The default template for error pages."""
@@ -402,19 +892,36 @@ class DefaultHttpErrorHandler:
 
     ``error_page`` should be a function which accepts the HTTP status code
     and returns the content of the error page. See ``default_error_page``.
+    It's called only once for every status code and HTTP version, and the
+    whole response is encoded and cached, so error pages should not change
+    over time.
     """
 
+    MAX_CACHED = 64
+
     def __init__(self, error_page=default_error_page):
         self._gen_error_page = error_page
+        self._responses = {}
+
+    def _encode_response(self, resp):
+        content = self._gen_error_page(resp.code)
+        if type(content) is str:
+            content = content.encode()
+        header_block = \
+            'Content-Length: {}\r\nContent-Type: text/html\r\n\r\n'.format(
+                len(content)).encode()
+        return resp._encode_head(header_block) + content
 
     @asyncio.coroutine
     def __call__(self, err, req):
         resp = req.respond(err.code)
-        content = self._gen_error_page(err.code)
-        resp.headers.append(HttpHeader('Content-Length', len(content)))
-        resp.headers.append(HttpHeader('Content-Type', 'text/html'))
-        yield from resp.send()
-        yield from resp.send_body(content)
+        key = (err.code, resp.version)
+        data = self._responses.get(key)
+        if data is None:
+            data = self._encode_response(resp)
+            if len(self._responses) < self.MAX_CACHED:
+                self._responses[key] = data
+        yield from resp.send_serialized(data)
 
 
 _default_error_handler = DefaultHttpErrorHandler()
@@ -430,11 +937,17 @@ class HttpRequestCB:
     path traversal.
     The optional argument ``error_handler`` should be a callable that can
     handle ``HttpError``. See ``DefaultHttpErrorHandler``.
+    ``metrics`` is an optional ``pyx.metrics.ServerMetrics`` object, to
+    record the latency and response size of every request.
+
+    The traversed resource is stored as ``req.resource``.
     """
 
-    def __init__(self, root_factory, error_handler=_default_error_handler):
+    def __init__(self, root_factory, error_handler=_default_error_handler,
+                 metrics=None):
         self._root_factory = root_factory
         self._error_handler = error_handler
+        self._metrics = metrics
 
     @asyncio.coroutine
     def _generate_500_and_stop(self, req, trace_msg):
@@ -448,22 +961,44 @@ class HttpRequestCB:
         req.connection.close()
 
     @asyncio.coroutine
-    def _handle_http_error(self, req, exc, trace_msg):
+    def _handle_http_error(self, req, exc):
+        # HttpErrors are expected, no traceback is formatted unless the
+        # error handler itself fails.
         if not req.responded:
             try:
                 yield from self._error_handler(exc, req)
             except:
-                logger('HttpRequestCB').debug(trace_msg)
+                logger('HttpRequestCB').debug(traceback.format_exc())
                 req.connection.close()
 
     @asyncio.coroutine
     def __call__(self, req):
+        if self._metrics is None and req.timings is None:
+            yield from self._handle(req)
+            return
+
+        start = time.monotonic()
+        try:
+            yield from self._handle(req)
+        finally:
+            if self._metrics is not None:
+                self._metrics.request_finished(req, time.monotonic() - start)
+            if req.timings is not None:
+                req.connection.hooks.response_finished(req)
+
+    @asyncio.coroutine
+    def _handle(self, req):
         try:
             res = self._root_factory(req)
             res = res.traverse(req.path)
+            req.resource = res
+            if req.timings is not None:
+                req.connection.hooks.resource_resolved(req)
         except HttpError as e:
-            yield from self._handle_http_error(req, e, traceback.format_exc())
+            yield from self._handle_http_error(req, e)
             return
+        except asyncio.CancelledError:
+            raise
         except:
             yield from self._generate_500_and_stop(req, traceback.format_exc())
             return
@@ -471,7 +1006,9 @@ class HttpRequestCB:
         try:
             yield from res._do_handle_request(req)
         except HttpError as e:
-            yield from self._handle_http_error(req, e, traceback.format_exc())
+            yield from self._handle_http_error(req, e)
+        except asyncio.CancelledError:
+            raise
         except:
             yield from self._generate_500_and_stop(req, traceback.format_exc())
 
@@ -481,22 +1018,124 @@ class HttpConnectionCB:
 
     ``req_cb`` should be a callable for handling HTTP requests. See
     ``HttpRequestCB``.
+    The optional argument ``limits`` should be an ``HttpRequestLimits``
+    object, and ``error_handler`` is used to answer requests violating these
+    limits. See ``DefaultHttpErrorHandler``.
+    ``request_class`` is the class used to parse requests, it should be
+    ``HttpRequest`` or one of its subclasses, such as ``LazyHttpRequest``.
+    ``scheduler`` is an optional ``pyx.io.BandwidthScheduler``, giving every
+    connection a throttle for file transfers.
+    ``metrics`` is an optional ``pyx.metrics.ServerMetrics`` object, to
+    record connections, keep-alive reuse and parse errors.
+    ``hooks`` is an optional ``pyx.hooks.RequestHooks`` object, to be
+    notified of the progress of every request.
+    ``monitor`` is an optional ``pyx.monitor.LoopLagMonitor``. While it
+    reports the event loop as overloaded, new requests are answered with
+    *503 Service Unavailable*, and their connections are closed.
+
+    If ``cancel_on_disconnect`` is True, a request being handled is
+    cancelled as soon as the connection is lost, e.g. reset by the peer or
+    failing on write, so that no more work is wasted on it. A peer only
+    half-closing the connection still gets its response. Handlers should
+    release their resources in ``finally`` clauses or ``with`` statements.
     """
-    def __init__(self, req_cb):
+    def __init__(self, req_cb, limits=None,
+                 error_handler=_default_error_handler,
+                 request_class=HttpRequest, scheduler=None, metrics=None,
+                 hooks=None, monitor=None, cancel_on_disconnect=True):
         self._request_cb = req_cb
+        self._limits = limits or default_request_limits
+        self._error_handler = error_handler
+        self._request_class = request_class
+        self._scheduler = scheduler
+        self._metrics = metrics
+        self._hooks = hooks
+        self._monitor = monitor
+        self._cancel_on_disconnect = cancel_on_disconnect
+
+    @asyncio.coroutine
+    def _reject_request(self, conn, exc):
+        logger('HttpConnectionCB').debug('Rejecting request: %s', exc)
+        # The request head is not fully parsed, respond with a bare request
+        req = HttpRequest(conn)
+        if conn.hooks is not None:
+            req.timings = {'start': time.monotonic()}
+        try:
+            yield from self._error_handler(exc, req)
+        except:
+            logger('HttpConnectionCB').debug(traceback.format_exc())
+        finally:
+            if req.timings is not None:
+                conn.hooks.response_finished(req)
+        conn.close()
 
     @asyncio.coroutine
     def __call__(self, reader, writer):
         conn = HttpConnection(reader, writer)
+        if self._scheduler is not None:
+            conn.throttle = self._scheduler.connection()
+        conn.hooks = self._hooks
+        if self._cancel_on_disconnect:
+            task = _current_task()
+            if task is not None:
+                conn._watch_disconnect(task)
+
+        try:
+            if self._metrics is None:
+                yield from self._serve(conn)
+            else:
+                self._metrics.connection_opened()
+                try:
+                    yield from self._serve(conn)
+                finally:
+                    self._metrics.connection_closed()
+        except asyncio.CancelledError:
+            if not conn.disconnected:
+                raise
+            conn.close()
+
+    @asyncio.coroutine
+    def _serve(self, conn):
+        metrics = self._metrics
+        monitor = self._monitor
+        reused = False
         while not conn.closed:
             try:
-                req = yield from HttpRequest.parse(conn)
+                req = yield from self._request_class.parse(conn, self._limits)
+            except HttpError as e:
+                if metrics is not None:
+                    metrics.parse_error()
+                yield from self._reject_request(conn, e)
+                break
             except Exception as e:
+                # Not an error if the client just closed the connection
+                if metrics is not None and not conn.reader.at_eof():
+                    metrics.parse_error()
                 logger('HttpConnectionCB').debug(traceback.format_exc())
                 conn.close()
                 break
 
-            yield from self._request_cb(req)
+            if req.timings is not None:
+                conn.hooks.request_parsed(req)
+            if monitor is not None and monitor.overloaded:
+                if metrics is not None:
+                    metrics.request_shed()
+                try:
+                    yield from monitor.shed(req)
+                finally:
+                    if req.timings is not None:
+                        conn.hooks.response_finished(req)
+                    conn.close()
+                break
+
+            if metrics is not None:
+                metrics.request_parsed(reused)
+                reused = True
+            conn._handling = True
+            try:
+                yield from self._request_cb(req)
+            finally:
+                conn._handling = False
 
             if req.version < (1, 1):
                 conn.close()
@@ -586,17 +1225,16 @@ def methods(method_list):
     return deco
 
 
-class StaticRootResource(UrlResource):
-    """A resource class for serving static files.
+class PathResource(UrlResource):
+    """Base class for resources handling all the remaining path segments
+    themselves.
 
-    ``local_root`` is the local directory for your static files.
+    The unquoted segments are collected in ``self.path``. ``..`` removes the
+    previous segment, and never goes above this resource.
     """
 
-    INDEX_NAMES = ['index.html', 'index.htm']
-
-    def __init__(self, local_root):
+    def __init__(self):
         super().__init__()
-        self.root = local_root
         self.path = []
 
     def get_child(self, key):
@@ -610,52 +1248,372 @@ class StaticRootResource(UrlResource):
                 self.path.append(s)
         return self
 
+
+default_index_cache = StaticIndexCache()
+
+
+class StaticRootResource(PathResource):
+    """A resource class for serving static files.
+
+    ``local_root`` is the local directory for your static files.
+    ``path_cache`` is an optional ``pyx.cache.StaticPathCache`` object. It
+    should be shared among all ``StaticRootResource`` objects serving the
+    same ``local_root``, so that resolved paths (including missing ones) can
+    be served without probing the file system again.
+    ``root_fd`` is an optional file descriptor of ``local_root``, opened
+    once and shared in the same way. Files are then opened relative to it,
+    without walking the whole path from ``/`` on every request.
+    If ``follow_symlinks`` is False, requests for symbolic links (in the
+    last path component) are rejected with *403 Forbidden*.
+    ``index_cache`` is a ``pyx.cache.StaticIndexCache`` object remembering
+    which of the ``INDEX_NAMES`` each directory contains. The process-wide
+    ``default_index_cache`` is used by default.
+    ``manifest`` is an optional ``pyx.manifest.StaticManifest`` for
+    ``local_root``. When specified, ``local_root`` is considered immutable,
+    and all file metadata comes from the manifest. Files missing from the
+    manifest are not served.
+    ``file_cache`` is an optional ``pyx.cache.StaticFileCache`` object,
+    shared like ``path_cache``. Small files are then kept in memory as
+    complete responses, and served with a single write, as long as the size
+    and modification time of the file are unchanged.
+    If ``writable`` is True, files can be uploaded with PUT requests, and
+    are saved with ``save_request_body``. Otherwise PUT requests are
+    rejected with *405 Method Not Allowed*. Uploads larger than
+    ``max_upload_size`` bytes are rejected with *413 Payload Too Large*,
+    None means no limit.
+    """
+
+    INDEX_NAMES = ['index.html', 'index.htm']
+
+    def __init__(self, local_root, path_cache=None, root_fd=None,
+                 follow_symlinks=True, index_cache=default_index_cache,
+                 manifest=None, file_cache=None, writable=False,
+                 max_upload_size=None):
+        super().__init__()
+        self.root = local_root
+        self._path_cache = path_cache
+        self._cache_key = None
+        self._resolved = None
+        self._root_fd = root_fd
+        self._index_cache = index_cache
+        self._manifest = manifest
+        self._file_cache = file_cache
+        self._writable = writable
+        self._max_upload_size = max_upload_size
+        # O_NONBLOCK keeps special files such as FIFOs from blocking the
+        # event loop in os.open(). It doesn't affect regular files.
+        self._open_flags = os.O_RDONLY | os.O_CLOEXEC | os.O_NONBLOCK
+        self._follow_symlinks = follow_symlinks
+        if not follow_symlinks:
+            self._open_flags |= os.O_NOFOLLOW
+
     def _build_real_path(self):
         return os.path.join(self.root, *self.path)
 
+    def _open(self, rel_path, dir_fd=None):
+        """Open ``rel_path`` and return ``(fd, stat_result)``.
+
+        ``rel_path`` is relative to ``dir_fd`` if specified, or the static
+        root otherwise. ``FileNotFoundError`` is raised if it's neither a
+        regular file nor a directory.
+        """
+        try:
+            if dir_fd is not None:
+                fd = os.open(rel_path, self._open_flags, dir_fd=dir_fd)
+            elif self._root_fd is not None:
+                fd = os.open(rel_path or '.', self._open_flags,
+                             dir_fd=self._root_fd)
+            else:
+                fd = os.open(os.path.join(self.root, rel_path),
+                             self._open_flags)
+        except PermissionError:
+            raise HttpError(403, 'Access to {} denied'.format(repr(rel_path)))
+        except OSError as e:
+            if e.errno == errno.ELOOP:
+                raise HttpError(
+                    403, 'Symlink {} not followed'.format(repr(rel_path)))
+            raise
+
+        try:
+            st = os.fstat(fd)
+        except:
+            os.close(fd)
+            raise
+        if not (stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode)):
+            # Never serve FIFOs, devices or sockets
+            os.close(fd)
+            raise FileNotFoundError(
+                errno.ENOENT, 'Not a regular file or directory', rel_path)
+        return (fd, st)
+
+    def _stat(self, rel_path):
+        """Return the ``os.stat_result`` of ``rel_path``, relative to the
+        static root, or None if it can't be stat'ed."""
+        try:
+            if self._root_fd is not None:
+                return os.stat(rel_path or '.', dir_fd=self._root_fd,
+                               follow_symlinks=self._follow_symlinks)
+            return os.stat(os.path.join(self.root, rel_path),
+                           follow_symlinks=self._follow_symlinks)
+        except OSError:
+            return None
+
+    def _open_index(self, dir_fd, name):
+        try:
+            fd, st = self._open(name, dir_fd=dir_fd)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if stat.S_ISREG(st.st_mode):
+            return (fd, st)
+        os.close(fd)
+        return None
+
+    def _find_index(self, dir_fd, dir_stat, rel_path):
+        cache = self._index_cache
+        if cache is not None:
+            found, name = cache.get(dir_stat)
+            if found:
+                if name is None:
+                    return None
+                opened = self._open_index(dir_fd, name)
+                if opened is not None:
+                    return (os.path.join(rel_path, name),) + opened
+
+        for name in self.INDEX_NAMES:
+            opened = self._open_index(dir_fd, name)
+            if opened is not None:
+                if cache is not None:
+                    cache.put(dir_stat, name)
+                return (os.path.join(rel_path, name),) + opened
+
+        if cache is not None:
+            cache.put(dir_stat, None)
+        return None
+
+    def _resolve_path(self):
+        """Resolve the traversed path, and return ``(outcome, fd, stat)``.
+
+        ``fd`` is an open regular file, or None if the path is not found.
+        """
+        rel_path = self._rel_path()
+
+        logger('StaticRootResource').debug('rel_path = %r', rel_path)
+
+        try:
+            fd, st = self._open(rel_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return ((StaticPathCache.NOT_FOUND, rel_path), None, None)
+
+        if stat.S_ISREG(st.st_mode):
+            return ((StaticPathCache.FILE, rel_path), fd, st)
+
+        try:
+            if stat.S_ISDIR(st.st_mode):
+                index = self._find_index(fd, st, rel_path)
+                if index is not None:
+                    index_path, index_fd, index_st = index
+                    return ((StaticPathCache.INDEX, index_path),
+                            index_fd, index_st)
+        finally:
+            os.close(fd)
+        return ((StaticPathCache.NOT_FOUND, rel_path), None, None)
+
+    def _rel_path(self):
+        """The traversed path relative to the static root, which is also
+        the key in the path cache."""
+        return '/'.join(s for s in self.path if len(s) > 0)
+
+    def _cached_outcome(self):
+        cache = self._path_cache
+        if cache is None:
+            return None
+        if self._cache_key is None:
+            self._cache_key = self._rel_path()
+            self._resolved = cache.get(self._cache_key)
+        return self._resolved
+
+    def _resolve(self):
+        """Resolve the traversed path with the help of the path cache, and
+        return ``(rel_path, fd, stat)`` for the file to be served.
+        """
+        cache = self._path_cache
+
+        if cache is not None:
+            if self._cached_outcome() is not None:
+                kind, rel_path = self._resolved
+                if kind == StaticPathCache.NOT_FOUND:
+                    raise HttpError(404, '{} not found'.format(repr(rel_path)))
+                try:
+                    fd, st = self._open(rel_path)
+                except (FileNotFoundError, NotADirectoryError):
+                    fd = None
+                if fd is not None:
+                    if stat.S_ISREG(st.st_mode):
+                        return (rel_path, fd, st)
+                    os.close(fd)
+                # The cached outcome is stale
+                cache.discard(self._cache_key)
+
+        outcome, fd, st = self._resolve_path()
+        self._resolved = outcome
+        if cache is not None:
+            cache.put(self._cache_key, outcome)
+        if fd is None:
+            raise HttpError(404, '{} not found'.format(repr(outcome[1])))
+        return (outcome[1], fd, st)
+
     @asyncio.coroutine
-    def _serve_file(self, req, path):
-        logger('StaticRootResource').debug('Serving file: %r', path)
-        with AsyncFile(filename=path) as af:
+    def _serve_cached(self, req, rel_path, file_stat=None):
+        """Serve the cached response for ``rel_path``, validated against
+        ``file_stat``, or a fresh stat of the file if it's None. Return False
+        if there's no valid cached response."""
+        if file_stat is None:
+            file_stat = self._stat(rel_path)
+            if file_stat is None:
+                return False
+        data = self._file_cache.get((rel_path, req.version), file_stat)
+        if data is None:
+            return False
+        logger('StaticRootResource').debug('Serving cached file: %r', rel_path)
+        yield from req.respond(200).send_serialized(data)
+        return True
+
+    @asyncio.coroutine
+    def _serve_small_file(self, resp, head, fileobj, size, key,
+                          file_stat=None):
+        body = fileobj.read(size)
+        if len(body) != size:
+            # The file changed under our feet
+            raise HttpError(500, 'Failed to read {} bytes'.format(size))
+        data = b''.join([head, body])
+        self._file_cache.put(key, data, file_stat)
+        yield from resp.send_serialized(data)
+
+    @asyncio.coroutine
+    def _serve_file(self, req, rel_path, fd, st):
+        logger('StaticRootResource').debug('Serving file: %r', rel_path)
+        try:
+            fileobj = os.fdopen(fd, 'rb')
+        except:
+            os.close(fd)
+            raise
+
+        file_size = st.st_size
+        cacheable = self._file_cache is not None and \
+            file_size <= self._file_cache.max_entry_size
+        if cacheable:
+            with fileobj:
+                served = yield from self._serve_cached(req, rel_path, st)
+                if not served:
+                    resp = req.respond(200)
+                    resp.headers.append(HttpHeader('Content-Length', file_size))
+                    mimetype, _encoding = mimetypes.guess_type(rel_path)
+                    if mimetype is not None:
+                        resp.headers.append(HttpHeader('Content-Type', mimetype))
+                    yield from self._serve_small_file(
+                        resp, resp._encode_head(), fileobj, file_size,
+                        (rel_path, req.version), st)
+            return
+
+        with AsyncFile(fileobj=fileobj) as af:
             resp = req.respond(200)
 
-            file_size = af.stat().st_size
             resp.headers.append(HttpHeader('Content-Length', file_size))
-            mimetype, _encoding = mimetypes.guess_type(path)
+            mimetype, _encoding = mimetypes.guess_type(rel_path)
             if mimetype is not None:
                 resp.headers.append(HttpHeader('Content-Type', mimetype))
 
             yield from resp.send()
-            sock = resp.connection.writer.get_extra_info('socket')
-            yield from sendfile_async(sock, af, 0, file_size)
+            yield from resp.send_file(af, 0, file_size)
+
+    @asyncio.coroutine
+    def _serve_manifest_entry(self, req):
+        rel_path = '/'.join(s for s in self.path if len(s) > 0)
+        entry = self._manifest.lookup(rel_path)
+        if entry is None:
+            raise HttpError(404, '{} not found'.format(repr(rel_path)))
+
+        entry = self._manifest.select_variant(
+            entry, req.get_first_header('Accept-Encoding'))
+        if req.get_first_header('If-None-Match') == entry.etag:
+            resp = req.respond(304)
+            resp.headers.append(HttpHeader('ETag', entry.etag))
+            yield from resp.send()
+            return
+
+        cacheable = self._file_cache is not None and \
+            entry.size <= self._file_cache.max_entry_size
+        if cacheable:
+            served = yield from self._serve_cached(req, entry.rel_path)
+            if served:
+                return
+
+        logger('StaticRootResource').debug('Serving file: %r', entry.rel_path)
+        try:
+            fd, st = self._open(entry.rel_path)
+        except (FileNotFoundError, NotADirectoryError):
+            raise HttpError(404, '{} not found'.format(repr(entry.rel_path)))
+
+        if cacheable:
+            with os.fdopen(fd, 'rb') as fileobj:
+                resp = req.respond(200)
+                yield from self._serve_small_file(
+                    resp, resp._encode_head(entry.header_block), fileobj,
+                    entry.size, (entry.rel_path, req.version), st)
+            return
+
+        with AsyncFile(fileobj=os.fdopen(fd, 'rb')) as af:
+            resp = req.respond(200)
+            yield from resp.send_preencoded(entry.header_block)
+            yield from resp.send_file(af, 0, entry.size)
 
     @methods(['GET'])
     @asyncio.coroutine
     def handle_request(self, req):
-        path = self._build_real_path()
-
-        logger('StaticRootResource').debug('path = %r', path)
-
-        if os.path.isfile(path):
-            yield from self._serve_file(req, path)
-        elif os.path.isdir(path):
-            glob_pattern = os.path.join(path, '*')
-            real_index = None
-            for f in glob.iglob(glob_pattern):
-                base_name = os.path.basename(f).lower()
-                if base_name in self.INDEX_NAMES and os.path.isfile(f):
-                    if os.access(f, os.R_OK):
-                        real_index = f
-                        break
-                    else:
-                        raise HttpError(
-                            403, 'Access to {} denied'.format(repr(path)))
-            if real_index is not None:
-                yield from self._serve_file(req, real_index)
-            else:
-                raise HttpError(404, '{} not found'.format(repr(path)))
+        if self._manifest is not None:
+            yield from self._serve_manifest_entry(req)
+            return
+
+        if self._file_cache is not None:
+            outcome = self._cached_outcome()
+            if outcome is not None and outcome[0] != StaticPathCache.NOT_FOUND:
+                served = yield from self._serve_cached(req, outcome[1])
+                if served:
+                    return
+
+        rel_path, fd, st = self._resolve()
+        yield from self._serve_file(req, rel_path, fd, st)
+
+    @handle_request.methods(['PUT'])
+    @asyncio.coroutine
+    def handle_put(self, req):
+        rel_path = self._rel_path()
+        if not self._writable or self._manifest is not None:
+            raise HttpError(405, 'PUT not allowed for {}'.format(
+                                    repr(rel_path)))
+        if len(rel_path) == 0:
+            raise HttpError(409, 'Cannot PUT to the root directory')
+
+        logger('StaticRootResource').debug('Receiving file: %r', rel_path)
+        if self._root_fd is None:
+            created = yield from save_request_body(
+                req, os.path.join(self.root, rel_path),
+                max_size=self._max_upload_size)
+        else:
+            created = yield from save_request_body(
+                req, rel_path, dir_fd=self._root_fd,
+                max_size=self._max_upload_size)
+
+        for c in (self._path_cache, self._file_cache):
+            if c is not None:
+                c.invalidate(rel_path)
+
+        if created:
+            resp = req.respond(201)
+            resp.headers.append(HttpHeader('Content-Length', 0))
         else:
-            raise HttpError(404, '{} not found'.format(repr(path)))
+            resp = req.respond(204)
+        yield from resp.send()
 
 
 @asyncio.coroutine
@@ -690,3 +1648,121 @@ def parse_multipart_formdata(reader, boundary, cb):
         yield from breader.read()
         breader = BoundaryReader(reader, boundary)
         line = yield from breader.readline()
+
+
+_FORM_BLOCK_SIZE = 8192
+
+
+def _decode_form_component(data, encoding):
+    return urllib.parse.unquote_to_bytes(
+        bytes(data).replace(b'+', b' ')).decode(encoding, 'replace')
+
+
+@asyncio.coroutine
+def parse_urlencoded_form(reader, max_fields=1000, max_field_size=65536,
+                          encoding='utf-8'):
+    """Read data from ``reader`` and parse application/x-www-form-urlencoded
+    fields, until EOF is reached.
+
+    The data is parsed block by block, so at most one (encoded) field is
+    buffered at a time. ``HttpError(413)`` is raised if there are more than
+    ``max_fields`` fields, or a field is larger than ``max_field_size``
+    bytes.
+
+    Returns a ``MultiDict``.
+    """
+
+    fields = []
+
+    def add_field(field):
+        if len(field) > max_field_size:
+            raise HttpError(413, 'Form field too large')
+        if not field:
+            return
+        if len(fields) >= max_fields:
+            raise HttpError(413, 'Too many form fields')
+        eq_idx = field.find(b'=')
+        if eq_idx < 0:
+            key, value = field, b''
+        else:
+            key, value = field[0:eq_idx], field[(eq_idx+1):]
+        fields.append((_decode_form_component(key, encoding),
+                       _decode_form_component(value, encoding)))
+
+    pending = bytearray()
+    data = yield from reader.read(_FORM_BLOCK_SIZE)
+    while data:
+        pending.extend(data)
+        amp_idx = pending.rfind(b'&')
+        if amp_idx >= 0:
+            for field in pending[0:amp_idx].split(b'&'):
+                add_field(field)
+            del pending[0:(amp_idx+1)]
+        if len(pending) > max_field_size:
+            raise HttpError(413, 'Form field too large')
+        data = yield from reader.read(_FORM_BLOCK_SIZE)
+    add_field(pending)
+
+    return MultiDict(fields)
+
+
+@asyncio.coroutine
+def save_request_body(req, path, dir_fd=None, max_size=None, fsync=False):
+    """Receive the body of ``req``, and save it to the file ``path``.
+
+    The body is written to a temporary file in the same directory first,
+    which then replaces ``path`` atomically, so that a partially received
+    file is never visible. If ``dir_fd`` is specified, ``path`` is relative
+    to that directory. If ``fsync`` is True, the data is flushed to disk
+    before replacing ``path``. Data is moved with ``pyx.io.splice_to_file``,
+    after sending *100 Continue* if the client expects it.
+
+    Returns True if ``path`` did not exist before.
+
+    May raise ``HttpError`` (400, 409, 411 or 413) according to the
+    Content-Length header, ``max_size``, and the state of ``path``.
+    """
+    length = req._get_content_length(max_size, 'request body')
+
+    try:
+        st = os.stat(path, dir_fd=dir_fd)
+    except FileNotFoundError:
+        created = True
+    else:
+        if stat.S_ISDIR(st.st_mode):
+            raise HttpError(409, '{} is a directory'.format(repr(path)))
+        created = False
+
+    dir_name, base_name = os.path.split(path)
+    tmp_path = os.path.join(
+        dir_name, '.{}.{}.tmp'.format(base_name, uuid.uuid4().hex))
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     os.O_CLOEXEC, 0o666, dir_fd=dir_fd)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HttpError(409, 'No parent directory for {}'.format(repr(path)))
+
+    try:
+        yield from req.send_continue()
+        try:
+            yield from splice_to_file(req.connection.reader,
+                                      req.connection.writer.transport,
+                                      fd, length)
+        except asyncio.IncompleteReadError:
+            raise HttpError(400, 'Incomplete request body')
+        if fsync:
+            os.fsync(fd)
+        os.close(fd)
+        fd = None
+        os.replace(tmp_path, path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except:
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.unlink(tmp_path, dir_fd=dir_fd)
+        except FileNotFoundError:
+            pass
+        raise
+
+    logger('save_request_body').debug('Saved %d bytes to %r', length, path)
+    return created
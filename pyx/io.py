@@ -5,17 +5,22 @@ I/O related routines & classes.
 
 
 import asyncio
+import collections
 import fcntl
 import os
 import ctypes
 import errno
 import io
+import time
+import threading
 from .log import logger
 
 
-__all__ = ['AsyncFile', 'sendfile_async', 'BufferedMixin',
+__all__ = ['AsyncFile', 'sendfile_async', 'splice_to_file', 'warm_up_files',
+           'TokenBucket', 'BandwidthScheduler',
+           'BufferPool', 'default_buffer_pool', 'BufferedMixin',
            'BaseReader', 'BufferedReader', 'LengthReader', 'BoundaryReader',
-           'BaseWriter', 'ChunkedWriter']
+           'BaseWriter', 'ChunkedWriter', 'RecordingWriter']
 
 
 class AsyncFile:
@@ -60,7 +65,6 @@ class AsyncFile:
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
-        self._rbuffer = bytearray()
 
     def __enter__(self):
         return self
@@ -80,13 +84,26 @@ class AsyncFile:
     def tell(self):
         return self._fileobj.tell()
 
-    def _read_ready(self, future, n, total):
+    def _remove_reader_if_cancelled(self, future):
+        if future.cancelled() and not self._fileobj.closed:
+            self._loop.remove_reader(self._fileobj.fileno())
+
+    def _remove_writer_if_cancelled(self, future):
+        if future.cancelled() and not self._fileobj.closed:
+            self._loop.remove_writer(self._fileobj.fileno())
+
+    def _read_ready(self, future, buf, filled, total):
         if future.cancelled():
             self._loop.remove_reader(self._fileobj.fileno())
             return
 
         try:
-            res = self._fileobj.read(n)
+            if total < 0:
+                res = self._fileobj.read(self.DEFAULT_BLOCK_SIZE)
+                n = None if res is None else len(res)
+            else:
+                n = self._fileobj.readinto(memoryview(buf)[
+                    filled:min(filled + self.DEFAULT_BLOCK_SIZE, total)])
         except (BlockingIOError, InterruptedError):
             return
         except Exception as exc:
@@ -94,28 +111,33 @@ class AsyncFile:
             future.set_exception(exc)
             return
 
-        if not res:     # EOF
-            self._loop.remove_reader(self._fileobj.fileno())
-            future.set_result(bytes(self._rbuffer))
+        if n is None:   # Not ready yet
             return
+        if total < 0:
+            buf.extend(res)
+        filled += n
 
-        self._rbuffer.extend(res)
+        if n == 0 or filled == total:
+            self._loop.remove_reader(self._fileobj.fileno())
+            future.set_result(bytes(memoryview(buf)[0:filled]))
+        else:
+            self._loop.add_reader(self._fileobj.fileno(), self._read_ready,
+                                  future, buf, filled, total)
 
-        if total > 0:
-            more_to_go = total - len(self._rbuffer)
-            if more_to_go <= 0:  # enough
-                res, self._rbuffer = self._rbuffer[:n], self._rbuffer[n:]
-                self._loop.remove_reader(self._fileobj.fileno())
-                future.set_result(bytes(res))
-            else:
-                more_to_go = min(self.DEFAULT_BLOCK_SIZE, more_to_go)
-                self._loop.add_reader(self._fileobj.fileno(),
-                                      self._read_ready,
-                                      future, more_to_go, total)
-        else:   # total < 0
-            # This callback is still registered with total < 0,
-            # nothing to do here
-            pass
+    def _wait_for_read(self, future, n):
+        # Data is collected in a pooled buffer if it fits, so that only the
+        # result has to be allocated
+        if n < 0:
+            buf = bytearray()
+        elif n <= default_buffer_pool.buffer_size:
+            lease = default_buffer_pool.lease()
+            buf = lease.buffer
+            future.add_done_callback(lambda _f: lease.release())
+        else:
+            buf = bytearray(n)
+        self._loop.add_reader(self._fileobj.fileno(), self._read_ready,
+                              future, buf, 0, n)
+        future.add_done_callback(self._remove_reader_if_cancelled)
 
     @asyncio.coroutine
     def read(self, n=-1):
@@ -127,24 +149,58 @@ class AsyncFile:
             try:
                 res = self._fileobj.read(n)
             except (BlockingIOError, InterruptedError):
-                if n < 0:
-                    self._rbuffer.clear()
-                    self._loop.add_reader(self._fileobj.fileno(),
-                                          self._read_ready,
-                                          future, self.DEFAULT_BLOCK_SIZE, n)
-                else:
-                    self._rbuffer.clear()
-                    read_block_size = min(self.DEFAULT_BLOCK_SIZE, n)
-                    self._loop.add_reader(self._fileobj.fileno(),
-                                          self._read_ready,
-                                          future, read_block_size, n)
+                res = None
             except Exception as exc:
                 future.set_exception(exc)
+                return future
+
+            if res is None:
+                self._wait_for_read(future, n)
             else:
                 future.set_result(res)
 
         return future
 
+    def _readinto_ready(self, future, buf):
+        if future.cancelled():
+            self._loop.remove_reader(self._fileobj.fileno())
+            return
+
+        try:
+            res = self._fileobj.readinto(buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as exc:
+            self._loop.remove_reader(self._fileobj.fileno())
+            future.set_exception(exc)
+            return
+
+        if res is not None:
+            self._loop.remove_reader(self._fileobj.fileno())
+            future.set_result(res)
+
+    @asyncio.coroutine
+    def readinto(self, buf):
+        """Read into the writable bytes-like object ``buf``, and return the
+        number of bytes read. 0 means EOF."""
+        future = asyncio.Future(loop=self._loop)
+
+        try:
+            res = self._fileobj.readinto(buf)
+        except (BlockingIOError, InterruptedError):
+            res = None
+        except Exception as exc:
+            future.set_exception(exc)
+            return future
+
+        if res is None:
+            self._loop.add_reader(self._fileobj.fileno(),
+                                  self._readinto_ready, future, buf)
+            future.add_done_callback(self._remove_reader_if_cancelled)
+        else:
+            future.set_result(res)
+        return future
+
     def _write_ready(self, future, data, written):
         if future.cancelled():
             self._loop.remove_writer(self._fileobj.fileno())
@@ -181,6 +237,7 @@ class AsyncFile:
                 self._loop.add_writer(self._fileobj.fileno(),
                                       self._write_ready,
                                       future, data, 0)
+                future.add_done_callback(self._remove_writer_if_cancelled)
             except Exception as exc:
                 future.set_exception(exc)
             else:
@@ -197,98 +254,511 @@ class AsyncFile:
         self._fileobj.close()
 
 
+class BufferLease:
+    """A buffer borrowed from a ``BufferPool``.
+
+    ``buffer`` is a ``bytearray`` of ``BufferPool.buffer_size`` bytes. Call
+    ``release()`` to give it back, or use the lease in a ``with`` statement.
+    The buffer must not be used after that.
+    """
+
+    __slots__ = ['_pool', 'buffer']
+
+    def __init__(self, pool, buffer):
+        self._pool = pool
+        self.buffer = buffer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        if self.buffer is not None:
+            self._pool._release(self.buffer)
+            self.buffer = None
+
+
+class BufferPool:
+    """A pool of reusable fixed-size buffers, for use with the ``readinto``
+    methods of ``AsyncFile`` and the readers. ``AsyncFile.read`` and
+    ``BoundaryReader.read`` also collect data in pooled buffers.
+
+    Every buffer is ``buffer_size`` bytes long, and at most ``max_free``
+    returned buffers are kept for reuse. The pool can be shared among
+    threads.
+
+    ``in_use`` is the number of buffers currently leased, ``high_water`` is
+    the maximum of ``in_use`` so far, and ``allocated`` counts all buffers
+    ever allocated by the pool.
+    """
+
+    def __init__(self, buffer_size=65536, max_free=64):
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        # A deque keeps its storage when emptied, unlike a list
+        self._free = collections.deque()
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.high_water = 0
+        self.allocated = 0
+
+    def lease(self):
+        """Borrow a buffer. Returns a ``BufferLease``."""
+        with self._lock:
+            buf = self._free.pop() if self._free else None
+            self.in_use += 1
+            if self.in_use > self.high_water:
+                self.high_water = self.in_use
+            if buf is None:
+                self.allocated += 1
+        if buf is None:
+            buf = bytearray(self.buffer_size)
+        return BufferLease(self, buf)
+
+    def _release(self, buf):
+        with self._lock:
+            self.in_use -= 1
+            if len(self._free) < self.max_free:
+                self._free.append(buf)
+
+    def __len__(self):
+        """The number of buffers available for reuse."""
+        return len(self._free)
+
+
+default_buffer_pool = BufferPool()
+
+
+@asyncio.coroutine
+def _readinto(reader, buf):
+    if hasattr(reader, 'readinto'):
+        return (yield from reader.readinto(buf))
+    data = yield from reader.read(len(buf))
+    buf[0:len(data)] = data
+    return len(data)
+
+
+SENDFILE_READAHEAD = 1048576
+
+
+def _fadvise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        # Not supported for this kind of file, don't retry
+        logger('sendfile_async').debug('posix_fadvise failed: %s', e)
+        return False
+    return True
+
+
 @asyncio.coroutine
-def sendfile_async(out_f, in_f, offset, nbytes, loop=None):
+def sendfile_async(out_f, in_f, offset, nbytes, loop=None, readahead=None,
+                   throttle=None):
     """The async version of ``os.sendfile(...)``.
 
     ``out_f`` and ``in_f`` can be any object with a ``fileno()`` method, but
     they must all be set to async mode beforehand.
+
+    For transfers larger than ``readahead`` bytes (``SENDFILE_READAHEAD`` by
+    default), the kernel is told that ``in_f`` will be read sequentially,
+    and asked to read the next ``readahead`` bytes into the page cache
+    while the current ones are being sent, so that ``os.sendfile(...)``
+    rarely has to block on disk. Set ``readahead`` to 0 to disable the hints.
+
+    ``throttle`` is an optional per-connection throttle, obtained from
+    ``BandwidthScheduler.connection()``, to limit the sending rate.
     """
     loop = loop or asyncio.get_event_loop()
+    if readahead is None:
+        readahead = SENDFILE_READAHEAD
 
     total_size = offset + nbytes
     cur_offset = offset
+
+    if 0 < readahead < nbytes and hasattr(os, 'posix_fadvise'):
+        in_fd = _get_fileno(in_f)
+        if _fadvise(in_fd, offset, nbytes, os.POSIX_FADV_SEQUENTIAL):
+            ahead = min(offset + 2 * readahead, total_size)
+            _fadvise(in_fd, offset, ahead - offset, os.POSIX_FADV_WILLNEED)
+        else:
+            ahead = total_size
+    else:
+        ahead = total_size
+
     while cur_offset < total_size:
+        if throttle is None:
+            granted = total_size - cur_offset
+        else:
+            granted = yield from throttle.acquire(total_size - cur_offset,
+                                                  nbytes)
         copied = yield from _sendfile_async(out_f, in_f,
                                             cur_offset,
-                                            total_size - cur_offset,
+                                            granted,
                                             loop)
+        if throttle is not None and copied < granted:
+            throttle.refund(granted - copied)
         cur_offset += copied
+        if ahead < total_size and ahead - cur_offset < readahead:
+            # Keep at least readahead bytes ahead of the current offset
+            start = max(ahead, cur_offset)
+            ahead = min(cur_offset + 2 * readahead, total_size)
+            if start < ahead:
+                _fadvise(in_fd, start, ahead - start, os.POSIX_FADV_WILLNEED)
+
+
+SPLICE_PIPE_SIZE = 65536
+COPY_BLOCK_SIZE = 65536
 
 
-def _sendfile_cb(future, out_f, in_f, offset, nbytes, loop):
-    if future.cancelled():
-        loop.remove_writer(out_f)
+@asyncio.coroutine
+def splice_to_file(reader, transport, out_f, nbytes, loop=None):
+    """Move ``nbytes`` bytes from a stream into the file ``out_f``.
+
+    ``reader`` should be an ``asyncio.StreamReader``, or implementing the
+    same interface, and ``transport`` is the transport feeding it, such as
+    ``StreamWriter.transport``. ``out_f`` can be any object with a
+    ``fileno()`` method.
+
+    After taking the data already buffered in ``reader``, the rest is moved
+    from the socket to ``out_f`` with ``os.splice(...)`` through a pipe,
+    never entering user space. Reading of ``transport`` is paused in the
+    meantime. If ``os.splice`` is not available, ``reader`` is not an
+    ``asyncio.StreamReader``, or ``transport`` is not a plain socket
+    transport, the data is copied in blocks through ``reader`` instead.
+
+    Raises ``asyncio.IncompleteReadError`` if the stream ends early.
+    """
+    loop = loop or asyncio.get_event_loop()
+    out_fd = _get_fileno(out_f)
+
+    sock = None
+    if hasattr(os, 'splice') and transport is not None and \
+            transport.get_extra_info('sslcontext') is None:
+        sock = transport.get_extra_info('socket')
+    # Other readers, such as BufferedReader, may hold data of their own
+    if sock is None or not isinstance(reader, asyncio.StreamReader):
+        yield from _copy_to_fd(reader, out_fd, nbytes)
+        return
+
+    # No event loop iteration happens between taking the buffered data and
+    # pausing the transport, so nothing can slip into the buffer
+    n = min(len(reader._buffer), nbytes)
+    if n > 0:
+        data = yield from reader.readexactly(n)
+        _write_all(out_fd, data)
+        nbytes -= n
+    if nbytes == 0:
         return
+    if reader.at_eof():
+        raise asyncio.IncompleteReadError(b'', nbytes)
 
+    # The event loop refuses to watch fds owned by transports, use a copy
+    sock_fd = os.dup(sock.fileno())
+    transport.pause_reading()
     try:
-        res = os.sendfile(out_f, in_f, offset, nbytes)
-    except (BlockingIOError, InterruptedError):
-        pass
-    except Exception as exc:
-        loop.remove_writer(out_f)
-        future.set_exception(exc)
-    else:
-        loop.remove_writer(out_f)
-        future.set_result(res)
+        yield from _splice_from_socket(sock_fd, out_fd, nbytes, loop)
+    finally:
+        transport.resume_reading()
+        os.close(sock_fd)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
 
 
 @asyncio.coroutine
-def _sendfile_async(out_f, in_f, offset, nbytes, loop):
-    def _get_fileno(f):
-        if hasattr(f, 'fileno'):
-            f = f.fileno()
-        elif not isinstance(f, int):
-            raise TypeError('Expected {}, but got {}'.format(int, type(f)))
-        return f
+def _copy_to_fd(reader, out_fd, nbytes):
+    # asyncio.StreamReader has no readinto(), the data read can be written
+    # directly instead of being copied into a pooled buffer
+    while nbytes > 0:
+        data = yield from reader.read(min(COPY_BLOCK_SIZE, nbytes))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', nbytes)
+        _write_all(out_fd, data)
+        nbytes -= len(data)
 
-    out_f = _get_fileno(out_f)
-    in_f = _get_fileno(in_f)
+
+@asyncio.coroutine
+def _wait_readable(fd, loop):
     future = asyncio.Future(loop=loop)
 
+    def _ready():
+        if not future.done():
+            future.set_result(None)
+
+    loop.add_reader(fd, _ready)
     try:
-        res = os.sendfile(out_f, in_f, offset, nbytes)
-    except (BlockingIOError, InterruptedError):
-        loop.add_writer(out_f, _sendfile_cb,
-                        future, out_f, in_f, offset, nbytes, loop)
-    except Exception as exc:
-        future.set_exception(exc)
-    else:
-        future.set_result(res)
+        yield from future
+    finally:
+        loop.remove_reader(fd)
+
 
-    return future
+@asyncio.coroutine
+def _wait_writable(fd, loop):
+    future = asyncio.Future(loop=loop)
+
+    def _ready():
+        if not future.done():
+            future.set_result(None)
+
+    # The event loop refuses to watch fds owned by transports, use a copy.
+    # It's closed even if the wait is cancelled, e.g. when the peer is gone
+    watched_fd = os.dup(fd)
+    loop.add_writer(watched_fd, _ready)
+    try:
+        yield from future
+    finally:
+        loop.remove_writer(watched_fd)
+        os.close(watched_fd)
+
+
+@asyncio.coroutine
+def _splice_from_socket(sock_fd, out_fd, nbytes, loop):
+    pipe_r, pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        while nbytes > 0:
+            try:
+                n = os.splice(sock_fd, pipe_w, min(nbytes, SPLICE_PIPE_SIZE),
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except (BlockingIOError, InterruptedError):
+                yield from _wait_readable(sock_fd, loop)
+                continue
+            if n == 0:
+                raise asyncio.IncompleteReadError(b'', nbytes)
+            nbytes -= n
+            while n > 0:
+                n -= os.splice(pipe_r, out_fd, n, flags=os.SPLICE_F_MOVE)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+def warm_up_files(file_names, pre_read=False, pool=None):
+    """Load files into the page cache.
+
+    This function blocks, and is meant to be called in an executor, e.g.
+    ``loop.run_in_executor(None, warm_up_files, file_names)``. If
+    ``pre_read`` is False, and ``os.posix_fadvise`` is available, the
+    kernel is asked to read the files in the background. Otherwise the
+    files are read through, with a buffer from ``pool``
+    (``default_buffer_pool`` by default).
+
+    Returns the total size of the files warmed up.
+    """
+    use_fadvise = not pre_read and hasattr(os, 'posix_fadvise')
+    if use_fadvise:
+        return _warm_up_files(file_names, True, None)
+    with (pool or default_buffer_pool).lease() as lease:
+        return _warm_up_files(file_names, False, lease.buffer)
+
+
+def _warm_up_files(file_names, use_fadvise, buf):
+    total = 0
+    for fname in file_names:
+        try:
+            with open(fname, 'rb', buffering=0) as f:
+                if use_fadvise:
+                    size = os.fstat(f.fileno()).st_size
+                    os.posix_fadvise(f.fileno(), 0, size,
+                                     os.POSIX_FADV_WILLNEED)
+                else:
+                    size = 0
+                    n = f.readinto(buf)
+                    while n:
+                        size += n
+                        n = f.readinto(buf)
+        except OSError as e:
+            logger('warm_up_files').warning('Failed to warm up %r: %s',
+                                            fname, e)
+            continue
+        total += size
+    return total
+
+
+class TokenBucket:
+    """A token bucket for rate limiting.
+
+    Tokens are added at ``rate`` per second, up to ``burst`` tokens (``rate``
+    by default). Consuming more tokens than available puts the bucket in
+    debt, which has to be paid back before any more tokens are available.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._clock = clock
+        self._tokens = self.burst
+        self._last_time = clock()
+
+    @property
+    def tokens(self):
+        """Tokens currently available. Negative if in debt."""
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+        return self._tokens
+
+    def consume(self, n):
+        """Take ``n`` tokens, and return the seconds to wait before they
+        are actually available."""
+        tokens = self.tokens - n
+        self._tokens = tokens
+        return 0 if tokens >= 0 else -tokens / self.rate
+
+    def refund(self, n):
+        """Give back ``n`` unused tokens."""
+        self._tokens = min(self.burst, self._tokens + n)
+
+
+class _ConnectionThrottle:
+    def __init__(self, scheduler, bucket):
+        self._scheduler = scheduler
+        self._bucket = bucket
+
+    @asyncio.coroutine
+    def acquire(self, n, total):
+        return (yield from self._scheduler._acquire(self._bucket, n, total))
+
+    def refund(self, n):
+        self._scheduler._refund(self._bucket, n)
+
+
+class BandwidthScheduler:
+    """Share the outgoing bandwidth among connections.
+
+    ``rate`` limits the total sending rate, and ``conn_rate`` limits the
+    sending rate of every single connection, both in bytes per second, and
+    both can be None for no limit. Transfers are paced in chunks of at most
+    ``chunk_size`` bytes.
+
+    Transfers no larger than ``small_size`` bytes are never delayed, but
+    still use up the total bandwidth, so that bulk transfers get what's left
+    over by small responses.
+
+    Call ``connection()`` to get a throttle for every new connection, and
+    pass it to ``sendfile_async``.
+    """
+
+    def __init__(self, rate=None, conn_rate=None, small_size=65536,
+                 chunk_size=65536, clock=time.monotonic):
+        self._bucket = None if rate is None else \
+            TokenBucket(rate, max(rate, chunk_size), clock)
+        self.conn_rate = conn_rate
+        self.small_size = small_size
+        self.chunk_size = chunk_size
+        self._clock = clock
+
+    def connection(self):
+        """Create a throttle for a new connection."""
+        if self.conn_rate is None:
+            bucket = None
+        else:
+            bucket = TokenBucket(self.conn_rate,
+                                 max(self.conn_rate, self.chunk_size),
+                                 self._clock)
+        return _ConnectionThrottle(self, bucket)
+
+    @asyncio.coroutine
+    def _acquire(self, conn_bucket, n, total):
+        if total <= self.small_size:
+            if self._bucket is not None:
+                self._bucket.consume(n)
+            return n
+
+        n = min(n, self.chunk_size)
+        delay = 0
+        for bucket in (conn_bucket, self._bucket):
+            if bucket is not None:
+                delay = max(delay, bucket.consume(n))
+        if delay > 0:
+            yield from asyncio.sleep(delay)
+        return n
+
+    def _refund(self, conn_bucket, n):
+        for bucket in (conn_bucket, self._bucket):
+            if bucket is not None:
+                bucket.refund(n)
+
+
+def _get_fileno(f):
+    if hasattr(f, 'fileno'):
+        f = f.fileno()
+    elif not isinstance(f, int):
+        raise TypeError('Expected {}, but got {}'.format(int, type(f)))
+    return f
+
+
+@asyncio.coroutine
+def _sendfile_async(out_f, in_f, offset, nbytes, loop):
+    out_f = _get_fileno(out_f)
+    in_f = _get_fileno(in_f)
+    while True:
+        try:
+            return os.sendfile(out_f, in_f, offset, nbytes)
+        except (BlockingIOError, InterruptedError):
+            yield from _wait_writable(out_f, loop)
 
 
 class BufferedMixin:
     """A mixin providing buffered semantics."""
 
     def init_buffer(self):
-        self._buffer = []
+        # Chunks are popped from the right. Unlike a list, a deque doesn't
+        # reallocate its storage every time it's emptied and refilled.
+        self._buffer = collections.deque()
 
     def flush_buffer(self):
         self._buffer.reverse()
         buffered = b''.join(self._buffer)
-        self._buffer = []
+        self._buffer.clear()
         return buffered
 
     def read_from_buffer(self, n):
+        if not self._buffer:
+            return (b'', n)
         if n < 0:
-            self._buffer.reverse()
-            buffered = b''.join(self._buffer)
-            self._buffer = []
-            return (buffered, n)
-        else:
-            buffered = bytearray()
-            while n > 0 and len(self._buffer) > 0:
-                data = self._buffer.pop()
-                if len(data) > n:
-                    self._buffer.append(data[n:])
-                    buffered.extend(data[0:n])
-                    n = 0
-                else:
-                    buffered.extend(data)
-                    n -= len(data)
-            return (bytes(buffered), n)
+            return (self.flush_buffer(), n)
+
+        data = self._buffer.pop()
+        if len(data) >= n:
+            if len(data) > n:
+                # Don't copy the remaining data again and again, when
+                # reading a large chunk in small pieces
+                self._buffer.append(memoryview(data)[n:])
+                data = data[0:n]
+            return (bytes(data), 0)
+
+        # Collect the chunks first, so that data is copied only once
+        chunks = [data]
+        n -= len(data)
+        while n > 0 and len(self._buffer) > 0:
+            data = self._buffer.pop()
+            if len(data) > n:
+                self._buffer.append(memoryview(data)[n:])
+                chunks.append(data[0:n])
+                n = 0
+            else:
+                chunks.append(data)
+                n -= len(data)
+        return (b''.join(chunks), n)
+
+    def read_from_buffer_into(self, buf):
+        """Copy buffered data into ``buf``, and return the number of bytes
+        copied."""
+        copied = 0
+        while copied < len(buf) and len(self._buffer) > 0:
+            data = self._buffer.pop()
+            n = min(len(data), len(buf) - copied)
+            buf[copied:(copied+n)] = data[0:n]
+            if n < len(data):
+                self._buffer.append(memoryview(data)[n:])
+            copied += n
+        return copied
 
     def put(self, data):
         self._buffer.append(data)
@@ -318,6 +788,8 @@ class BufferedReader(BaseReader, BufferedMixin):
         nl_idx = buffered.find(b'\n')
         if nl_idx < 0:
             more_data = yield from self._reader.readline()
+            if not buffered:
+                return more_data
             return b''.join([buffered, more_data])
         else:
             self.put(buffered[(nl_idx+1):])
@@ -328,6 +800,8 @@ class BufferedReader(BaseReader, BufferedMixin):
         buffered, more = self.read_from_buffer(n)
         if more != 0:
             more_data = yield from self._reader.read(more)
+            if not buffered:
+                return more_data
             return b''.join([buffered, more_data])
         else:
             return buffered
@@ -340,10 +814,21 @@ class BufferedReader(BaseReader, BufferedMixin):
         buffered, more = self.read_from_buffer(n)
         if more != 0:
             more_data = yield from self._reader.readexactly(more)
+            if not buffered:
+                return more_data
             return b''.join([buffered, more_data])
         else:
             return buffered
 
+    @asyncio.coroutine
+    def readinto(self, buf):
+        if len(buf) == 0:
+            return 0
+        copied = self.read_from_buffer_into(buf)
+        if copied > 0:
+            return copied
+        return (yield from _readinto(self._reader, buf))
+
 
 class LengthReader(BaseReader):
     """A reader that reads at most ``length`` bytes."""
@@ -403,9 +888,24 @@ class LengthReader(BaseReader):
         else:
             raise asyncio.IncompleteReadError(b'', n)
 
+    @asyncio.coroutine
+    def readinto(self, buf):
+        if self._remaining > 0:
+            if len(buf) > self._remaining:
+                buf = memoryview(buf)[0:(self._remaining)]
+            n = yield from _readinto(self._reader, buf)
+            self._remaining -= n
+            return n
+        else:
+            return 0
+
 
 class BoundaryReader(BaseReader):
-    """A reader that reads until the string ``boundary`` is encountered."""
+    """A reader that reads until the string ``boundary`` is encountered.
+
+    Data is collected in a buffer from ``default_buffer_pool`` when the
+    requested size allows.
+    """
 
     DEFAULT_BLOCK_SIZE = 8192
 
@@ -428,24 +928,23 @@ class BoundaryReader(BaseReader):
             # two lines
             line = yield from self._reader.readline()
             line2 = yield from self._reader.readline()
-            buf = b''.join([line, line2])
+            buf = bytearray().join([line, line2])
 
             bd_idx = buf.find(self._boundary)
             if bd_idx >= 0:
                 self._hit_boundary = True
-                _has_trailer, buf = \
-                    yield from self._strip_boundary(buf, bd_idx)
-                return buf
+                end = yield from self._strip_boundary(buf, bd_idx, len(buf))
+                return bytes(buf[0:end])
 
             self._reader.put(line2)
             return line
 
     @asyncio.coroutine
-    def _read_next_block(self, n, buf):
+    def _read_next_block(self, n, buffered):
         if n < 0:
             to_read = self.DEFAULT_BLOCK_SIZE
         else:
-            remaining = max(n - len(buf), 0)
+            remaining = max(n - buffered, 0)
             if remaining < len(self._boundary) * 2:
                 to_read = remaining + len(self._boundary)
             else:
@@ -454,71 +953,110 @@ class BoundaryReader(BaseReader):
         return (yield from self._reader.read(to_read))
 
     @asyncio.coroutine
-    def _strip_boundary(self, buf, bd_idx):
-        # len(buf) is ALWAYS larger than 4, since len(self._boundary) > 4
-        if bd_idx + len(self._boundary) > len(buf) - 4:
+    def _strip_boundary(self, buf, bd_idx, filled):
+        """Put back the data after the boundary found at ``bd_idx``, in the
+        first ``filled`` bytes of ``buf``, and return the length of the data
+        before the boundary."""
+        # filled is ALWAYS larger than 4, since len(self._boundary) > 4
+        if bd_idx + len(self._boundary) > filled - 4:
             # Also read the trailing '--\r\n', if any
             padding = yield from self._reader.read(4)
-            buf.extend(padding)
+            buf[filled:(filled+len(padding))] = padding
+            filled += len(padding)
 
         # See if these 4 bytes are '--\r\n' (the trailing sequence
         # of the ending boundary). If so, discard them together with
         # the boundary string
         search_idx = bd_idx + len(self._boundary)
-        if buf[search_idx:(search_idx+4)] == b'--\r\n':
-            self._reader.put(buf[(search_idx+4):])
-            has_trailer = True
-        elif buf[search_idx:(search_idx+2)] == b'\r\n':
-            self._reader.put(buf[(search_idx+2):])
-            has_trailer = False
-        else:
-            self._reader.put(buf[search_idx:])
-            has_trailer = False
+        if buf[search_idx:min(search_idx+4, filled)] == b'--\r\n':
+            search_idx += 4
+        elif buf[search_idx:min(search_idx+2, filled)] == b'\r\n':
+            search_idx += 2
+        if search_idx < filled:
+            self._reader.put(bytes(buf[search_idx:filled]))
+
+        return bd_idx
 
-        return (has_trailer, buf[0:bd_idx])
+    def _fits_in_pool(self, n):
+        # At most (n + len(boundary) * 3 + 4) bytes are buffered in _read()
+        return 0 <= n <= default_buffer_pool.buffer_size - \
+            len(self._boundary) * 3 - 4
 
     @asyncio.coroutine
     def read(self, n=-1):
         if self._hit_boundary:
             return b''
 
-        else:
-            buf = bytearray()
-            # 1. Read at least (len(boundary) + 1) bytes
-            data = yield from self._read_next_block(n, buf)
-            # 2. If we hit EOF or have enough bytes already, stop.
-            #    Here we want at least (n + len(boundary)) bytes in the buffer
-            #    so that we can ensure the first n bytes are not part of the
-            #    boundary
-            while len(data) > 0 and \
-                    (n < 0 or len(buf) < n + len(self._boundary)):
-                buf.extend(data)
-                # Only search the data we just read
-                search_idx = \
-                    max(len(buf) - len(data) - (len(self._boundary) - 1), 0)
-                bd_idx = buf.find(self._boundary, search_idx)
-
-                # 3. See if we have found the boundary string in buf.
-                #    If the boundary is found, no more data shall be read.
-                #    Else repeat step 1.
-                if bd_idx >= 0:
-                    self._hit_boundary = True
-                    _has_trailer, buf = \
-                        yield from self._strip_boundary(buf, bd_idx)
-                    break
-
-                data = yield from self._read_next_block(n, buf)
-
-            if not self._hit_boundary:
-                # We stopped before seeing the boundary string, and `data`
-                # contains the last bunch of bytes we read
-                buf.extend(data)
-
-            if n >= 0 and len(buf) > n:
-                self._reader.put(buf[n:])
-                buf = buf[0:n]
-
+        if self._fits_in_pool(n):
+            with default_buffer_pool.lease() as lease:
+                filled = yield from self._read(n, lease.buffer)
+                return bytes(memoryview(lease.buffer)[0:filled])
+        buf = bytearray()
+        filled = yield from self._read(n, buf)
+        if filled == len(buf):
             return bytes(buf)
+        return bytes(memoryview(buf)[0:filled])
+
+    @asyncio.coroutine
+    def readinto(self, buf):
+        if self._hit_boundary or len(buf) == 0:
+            return 0
+
+        if self._fits_in_pool(len(buf)):
+            with default_buffer_pool.lease() as lease:
+                filled = yield from self._read(len(buf), lease.buffer)
+                buf[0:filled] = memoryview(lease.buffer)[0:filled]
+                return filled
+        data = bytearray()
+        filled = yield from self._read(len(buf), data)
+        buf[0:filled] = memoryview(data)[0:filled]
+        return filled
+
+    @asyncio.coroutine
+    def _read(self, n, buf):
+        """Read up to ``n`` bytes before the boundary into ``buf``, and
+        return the number of bytes read.
+
+        ``buf`` is either a pooled buffer large enough for everything, or an
+        empty bytearray growing as needed. Only the first ``filled`` bytes
+        of it are valid.
+        """
+        filled = 0
+        # 1. Read at least (len(boundary) + 1) bytes
+        data = yield from self._read_next_block(n, filled)
+        # 2. If we hit EOF or have enough bytes already, stop.
+        #    Here we want at least (n + len(boundary)) bytes in the buffer
+        #    so that we can ensure the first n bytes are not part of the
+        #    boundary
+        while len(data) > 0 and \
+                (n < 0 or filled < n + len(self._boundary)):
+            buf[filled:(filled+len(data))] = data
+            filled += len(data)
+            # Only search the data we just read
+            search_idx = \
+                max(filled - len(data) - (len(self._boundary) - 1), 0)
+            bd_idx = buf.find(self._boundary, search_idx, filled)
+
+            # 3. See if we have found the boundary string in buf.
+            #    If the boundary is found, no more data shall be read.
+            #    Else repeat step 1.
+            if bd_idx >= 0:
+                self._hit_boundary = True
+                filled = yield from self._strip_boundary(buf, bd_idx, filled)
+                break
+
+            data = yield from self._read_next_block(n, filled)
+
+        if not self._hit_boundary:
+            # We stopped before seeing the boundary string, and `data`
+            # contains the last bunch of bytes we read
+            buf[filled:(filled+len(data))] = data
+            filled += len(data)
+
+        if n >= 0 and filled > n:
+            self._reader.put(buf[n:filled])
+            filled = n
+        return filled
 
     @asyncio.coroutine
     def readexactly(self, n):
@@ -554,3 +1092,32 @@ class ChunkedWriter(BaseWriter):
         hex_len = (hex(len(data))[2:]).encode()
         chunk = b''.join([hex_len, b'\r\n', data, b'\r\n'])
         return self._writer.write(chunk)
+
+
+class RecordingWriter(BaseWriter):
+    """Pass data through to the underlying writer, keeping a copy of it.
+
+    The recorded data is available as ``data``. If more than ``max_size``
+    bytes are written, recording stops and ``data`` becomes None.
+    """
+
+    def __init__(self, writer, max_size=None):
+        super().__init__(writer)
+        self.max_size = max_size
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        if self._chunks is not None:
+            self._size += len(data)
+            if self.max_size is not None and self._size > self.max_size:
+                self._chunks = None
+            else:
+                self._chunks.append(bytes(data))
+        return self._writer.write(data)
+
+    @property
+    def data(self):
+        if self._chunks is None:
+            return None
+        return b''.join(self._chunks)
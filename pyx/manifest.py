@@ -0,0 +1,194 @@
+"""
+Manifests for immutable static file trees.
+
+A manifest records everything needed to serve the files in a static tree,
+so that nothing has to be derived from the file system per request. It can
+be built by scanning the tree when the server starts, or generated
+beforehand with the ``pyx-manifest`` command::
+
+    pyx-manifest -r /some/where -o /some/where.manifest
+    pyx -r /some/where --manifest /some/where.manifest
+
+"""
+
+
+import os
+import json
+import mimetypes
+import email.utils
+from .log import logger
+
+
+__all__ = ['ManifestEntry', 'StaticManifest']
+
+
+class ManifestEntry:
+    """Metadata for one file in a ``StaticManifest``.
+
+    ``variants`` maps content codings (such as ``'gzip'``) to entries for
+    precompressed versions of this file. ``header_block`` contains the
+    pre-encoded response headers for the file, terminated by an empty line.
+    """
+
+    __slots__ = ['rel_path', 'size', 'mtime', 'etag', 'mimetype',
+                 'encoding', 'variants', 'header_block']
+
+    def __init__(self, rel_path, size, mtime, mimetype, encoding=None):
+        self.rel_path = rel_path
+        self.size = size
+        self.mtime = mtime
+        self.etag = '"{:x}-{:x}"'.format(int(mtime), size)
+        self.mimetype = mimetype
+        self.encoding = encoding
+        self.variants = {}
+        self.header_block = None
+
+    def encode_headers(self, vary=False):
+        """Build ``self.header_block``."""
+        hlist = ['Content-Length: {}'.format(self.size)]
+        if self.mimetype is not None:
+            hlist.append('Content-Type: {}'.format(self.mimetype))
+        if self.encoding is not None:
+            hlist.append('Content-Encoding: {}'.format(self.encoding))
+        if vary:
+            hlist.append('Vary: Accept-Encoding')
+        hlist.append('ETag: {}'.format(self.etag))
+        hlist.append('Last-Modified: {}'.format(
+                        email.utils.formatdate(self.mtime, usegmt=True)))
+        hlist.append('\r\n')
+        self.header_block = '\r\n'.join(hlist).encode('latin-1')
+
+
+class StaticManifest:
+    """An in-memory index of an immutable static tree.
+
+    ``files`` maps paths relative to the static root to tuples of
+    ``(size, mtime, mimetype)``, and ``indexes`` maps relative directory
+    paths to the relative paths of their index files. Use ``scan`` or
+    ``load`` to create a manifest, instead of invoking the constructor
+    directly.
+
+    Files with the suffixes in ``VARIANT_SUFFIXES`` are also registered as
+    precompressed variants of the files they were compressed from.
+    """
+
+    VERSION = 1
+    VARIANT_SUFFIXES = [('br', '.br'), ('gzip', '.gz')]
+
+    def __init__(self, files, indexes):
+        self._entries = {}
+        for rel_path, (size, mtime, mimetype) in files.items():
+            self._entries[rel_path] = ManifestEntry(rel_path, size, mtime,
+                                                    mimetype)
+
+        for entry in self._entries.values():
+            for encoding, suffix in self.VARIANT_SUFFIXES:
+                variant = self._entries.get(entry.rel_path + suffix)
+                if variant is not None:
+                    entry.variants[encoding] = ManifestEntry(
+                        variant.rel_path, variant.size, variant.mtime,
+                        entry.mimetype, encoding)
+
+        for entry in self._entries.values():
+            vary = len(entry.variants) > 0
+            entry.encode_headers(vary)
+            for variant in entry.variants.values():
+                variant.encode_headers(vary)
+
+        self._indexes = dict(indexes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        """Iterate over the ``ManifestEntry`` objects for all files."""
+        return iter(self._entries.values())
+
+    @property
+    def indexes(self):
+        """A dict mapping relative directory paths to their index files."""
+        return self._indexes
+
+    def lookup(self, rel_path):
+        """Return the ``ManifestEntry`` for ``rel_path``, or None.
+
+        If ``rel_path`` is a directory, the entry for its index file is
+        returned.
+        """
+        entry = self._entries.get(rel_path)
+        if entry is None:
+            index_path = self._indexes.get(rel_path)
+            if index_path is not None:
+                entry = self._entries.get(index_path)
+        return entry
+
+    def select_variant(self, entry, accept_encoding):
+        """Choose the variant of ``entry`` to serve, according to the value
+        of an ``Accept-Encoding`` header, which may be None.
+
+        Returns ``entry`` itself if no acceptable variant exists.
+        """
+        if not entry.variants or not accept_encoding:
+            return entry
+
+        codings = set()
+        for item in accept_encoding.split(','):
+            coding, _sep, params = item.partition(';')
+            if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            codings.add(coding.strip().lower())
+        for encoding, _suffix in self.VARIANT_SUFFIXES:
+            if encoding in codings and encoding in entry.variants:
+                return entry.variants[encoding]
+        return entry
+
+    @classmethod
+    def scan(cls, root, index_names=('index.html', 'index.htm')):
+        """Scan the directory ``root`` and build a manifest for it."""
+        files = {}
+        indexes = {}
+        for dir_path, _dir_names, file_names in os.walk(root):
+            rel_dir = os.path.relpath(dir_path, root)
+            if rel_dir == '.':
+                rel_dir = ''
+            for name in file_names:
+                rel_path = os.path.join(rel_dir, name)
+                try:
+                    st = os.stat(os.path.join(dir_path, name))
+                except OSError as e:
+                    logger('StaticManifest').warning(
+                        'Skipping %r: %s', rel_path, e)
+                    continue
+                mimetype, _encoding = mimetypes.guess_type(name)
+                files[rel_path] = (st.st_size, st.st_mtime, mimetype)
+            for name in index_names:
+                if name in file_names:
+                    indexes[rel_dir] = os.path.join(rel_dir, name)
+                    break
+        return cls(files, indexes)
+
+    def save(self, fname):
+        """Write this manifest to the file ``fname``."""
+        files = {}
+        for rel_path, entry in self._entries.items():
+            files[rel_path] = [entry.size, entry.mtime, entry.mimetype]
+        data = {
+            'version': self.VERSION,
+            'files': files,
+            'indexes': self._indexes,
+        }
+        with open(fname, 'w') as f:
+            json.dump(data, f, separators=(',', ':'), sort_keys=True)
+
+    @classmethod
+    def load(cls, fname):
+        """Load a manifest written by ``save``."""
+        with open(fname) as f:
+            data = json.load(f)
+        if data.get('version') != cls.VERSION:
+            raise ValueError('Unsupported manifest version: {}'.format(
+                                repr(data.get('version'))))
+        files = {}
+        for rel_path, (size, mtime, mimetype) in data['files'].items():
+            files[rel_path] = (size, mtime, mimetype)
+        return cls(files, data['indexes'])
@@ -0,0 +1,333 @@
+"""
+Metrics in the Prometheus text format.
+
+Metrics are recorded once per connection, request or transfer, never per
+byte. A ``ServerMetrics`` object can be passed to ``HttpConnectionCB`` and
+``HttpRequestCB``, and exposed with a ``MetricsResource``::
+
+    from pyx.http import (HttpConnectionCB, HttpRequestCB)
+    from pyx.metrics import (ServerMetrics, MetricsResource)
+
+    metrics = ServerMetrics()
+    metrics.watch_cache('path', path_cache)
+    metrics_res = MetricsResource(metrics.registry)
+
+    req_cb = HttpRequestCB(root_factory, metrics=metrics)
+    conn_cb = HttpConnectionCB(req_cb, metrics=metrics)
+
+"""
+
+
+import asyncio
+import bisect
+import math
+from .http import (HttpHeader, HttpError, UrlResource, methods)
+
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'MetricsRegistry',
+           'MetricsResource', 'ServerMetrics']
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\') \
+                     .replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+
+def _format_labels(label_names, labels, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape_label_value(v))
+             for n, v in zip(label_names, labels)]
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+    return repr(value)
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, help, label_names=(), fn=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._fn = fn
+        self._values = {}
+
+    def collect(self):
+        """Return a dict mapping tuples of label values to values."""
+        if self._fn is not None:
+            values = self._fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return values
+        return self._values
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for labels, value in sorted(self.collect().items()):
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.label_names, labels),
+                _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """A monotonically increasing value.
+
+    ``label_names`` names the labels of the metric. Values for the labels
+    are passed as a tuple to ``inc``. Alternatively, ``fn`` can be specified,
+    which is called when the metric is collected, and should return the
+    current value, or a dict mapping tuples of label values to values.
+    """
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down. See ``Counter`` for the arguments."""
+
+    TYPE = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+
+class Histogram(_Metric):
+    """Counts observations in buckets.
+
+    ``buckets`` is a sorted list of upper bounds. Observations are counted
+    in the first matching bucket only, and the cumulative counts are
+    computed when rendered.
+    """
+
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    def __init__(self, name, help, label_names=(), buckets=None):
+        super().__init__(name, help, label_names)
+        self.buckets = list(buckets or self.DEFAULT_BUCKETS)
+
+    def observe(self, value, labels=()):
+        entry = self._values.get(labels)
+        if entry is None:
+            # [bucket counts..., +Inf count, sum]
+            entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        bounds = [_format_value(float(b)) for b in self.buckets] + ['+Inf']
+        for labels, entry in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(bounds, entry):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.label_names, labels,
+                                   'le="{}"'.format(bound)),
+                    total))
+            label_str = _format_labels(self.label_names, labels)
+            lines.append('{}_sum{} {}'.format(
+                self.name, label_str, _format_value(entry[-1])))
+            lines.append('{}_count{} {}'.format(self.name, label_str, total))
+        return lines
+
+
+class MetricsRegistry:
+    """A collection of metrics, rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add ``metric`` to this registry, and return it."""
+        if any(m.name == metric.name for m in self._metrics):
+            raise ValueError('Duplicate metric: {}'.format(metric.name))
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricsResource(UrlResource):
+    """A resource serving the metrics in ``registry``."""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+
+    def get_child(self, key):
+        raise HttpError(404, '{} not found'.format(repr(key)))
+
+    @methods(['GET'])
+    @asyncio.coroutine
+    def handle_request(self, req):
+        content = self.registry.render().encode()
+        resp = req.respond(200)
+        resp.headers.append(HttpHeader('Content-Length', len(content)))
+        resp.headers.append(HttpHeader('Content-Type', self.CONTENT_TYPE))
+        yield from resp.send()
+        yield from resp.send_body(content)
+
+
+class ServerMetrics:
+    """The standard metrics of a Pyx server.
+
+    Pass this object as ``metrics`` to ``HttpConnectionCB`` and
+    ``HttpRequestCB``. The metrics are registered in ``registry``, or a new
+    ``MetricsRegistry`` if it's None, available as ``self.registry``.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        reg = self.registry.register
+
+        self.request_duration = reg(Histogram(
+            'pyx_request_duration_seconds',
+            'Time spent handling requests, by status code', ['code']))
+        self.connections_active = reg(Gauge(
+            'pyx_connections_active', 'Currently open connections'))
+        self.connections = reg(Counter(
+            'pyx_connections_total', 'Accepted connections'))
+        self.requests_parsed = reg(Counter(
+            'pyx_requests_parsed_total', 'Successfully parsed requests'))
+        self.requests_reused = reg(Counter(
+            'pyx_requests_reused_total',
+            'Requests received on kept-alive connections'))
+        reg(Gauge('pyx_keepalive_reuse_ratio',
+                  'Fraction of requests received on kept-alive connections',
+                  fn=self._reuse_ratio))
+        self.parse_errors = reg(Counter(
+            'pyx_parse_errors_total', 'Malformed or oversized request heads'))
+        self.requests_shed = reg(Counter(
+            'pyx_requests_shed_total',
+            'Requests rejected because the event loop was overloaded'))
+        self.response_bytes = reg(Counter(
+            'pyx_response_bytes_total',
+            'Bytes sent in responses, by method', ['via']))
+
+        self._loop_monitors = []
+        reg(Gauge('pyx_loop_lag_seconds',
+                  'Last measured event loop lag',
+                  fn=lambda: max([m.lag for m in self._loop_monitors],
+                                 default=0.0)))
+
+        self._limiters = []
+        reg(Gauge('pyx_limiter_active',
+                  'Requests holding a slot of a concurrency limiter',
+                  ['limiter'],
+                  fn=lambda: self._collect_limiters('active')))
+        reg(Gauge('pyx_limiter_queue_depth',
+                  'Requests waiting for a slot of a concurrency limiter',
+                  ['limiter'],
+                  fn=lambda: self._collect_limiters('queue_depth')))
+        reg(Counter('pyx_limiter_queued_total',
+                    'Requests that had to wait for a concurrency limiter',
+                    ['limiter'],
+                    fn=lambda: self._collect_limiters('queued')))
+        reg(Counter('pyx_limiter_wait_seconds_total',
+                    'Total time spent waiting for concurrency limiters',
+                    ['limiter'],
+                    fn=lambda: self._collect_limiters('wait_time')))
+        reg(Counter('pyx_limiter_rejected_total',
+                    'Requests rejected by concurrency limiters, by reason',
+                    ['limiter', 'reason'],
+                    fn=self._collect_limiter_rejections))
+
+        self._caches = []
+        reg(Counter('pyx_cache_hits_total', 'Cache hits', ['cache'],
+                    fn=lambda: self._collect_caches('hits')))
+        reg(Counter('pyx_cache_misses_total', 'Cache misses', ['cache'],
+                    fn=lambda: self._collect_caches('misses')))
+
+    def watch_cache(self, name, cache):
+        """Export the ``hits`` and ``misses`` of ``cache``, such as a
+        ``pyx.cache.StaticPathCache``, labeled with ``name``."""
+        self._caches.append((name, cache))
+
+    def watch_loop(self, monitor):
+        """Export the lag measured by ``monitor``, a
+        ``pyx.monitor.LoopLagMonitor``."""
+        self._loop_monitors.append(monitor)
+
+    def watch_limiter(self, limiter):
+        """Export the statistics of ``limiter``, a
+        ``pyx.concurrency.ConcurrencyLimiter``, labeled with its name."""
+        self._limiters.append(limiter)
+
+    def _collect_limiters(self, attr):
+        return {(l.name,): getattr(l, attr) for l in self._limiters}
+
+    def _collect_limiter_rejections(self):
+        return {(l.name, reason): count
+                for l in self._limiters
+                for reason, count in l.rejected.items()}
+
+    def _collect_caches(self, attr):
+        return {(name,): getattr(cache, attr) for name, cache in self._caches}
+
+    def _reuse_ratio(self):
+        parsed = self.requests_parsed.collect().get((), 0)
+        if parsed == 0:
+            return 0.0
+        return self.requests_reused.collect().get((), 0) / parsed
+
+    def connection_opened(self):
+        self.connections.inc()
+        self.connections_active.inc()
+
+    def connection_closed(self):
+        self.connections_active.dec()
+
+    def request_parsed(self, reused):
+        self.requests_parsed.inc()
+        if reused:
+            self.requests_reused.inc()
+
+    def parse_error(self):
+        self.parse_errors.inc()
+
+    def request_shed(self):
+        self.requests_shed.inc()
+
+    def request_finished(self, req, duration):
+        resp = req.response
+        if resp is None:
+            self.request_duration.observe(duration, ('0',))
+            return
+        self.request_duration.observe(duration, (str(resp.code),))
+        if resp.bytes_written:
+            self.response_bytes.inc(resp.bytes_written, ('write',))
+        if resp.bytes_sent_file:
+            self.response_bytes.inc(resp.bytes_sent_file, ('sendfile',))
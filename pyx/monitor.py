@@ -0,0 +1,234 @@
+"""
+Event loop health monitoring.
+
+A ``LoopLagMonitor`` measures how late the event loop runs scheduled
+callbacks. When the lag grows past a threshold, the loop is considered
+overloaded, and ``HttpConnectionCB`` answers new requests with *503 Service
+Unavailable* right away, instead of queueing them behind the backlog::
+
+    from pyx.monitor import LoopLagMonitor
+
+    monitor = LoopLagMonitor(threshold=0.5)
+    monitor.start()
+    conn_cb = HttpConnectionCB(req_cb, monitor=monitor)
+
+For debugging, a ``BlockingWatchdog`` finds the code blocking the event
+loop, by capturing its stack from another thread.
+
+"""
+
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from .log import logger
+from .http import (HttpHeader, HttpRequest, UrlResource)
+
+
+__all__ = ['LoopLagMonitor', 'BlockingWatchdog']
+
+
+class LoopLagMonitor:
+    """Sample the lag of ``loop`` every ``interval`` seconds.
+
+    The last sample is available as ``self.lag``. The loop is marked as
+    ``overloaded`` when the lag reaches ``threshold`` seconds, and is marked
+    healthy again when it drops below ``recover_threshold``, which defaults
+    to half of ``threshold``. If ``threshold`` is None, the lag is only
+    measured.
+
+    Shed requests are answered with ``Retry-After: <retry_after>``.
+    """
+
+    def __init__(self, loop=None, interval=0.1, threshold=None,
+                 recover_threshold=None, retry_after=1):
+        self._loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.threshold = threshold
+        if recover_threshold is None and threshold is not None:
+            recover_threshold = threshold / 2
+        self.recover_threshold = recover_threshold
+        self.retry_after = retry_after
+        self.lag = 0.0
+        self.overloaded = False
+        self._expected = None
+        self._handle = None
+        self._responses = {}
+
+    def start(self):
+        if self._handle is None:
+            self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        self.sample(self._loop.time() - self._expected)
+        self._schedule()
+
+    def sample(self, lag):
+        """Record a lag sample, and update ``self.overloaded``."""
+        self.lag = lag = max(lag, 0.0)
+        if self.threshold is None:
+            return
+        if self.overloaded:
+            if lag < self.recover_threshold:
+                self.overloaded = False
+                logger('LoopLagMonitor').info(
+                    'Event loop recovered, lag %.3fs', lag)
+        elif lag >= self.threshold:
+            self.overloaded = True
+            logger('LoopLagMonitor').warning(
+                'Event loop overloaded, lag %.3fs, shedding requests', lag)
+
+    @asyncio.coroutine
+    def shed(self, req):
+        """Answer ``req`` with *503 Service Unavailable*. The connection
+        should be closed afterwards."""
+        resp = req.respond(503)
+        data = self._responses.get(resp.version)
+        if data is None:
+            resp.headers.append(HttpHeader('Retry-After', self.retry_after))
+            resp.headers.append(HttpHeader('Content-Length', 0))
+            resp.headers.append(HttpHeader('Connection', 'close'))
+            data = str(resp).encode()
+            if len(self._responses) < 8:
+                self._responses[resp.version] = data
+        yield from resp.send_serialized(data)
+
+
+def _find_request(frame):
+    """Return the innermost ``(resource, request)`` pair found in the local
+    variables of ``frame`` and its callers."""
+    resource = req = None
+    while frame is not None and (resource is None or req is None):
+        local_vars = frame.f_locals
+        if resource is None and \
+                isinstance(local_vars.get('self'), UrlResource):
+            resource = local_vars['self']
+        if req is None:
+            for v in local_vars.values():
+                if isinstance(v, HttpRequest):
+                    req = v
+                    break
+        frame = frame.f_back
+    return resource, req
+
+
+class BlockingWatchdog:
+    """Detect callbacks blocking ``loop`` for more than ``threshold``
+    seconds.
+
+    A heartbeat runs in the loop every ``interval`` seconds (a quarter of
+    ``threshold`` by default), and a watchdog thread checks it. When the
+    heartbeat stops, the stack of the loop thread is captured with
+    ``sys._current_frames()``, and the stall is attributed to the request
+    path and ``UrlResource`` class found in the stack. See ``report``.
+
+    This is meant for debugging, since capturing stacks is expensive.
+    """
+
+    def __init__(self, loop=None, threshold=0.1, interval=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.threshold = threshold
+        self.interval = interval or threshold / 4
+        self._last_tick = None
+        self._loop_thread = None
+        self._handle = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._stall = None
+        self._offenders = {}
+
+    def start(self):
+        """Start the watchdog. Should be called in the loop thread."""
+        self._loop_thread = threading.get_ident()
+        self._tick()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='pyx-blocking-watchdog',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _tick(self):
+        self._last_tick = time.monotonic()
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.check(time.monotonic())
+
+    def check(self, now):
+        """Check the heartbeat at time ``now``. Called periodically from the
+        watchdog thread."""
+        last_tick = self._last_tick
+        if self._stall is not None and self._stall[0] != last_tick:
+            # The loop is running again
+            stall_tick, key, stack = self._stall
+            self._stall = None
+            self._record(key, max(last_tick - stall_tick - self.interval, 0),
+                         stack)
+
+        if self._stall is None and \
+                now - last_tick >= self.threshold + self.interval:
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                return
+            resource, req = _find_request(frame)
+            key = (type(resource).__name__ if resource is not None else '-',
+                   getattr(req, 'path', '-'))
+            stack = ''.join(traceback.format_stack(frame))
+            del frame
+            self._stall = (last_tick, key, stack)
+            logger('BlockingWatchdog').warning(
+                'Event loop blocked for %.3fs in %s (%s):\n%s',
+                now - last_tick - self.interval, key[0], key[1], stack)
+
+    def _record(self, key, duration, stack):
+        with self._lock:
+            entry = self._offenders.get(key)
+            if entry is None:
+                self._offenders[key] = [1, duration, duration, stack]
+            else:
+                entry[0] += 1
+                entry[1] += duration
+                if duration >= entry[2]:
+                    entry[2] = duration
+                    entry[3] = stack
+
+    def report(self, limit=10):
+        """Return the top ``limit`` offenders, sorted by total blocking time.
+
+        Every item is a tuple ``(resource_class_name, path, count,
+        total_time, max_time, stack)``, where ``stack`` is captured during
+        the longest stall.
+        """
+        with self._lock:
+            items = [k + tuple(v) for k, v in self._offenders.items()]
+        items.sort(key=lambda i: i[3], reverse=True)
+        return items[0:limit]
+
+    def format_report(self, limit=10):
+        lines = ['Top event loop blockers:']
+        for name, path, count, total, max_time, _stack in self.report(limit):
+            lines.append('  {:.3f}s total, {} stalls, max {:.3f}s: '
+                         '{} ({})'.format(total, count, max_time, name, path))
+        return '\n'.join(lines)
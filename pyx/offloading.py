@@ -0,0 +1,233 @@
+"""
+Offloading CPU-heavy request handlers to executors.
+
+A handler decorated with ``offload`` runs in an executor, such as a
+``concurrent.futures.ProcessPoolExecutor``, and its output is streamed back
+to the client while it's being generated::
+
+    import concurrent.futures
+    from pyx.http import (UrlResource, methods)
+    from pyx.offloading import offload
+
+    pool = concurrent.futures.ProcessPoolExecutor()
+
+    class ReportResource(UrlResource):
+        @methods(['GET'])
+        @offload(pool, content_type='text/csv')
+        def handle_request(req):
+            for row in expensive_report(req.args.get('year')):
+                yield ','.join(row) + '\\r\\n'
+
+The decorated function receives an ``OffloadedRequest`` instead of the
+resource and the ``pyx.http.HttpRequest``, since those can't be sent to
+other processes, and it may be a generator producing bytes or strings. It
+must be defined at import time, so that worker processes can find it.
+
+The output is sent through a pipe, read by the event loop no faster than
+the client receives it. A worker producing data too fast simply blocks
+on the pipe.
+
+"""
+
+
+import asyncio
+import functools
+import importlib
+import multiprocessing.connection
+import os
+import struct
+import traceback
+import urllib.parse
+from .log import logger
+from .io import (ChunkedWriter, _write_all)
+from .http import (HttpHeader, HttpError, HttpMessage, MultiDict)
+
+
+__all__ = ['OffloadedRequest', 'offload']
+
+
+# kind, payload size
+_FRAME = struct.Struct('>cI')
+_DATA = b'D'
+_ERROR = b'E'
+_EXCEPTION = b'X'
+_FINISH = b'F'
+
+# The max size of data frames
+_MAX_FRAME_SIZE = 65536
+
+# Offloaded functions, by '<module>:<qualname>'
+_producers = {}
+
+
+class _OffloadedException(Exception):
+    """An exception raised by an offloaded function, with its formatted
+    traceback as the message."""
+
+
+class OffloadedRequest(HttpMessage):
+    """A copy of the request line and headers of an ``HttpRequest``, which
+    can be sent to other processes."""
+
+    def __init__(self, req):
+        super().__init__(None)
+        self.method = req.method
+        self.path = req.path
+        self.query = req.query
+        self.version = req.version
+        self.headers = list(req.headers)
+
+    @property
+    def args(self):
+        """The query arguments, as a ``pyx.http.MultiDict``."""
+        if self.query is None:
+            return MultiDict()
+        return MultiDict(urllib.parse.parse_qsl(self.query,
+                                                keep_blank_values=True))
+
+
+def _write_frame(fd, kind, data=b''):
+    _write_all(fd, _FRAME.pack(kind, len(data)) + data)
+
+
+def _run_producer(key, req, out):
+    """Run in the executor, send the output of producer ``key`` to ``out``,
+    a ``multiprocessing.connection.Connection``."""
+    fd = out.fileno()
+    try:
+        try:
+            module_name, _sep, _qualname = key.partition(':')
+            importlib.import_module(module_name)
+            result = _producers[key](req)
+            if isinstance(result, (bytes, str)):
+                result = [result]
+            for data in result or ():
+                if isinstance(data, str):
+                    data = data.encode()
+                for i in range(0, len(data), _MAX_FRAME_SIZE):
+                    _write_frame(fd, _DATA, data[i:(i+_MAX_FRAME_SIZE)])
+        except BrokenPipeError:
+            # The request is gone
+            return
+        except HttpError as e:
+            _write_frame(fd, _ERROR,
+                         '{} {}'.format(e.code, e.args[0]).encode())
+        except Exception:
+            _write_frame(fd, _EXCEPTION, traceback.format_exc().encode())
+        else:
+            _write_frame(fd, _FINISH)
+    except BrokenPipeError:
+        pass
+    finally:
+        out.close()
+
+
+@asyncio.coroutine
+def _read_frame(reader):
+    kind, size = _FRAME.unpack((yield from reader.readexactly(_FRAME.size)))
+    if size > 0:
+        data = yield from reader.readexactly(size)
+    else:
+        data = b''
+    if kind == _ERROR:
+        code, _sep, msg = data.decode().partition(' ')
+        raise HttpError(int(code), msg)
+    if kind == _EXCEPTION:
+        raise _OffloadedException(data.decode())
+    return (kind, data)
+
+
+@asyncio.coroutine
+def _serve_offloaded(req, key, executor, content_type):
+    loop = asyncio.get_event_loop()
+    r, w = os.pipe()
+    out = multiprocessing.connection.Connection(w, readable=False)
+    reader = asyncio.StreamReader(loop=loop)
+    try:
+        transport, _protocol = yield from loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader, loop=loop),
+            open(r, 'rb', buffering=0))
+    except:
+        os.close(r)
+        out.close()
+        raise
+
+    def _done(future):
+        # Only closed when the producer is done, since a thread producer
+        # shares the fd
+        out.close()
+        if future.cancelled():
+            reader.set_exception(asyncio.CancelledError())
+        elif future.exception() is not None:
+            reader.set_exception(future.exception())
+
+    future = loop.run_in_executor(executor, _run_producer,
+                                  key, OffloadedRequest(req), out)
+    future.add_done_callback(_done)
+
+    try:
+        # Errors raised before any output are reported with their status
+        kind, data = yield from _read_frame(reader)
+
+        resp = req.respond(200)
+        resp.headers.append(HttpHeader('Content-Type', content_type))
+        chunked = req.version >= (1, 1)
+        if chunked:
+            resp.headers.append(HttpHeader('Transfer-Encoding', 'chunked'))
+        else:
+            resp.headers.append(HttpHeader('Connection', 'close'))
+        yield from resp.send()
+
+        conn = req.connection
+        writer = conn.writer
+        if chunked:
+            conn.writer = ChunkedWriter(writer)
+        try:
+            while kind == _DATA:
+                yield from resp.send_body(data)
+                try:
+                    kind, data = yield from _read_frame(reader)
+                except HttpError as e:
+                    # Too late to change the status, abort the response
+                    logger('offload').debug('%s failed: %r', key, e)
+                    conn.close()
+                    raise
+                except _OffloadedException:
+                    # Logged with the remote traceback by the 500 path
+                    conn.close()
+                    raise
+            if chunked:
+                # The last chunk
+                yield from resp.send_body(b'')
+        finally:
+            conn.writer = writer
+        if not chunked:
+            conn.close()
+    finally:
+        # The producer gets a broken pipe if it's still running
+        transport.close()
+
+
+def offload(executor=None, content_type='application/octet-stream'):
+    """A decorator to run a request handler in ``executor``, and stream its
+    output as the response body, with status *200 OK* and ``Content-Type:
+    <content_type>``.
+
+    ``executor`` should be a ``concurrent.futures.Executor``, or None to use
+    the default executor of the event loop. ``HttpError`` raised before any
+    output is produced is reported normally, and other exceptions result in
+    *500 Internal Error*, with the traceback from the executor logged. Once
+    some output is sent, errors can only abort the connection.
+    """
+
+    def deco(func):
+        key = '{}:{}'.format(func.__module__, func.__qualname__)
+        _producers[key] = func
+
+        @functools.wraps(func)
+        @asyncio.coroutine
+        def _offloaded_handler(self, req):
+            yield from _serve_offloaded(req, key, executor, content_type)
+        return _offloaded_handler
+
+    return deco
@@ -0,0 +1,241 @@
+"""
+Caching complete responses of dynamic resources.
+
+A handler decorated with ``cache_response`` is only run when no fresh
+response is cached. Its output is recorded while being sent, and replayed
+with a single write for subsequent requests::
+
+    from pyx.http import (UrlResource, methods)
+    from pyx.response_cache import (ResponseCache, cache_response)
+
+    page_cache = ResponseCache(ttl=60, stale_ttl=300,
+                               vary=['Accept-Encoding'])
+
+    class PageResource(UrlResource):
+        @methods(['GET', 'HEAD'])
+        @cache_response(page_cache)
+        @asyncio.coroutine
+        def handle_request(self, req):
+            ...
+
+Only GET and HEAD requests are cached, and only responses with a status in
+``ResponseCache.codes``, without ``Set-Cookie`` or ``Cache-Control:
+no-store`` / ``private`` headers, and not sent with ``send_file``.
+
+"""
+
+
+import asyncio
+import collections
+import functools
+import time
+import traceback
+from .log import logger
+from .io import RecordingWriter
+from .http import (HttpConnection, HttpRequest)
+
+
+__all__ = ['ResponseCache', 'cache_response']
+
+
+_CachedResponse = collections.namedtuple('_CachedResponse',
+                                         ['code', 'data', 'expires'])
+
+
+class ResponseCache:
+    """A memory-bounded LRU cache for serialized responses.
+
+    Keys are built by ``make_key`` from the method, path, query and HTTP
+    version of a request, plus the values of the request headers named in
+    ``vary``. Responses larger than ``max_entry_size`` bytes are not
+    cached, and the total size is kept under ``max_size``.
+
+    Entries are fresh for ``ttl`` seconds. For ``stale_ttl`` more seconds,
+    a stale entry is still served, while the response is regenerated in
+    the background.
+    """
+
+    codes = frozenset([200, 203, 204, 301, 404, 410])
+
+    def __init__(self, max_size=16777216, max_entry_size=1048576, ttl=60.0,
+                 stale_ttl=0.0, vary=(), clock=time.monotonic):
+        self._entries = collections.OrderedDict()
+        self._revalidating = {}
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.vary = tuple(vary)
+        self._clock = clock
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def make_key(self, req):
+        return ((req.method, req.path, req.query, req.version) +
+                tuple(req.get_first_header(h) for h in self.vary))
+
+    def get(self, key):
+        """Return ``(code, data, stale)`` for ``key``, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        now = self._clock()
+        if entry.expires <= now:
+            if entry.expires + self.stale_ttl <= now:
+                self.discard(key)
+                self.misses += 1
+                return None
+            stale = True
+            self.stale_hits += 1
+        else:
+            stale = False
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return (entry.code, entry.data, stale)
+
+    def put(self, key, code, data):
+        """Cache the serialized response ``data``, with status ``code``."""
+        if len(data) > self.max_entry_size or len(data) > self.max_size:
+            return
+        self.discard(key)
+        self._entries[key] = _CachedResponse(code, data,
+                                             self._clock() + self.ttl)
+        self.size += len(data)
+        while self.size > self.max_size:
+            self.discard(next(iter(self._entries)))
+
+    def discard(self, key):
+        """Remove the cached response for ``key``, if any."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.data)
+
+    def clear(self):
+        """Remove all cached responses, and cancel their revalidation."""
+        self._entries.clear()
+        self.size = 0
+        for task in self._revalidating.values():
+            task.cancel()
+        self._revalidating.clear()
+
+    def _revalidate(self, key, coro):
+        """Run ``coro`` in a task regenerating the response for ``key`` in
+        the background, tracked until it's done."""
+        task = asyncio.ensure_future(coro)
+        self._revalidating[key] = task
+
+        def _done(task):
+            if self._revalidating.get(key) is task:
+                del self._revalidating[key]
+        task.add_done_callback(_done)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _is_cacheable(cache, resp, conn):
+    if resp is None or resp.code not in cache.codes or \
+            resp.bytes_sent_file > 0 or conn.closed:
+        return False
+    for key, value in resp.headers:
+        key = key.lower()
+        if key == 'set-cookie':
+            return False
+        if key == 'cache-control':
+            directives = [d.strip().lower() for d in str(value).split(',')]
+            if 'no-store' in directives or 'private' in directives:
+                return False
+    return True
+
+
+@asyncio.coroutine
+def _record(cache, key, handler, resource, req):
+    conn = req.connection
+    writer = conn.writer
+    recorder = RecordingWriter(writer, cache.max_entry_size)
+    conn.writer = recorder
+    try:
+        yield from handler(resource, req)
+    finally:
+        conn.writer = writer
+
+    data = recorder.data
+    if data is not None and _is_cacheable(cache, req.response, conn):
+        cache.put(key, req.response.code, data)
+
+
+class _NullWriter:
+    """Discard everything written, for regenerating responses in the
+    background."""
+
+    transport = None
+
+    def write(self, data):
+        pass
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def _detached_request(req):
+    reader = asyncio.StreamReader()
+    reader.feed_eof()
+    detached = HttpRequest(HttpConnection(reader, _NullWriter()))
+    detached.limits = req.limits
+    detached.method = req.method
+    detached.path = req.path
+    detached.query = req.query
+    detached.protocol = req.protocol
+    detached.version = req.version
+    detached.headers = list(req.headers)
+    return detached
+
+
+@asyncio.coroutine
+def _revalidate(cache, key, handler, resource, req):
+    try:
+        yield from _record(cache, key, handler, resource, req)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger('cache_response').debug(traceback.format_exc())
+
+
+def cache_response(cache):
+    """A decorator to cache the responses of a request handler in
+    ``cache``, a ``ResponseCache``."""
+
+    def deco(handler):
+        @functools.wraps(handler)
+        @asyncio.coroutine
+        def _caching_handler(self, req):
+            if req.method not in ('GET', 'HEAD'):
+                return (yield from handler(self, req))
+
+            key = cache.make_key(req)
+            cached = cache.get(key)
+            if cached is None:
+                yield from _record(cache, key, handler, self, req)
+                return
+
+            code, data, stale = cached
+            if stale and key not in cache._revalidating:
+                cache._revalidate(key, _revalidate(cache, key, handler, self,
+                                                   _detached_request(req)))
+            resp = req.respond(code)
+            yield from resp.send_serialized(data)
+        return _caching_handler
+
+    return deco
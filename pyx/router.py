@@ -0,0 +1,205 @@
+"""
+A compiled router for ``UrlResource`` trees.
+
+Instead of calling ``get_child`` for every path segment on every request, a
+``Router`` compiles a declarative resource tree into a trie once, and then
+resolves request paths against it::
+
+    from pyx.http import (HttpRequestCB, StaticRootResource)
+    from pyx.router import (Router, mount)
+
+    router = Router({
+        '': IndexResource(),
+        'users': {
+            '': UserListResource(),
+            '{user_id}': UserResource(),
+        },
+        'api/v1/status': StatusResource(),
+        'static': mount(lambda: StaticRootResource('/some/where')),
+    })
+
+    req_cb = HttpRequestCB(lambda req: router)
+
+"""
+
+
+import asyncio
+import collections
+import functools
+import urllib.parse
+from .http import (HttpError, UrlResource, _HandleRequestDict)
+
+
+__all__ = ['Router', 'mount']
+
+
+class _Mount:
+    def __init__(self, factory):
+        self.factory = factory
+
+
+def mount(factory):
+    """Mark a subtree that is served by a traditional ``UrlResource``.
+
+    ``factory`` is called with no arguments for every request routed to the
+    subtree, and the remaining path is traversed by the produced resource
+    with ``UrlResource.traverse``. This is useful for resources keeping
+    per-request state, such as ``StaticRootResource``.
+    """
+    return _Mount(factory)
+
+
+def _build_dispatch(res):
+    handler = res.handle_request
+    if isinstance(handler, _HandleRequestDict):
+        return ({m: functools.partial(h, res) for m, h in handler.items()},
+                None)
+    else:
+        return ({}, handler)
+
+
+class _RouteNode:
+    __slots__ = ['children', 'param_name', 'param_child',
+                 'resource', 'dispatch', 'default_handler', 'mount']
+
+    def __init__(self):
+        self.children = {}
+        self.param_name = None
+        self.param_child = None
+        self.resource = None
+        self.dispatch = None
+        self.default_handler = None
+        self.mount = None
+
+
+class _RouteMatch:
+    """The result of a route lookup, bound with path parameters.
+
+    Works as the traversed resource for ``HttpRequestCB``.
+    """
+
+    def __init__(self, node, params):
+        self.resource = node.resource
+        self.params = params
+        self._dispatch = node.dispatch
+        self._default_handler = node.default_handler
+
+    @asyncio.coroutine
+    def _do_handle_request(self, req):
+        # Matches are cached and shared, every request gets its own dict
+        req.route_params = dict(self.params)
+        handler = self._dispatch.get(req.method, self._default_handler)
+        if handler is None:
+            raise HttpError(501, 'Method {} not implemented for {}'.format(
+                                    req.method, self.resource.__class__))
+        yield from handler(req)
+
+
+class Router(UrlResource):
+    """A root resource that resolves paths with a compiled trie.
+
+    ``tree`` is a dict mapping path segments to resources. The values can
+    be:
+
+        * ``UrlResource`` objects, which are shared among all requests;
+        * dicts, which are subtrees;
+        * ``mount(...)`` objects. See ``mount``.
+
+    A key may contain multiple segments separated by ``/``. The empty key
+    ``''`` maps to the resource for the subtree itself. A segment in the
+    form of ``{name}`` matches any single segment, and the unquoted value is
+    stored in the ``route_params`` dict of the request. Static segments take
+    precedence over parameter segments, and mounts come last.
+
+    Resolutions of paths without parameters or mounts are kept in an LRU
+    cache with at most ``cache_size`` entries. HTTP methods are dispatched
+    with tables computed when the tree is compiled.
+    """
+
+    def __init__(self, tree, cache_size=1024):
+        super().__init__()
+        self._root = _RouteNode()
+        self._compile(self._root, tree)
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def _compile(self, node, tree):
+        for key, value in tree.items():
+            target = node
+            for seg in key.split('/'):
+                if len(seg) == 0:
+                    continue
+                target = self._compile_segment(target, seg)
+
+            if isinstance(value, dict):
+                self._compile(target, value)
+            elif isinstance(value, _Mount):
+                target.mount = value
+            elif isinstance(value, UrlResource):
+                target.resource = value
+                target.dispatch, target.default_handler = \
+                    _build_dispatch(value)
+            else:
+                raise TypeError('Bad route target for {}: {}'.format(
+                                    repr(key), repr(value)))
+
+    def _compile_segment(self, node, seg):
+        if seg.startswith('{') and seg.endswith('}'):
+            name = seg[1:-1]
+            if node.param_child is None:
+                node.param_name = name
+                node.param_child = _RouteNode()
+            elif node.param_name != name:
+                raise ValueError('Conflicting parameter names: {} and {}'.format(
+                                    repr(node.param_name), repr(name)))
+            return node.param_child
+        else:
+            child = node.children.get(seg)
+            if child is None:
+                child = node.children[seg] = _RouteNode()
+            return child
+
+    def _match(self, node, segs, idx, params):
+        if idx == len(segs):
+            if node.resource is not None:
+                return (node, None)
+        else:
+            seg = segs[idx]
+            child = node.children.get(seg)
+            if child is not None:
+                found = self._match(child, segs, idx + 1, params)
+                if found is not None:
+                    return found
+            if node.param_child is not None:
+                params[node.param_name] = urllib.parse.unquote(seg)
+                found = self._match(node.param_child, segs, idx + 1, params)
+                if found is not None:
+                    return found
+                del params[node.param_name]
+
+        if node.mount is not None:
+            return (node, '/'.join(segs[idx:]))
+        return None
+
+    def traverse(self, path):
+        match = self._cache.get(path)
+        if match is not None:
+            self._cache.move_to_end(path)
+            return match
+
+        segs = [s for s in path.split('/') if len(s) > 0]
+        params = {}
+        found = self._match(self._root, segs, 0, params)
+        if found is None:
+            raise HttpError(404, '{} not found'.format(repr(path)))
+
+        node, rest = found
+        if rest is not None:
+            return node.mount.factory().traverse(rest)
+
+        match = _RouteMatch(node, params)
+        if not params:
+            self._cache[path] = match
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return match
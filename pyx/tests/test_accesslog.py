@@ -0,0 +1,64 @@
+import unittest
+import io
+import pyx.http as http
+import pyx.hooks as hooks
+import pyx.monitor as monitor
+import pyx.accesslog as accesslog
+from .test_http import serve_dummy_connection
+
+
+class TestAccessLog(unittest.TestCase):
+    def serve(self, log, data, **kwargs):
+        h = hooks.RequestHooks()
+        h.add(log)
+        serve_dummy_connection(data, peer=('10.0.0.1', 12345), hooks=h,
+                               **kwargs)
+
+    def test_combined(self):
+        stream = io.StringIO()
+        log = accesslog.AccessLog(stream)
+        log.start()
+        self.serve(log, b'GET /?a=1 HTTP/1.1\r\n'
+                        b'User-Agent: test\r\n'
+                        b'\r\n'
+                        b'POST /missing HTTP/1.0\r\n'
+                        b'\r\n')
+        log.close()
+
+        lines = stream.getvalue().split('\n')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[2], '')
+        self.assertTrue(lines[0].startswith('10.0.0.1 - - ['))
+        self.assertRegex(lines[0],
+                         r'\] "GET /\?a=1 HTTP/1\.1" 200 2 "-" "test"$')
+        self.assertTrue('"POST /missing HTTP/1.0" 404 ' in lines[1])
+
+    def test_rejected_and_shed(self):
+        stream = io.StringIO()
+        log = accesslog.AccessLog(stream, fmt='{request} {status}')
+        self.serve(log, b'GET / HTTP/1.1\r\n'
+                        b'X-Long: ' + b'x' * 100 + b'\r\n'
+                        b'\r\n',
+                   limits=http.HttpRequestLimits(max_header_line=64))
+        m = monitor.LoopLagMonitor(threshold=0.5)
+        m.overloaded = True
+        self.serve(log, b'GET /busy HTTP/1.1\r\n'
+                        b'\r\n', monitor=m)
+        log.close()
+        self.assertEqual(stream.getvalue(),
+                         '- 431\n'
+                         'GET /busy HTTP/1.1 503\n')
+
+    def test_custom_format_and_drops(self):
+        stream = io.StringIO()
+        log = accesslog.AccessLog(stream, fmt='{method} {path} {status}',
+                                  capacity=1)
+        with self.assertLogs('pyx.AccessLog', 'WARNING') as cm:
+            self.serve(log, b'GET /a HTTP/1.1\r\n'
+                            b'\r\n'
+                            b'GET /b HTTP/1.1\r\n'
+                            b'\r\n')
+            log.close()
+        self.assertEqual(log.dropped, 1)
+        self.assertTrue('Dropped 1 access log records' in cm.output[0])
+        self.assertEqual(stream.getvalue(), 'GET /a 404\n')
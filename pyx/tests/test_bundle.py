@@ -0,0 +1,105 @@
+import unittest
+import unittest.mock as mock
+import asyncio
+import tempfile
+import os
+import pyx.bundle as bundle
+import pyx.http as http
+from .test_http import create_dummy_request
+from .test_manifest import create_dummy_tree
+
+
+class TestStaticBundle(unittest.TestCase):
+    def test_pack(self):
+        with tempfile.TemporaryDirectory() as root:
+            create_dummy_tree(root)
+            fname = os.path.join(root, 'test.bundle')
+            count = bundle.StaticBundle.pack(root, fname)
+            self.assertEqual(count, 3)
+
+            b = bundle.StaticBundle(fname)
+            try:
+                self.assertEqual(len(b), 3)
+                self.assertTrue(b.lookup('missing') is None)
+
+                entry = b.lookup('')
+                self.assertEqual(entry.rel_path, 'index.html')
+                self.assertEqual(entry.etag, '"53724e00-d"')
+                self.assertEqual(b.read(entry), b'<html></html>')
+                with open(fname, 'rb') as f:
+                    f.seek(b.offset(entry))
+                    self.assertEqual(f.read(entry.size), b'<html></html>')
+
+                entry = b.lookup('dir/app.js')
+                self.assertEqual(b.read(entry), b'var a = 1;')
+                self.assertEqual(b.read(entry.variants['gzip']), b'compressed')
+            finally:
+                b.close()
+
+    def test_bad_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 64)
+            f.flush()
+            with self.assertRaises(ValueError):
+                bundle.StaticBundle(f.name)
+
+
+class TestBundleResource(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        root = self.tmp_dir.name
+        create_dummy_tree(root)
+        fname = os.path.join(root, 'test.bundle')
+        bundle.StaticBundle.pack(root, fname)
+        self.bundle = bundle.StaticBundle(fname, tiny_size=10)
+
+    def tearDown(self):
+        self.bundle.close()
+        self.tmp_dir.cleanup()
+
+    def serve(self, path, headers=[]):
+        req = create_dummy_request()
+        req.method = 'GET'
+        req.version = (1, 1)
+        req.headers = headers
+        res = bundle.BundleResource(self.bundle).traverse(path)
+        asyncio.get_event_loop().run_until_complete(
+            res._do_handle_request(req))
+        return req
+
+    def test_tiny_file(self):
+        req = self.serve('/dir/../dir/app.js')
+        writes = req.connection.writer.write.call_args_list
+        self.assertEqual(len(writes), 1)
+        data = writes[0][0][0]
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(data.endswith(b'\r\n\r\nvar a = 1;'))
+
+        req = self.serve('/dir/app.js',
+                         [http.HttpHeader('Accept-Encoding', 'gzip')])
+        data = req.connection.writer.write.call_args[0][0]
+        self.assertTrue(b'Content-Encoding: gzip\r\n' in data)
+        self.assertTrue(data.endswith(b'\r\n\r\ncompressed'))
+
+    def test_sendfile(self):
+        entry = self.bundle.lookup('index.html')
+
+        @asyncio.coroutine
+        def dummy_sendfile(out_f, in_f, offset, nbytes, **kwargs):
+            pass
+
+        with mock.patch('pyx.http.sendfile_async',
+                        side_effect=dummy_sendfile) as sendfile:
+            self.serve('/')
+        self.assertEqual(sendfile.call_args[0][1:],
+                         (self.bundle, self.bundle.offset(entry), entry.size))
+
+    def test_not_modified_and_not_found(self):
+        entry = self.bundle.lookup('index.html')
+        req = self.serve('/', [http.HttpHeader('If-None-Match', entry.etag)])
+        status_line = req.connection.writer.write.call_args[0][0]
+        self.assertTrue(status_line.startswith(b'HTTP/1.1 304 '))
+
+        with self.assertRaises(http.HttpError) as cm:
+            self.serve('/test.bundle')
+        self.assertEqual(cm.exception.code, 404)
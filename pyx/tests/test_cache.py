@@ -0,0 +1,147 @@
+import unittest
+import pyx.cache as cache
+
+
+class DummyClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStaticPathCache(unittest.TestCase):
+    def test_get_put(self):
+        clock = DummyClock()
+        pc = cache.StaticPathCache(ttl=10, negative_ttl=1, clock=clock)
+
+        self.assertTrue(pc.get('/a') is None)
+        pc.put('/a', (pc.FILE, 'a'))
+        pc.put('/b', (pc.NOT_FOUND, 'b'))
+        self.assertEqual(pc.get('/a'), (pc.FILE, 'a'))
+        self.assertEqual(pc.get('/b'), (pc.NOT_FOUND, 'b'))
+        self.assertEqual((pc.hits, pc.misses), (2, 1))
+
+        clock.now = 2.0
+        self.assertTrue(pc.get('/b') is None)
+        self.assertEqual(pc.get('/a'), (pc.FILE, 'a'))
+
+        clock.now = 10.0
+        self.assertTrue(pc.get('/a') is None)
+        self.assertEqual(len(pc), 0)
+
+    def test_bounds(self):
+        pc = cache.StaticPathCache(max_entries=2, max_negative_entries=1)
+
+        pc.put('/a', (pc.FILE, 'a'))
+        pc.put('/b', (pc.FILE, 'b'))
+        pc.get('/a')
+        pc.put('/c', (pc.INDEX, 'c/index.html'))
+        for i in range(10):
+            pc.put('/missing/{}'.format(i), (pc.NOT_FOUND, 'missing'))
+
+        self.assertEqual(pc.get('/a'), (pc.FILE, 'a'))
+        self.assertTrue(pc.get('/b') is None)
+        self.assertEqual(pc.get('/c'), (pc.INDEX, 'c/index.html'))
+        self.assertEqual(len(pc), 3)
+
+        pc.discard('/a')
+        self.assertTrue(pc.get('/a') is None)
+        pc.clear()
+        self.assertEqual(len(pc), 0)
+
+    def test_invalidate(self):
+        pc = cache.StaticPathCache()
+
+        pc.put('/a', (pc.FILE, 'a'))
+        pc.put('/./a', (pc.FILE, 'a'))
+        pc.put('/d/', (pc.INDEX, 'd/index.htm'))
+        pc.put('/e', (pc.NOT_FOUND, 'e'))
+        pc.put('/x/y/z', (pc.NOT_FOUND, 'x/y/z'))
+
+        pc.invalidate('a')
+        self.assertTrue(pc.get('/a') is None)
+        self.assertTrue(pc.get('/./a') is None)
+        self.assertEqual(len(pc), 3)
+
+        # Index outcomes are affected by any change in the directory
+        pc.invalidate('d/index.html')
+        self.assertTrue(pc.get('/d/') is None)
+
+        pc.invalidate('x', is_dir=True)
+        self.assertTrue(pc.get('/x/y/z') is None)
+        self.assertEqual(pc.get('/e'), (pc.NOT_FOUND, 'e'))
+
+        pc.invalidate(None)
+        self.assertEqual(len(pc), 0)
+        self.assertEqual(pc._by_path, {})
+
+    def test_replace(self):
+        pc = cache.StaticPathCache()
+
+        pc.put('/a', (pc.FILE, 'a'))
+        pc.put('/a', (pc.NOT_FOUND, 'a'))
+        self.assertEqual(pc.get('/a'), (pc.NOT_FOUND, 'a'))
+        self.assertEqual(len(pc), 1)
+
+
+class DummyStat:
+    def __init__(self, st_mtime_ns, st_size):
+        self.st_mtime_ns = st_mtime_ns
+        self.st_size = st_size
+
+
+class TestStaticFileCache(unittest.TestCase):
+    def test_get_put(self):
+        clock = DummyClock()
+        fc = cache.StaticFileCache(ttl=10, clock=clock)
+
+        fc.put(('a', (1, 1)), b'response a', DummyStat(1, 1))
+        fc.put(('b', (1, 1)), b'response b')
+        self.assertEqual(fc.size, 20)
+        self.assertEqual(fc.get(('a', (1, 1))), b'response a')
+        self.assertTrue(fc.get(('a', (1, 0))) is None)
+        self.assertEqual((fc.hits, fc.misses), (1, 1))
+
+        clock.now = 20.0
+        # Validated entries get renewed
+        self.assertEqual(fc.get(('a', (1, 1)), DummyStat(1, 1)), b'response a')
+        self.assertEqual(fc.get(('a', (1, 1))), b'response a')
+        self.assertTrue(fc.get(('b', (1, 1))) is None)
+        self.assertEqual(fc.size, 10)
+
+        self.assertTrue(fc.get(('a', (1, 1)), DummyStat(2, 1)) is None)
+        self.assertEqual(len(fc), 0)
+        self.assertEqual(fc.size, 0)
+
+    def test_bounds(self):
+        fc = cache.StaticFileCache(max_size=25)
+
+        fc.put('a', b'0123456789')
+        fc.put('b', b'0123456789')
+        fc.get('a')
+        fc.put('c', b'0123456789')
+        self.assertEqual(fc.size, 20)
+        self.assertTrue(fc.get('b') is None)
+        self.assertEqual(fc.get('a'), b'0123456789')
+
+        fc.put('d', b'0' * 26)
+        self.assertTrue(fc.get('d') is None)
+        fc.put('a', b'01234')
+        self.assertEqual(fc.size, 15)
+        fc.clear()
+        self.assertEqual(fc.size, 0)
+
+    def test_invalidate(self):
+        fc = cache.StaticFileCache()
+
+        fc.put(('a', (1, 1)), b'a')
+        fc.put(('a', (1, 0)), b'a')
+        fc.put(('d/b', (1, 1)), b'b')
+        fc.put(('d/c', (1, 1)), b'c')
+
+        fc.invalidate('a')
+        self.assertEqual(len(fc), 2)
+        fc.invalidate('d', is_dir=True)
+        self.assertEqual(len(fc), 0)
+        self.assertEqual(fc.size, 0)
@@ -0,0 +1,92 @@
+import unittest
+import asyncio
+import pyx.http as http
+import pyx.metrics as metrics
+import pyx.concurrency as concurrency
+from .test_http import create_dummy_request
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+    def test_queue(self):
+        loop = asyncio.get_event_loop()
+        limiter = concurrency.ConcurrencyLimiter('test', 2, queue_size=2)
+        order = []
+
+        @asyncio.coroutine
+        def worker(i, delay):
+            yield from limiter.acquire()
+            order.append(i)
+            try:
+                yield from asyncio.sleep(delay)
+            finally:
+                limiter.release()
+
+        tasks = [asyncio.ensure_future(worker(i, 0.01)) for i in range(4)]
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual((limiter.active, limiter.queue_depth), (2, 2))
+
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(limiter.acquire())
+        self.assertEqual(cm.exception.code, 503)
+
+        loop.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual(order, [0, 1, 2, 3])
+        self.assertEqual((limiter.active, limiter.queue_depth), (0, 0))
+        self.assertEqual(limiter.queued, 2)
+        self.assertTrue(limiter.wait_time > 0)
+        self.assertEqual(limiter.rejected, {'queue_full': 1, 'timeout': 0})
+
+    def test_timeout_and_cancel(self):
+        loop = asyncio.get_event_loop()
+        limiter = concurrency.ConcurrencyLimiter('test', 1, queue_size=2,
+                                                 timeout=0.01)
+        loop.run_until_complete(limiter.acquire())
+
+        timed_out = asyncio.ensure_future(limiter.acquire())
+        with self.assertRaises(http.HttpError):
+            loop.run_until_complete(limiter.acquire())
+        self.assertEqual(limiter.rejected['timeout'], 2)
+        self.assertTrue(isinstance(timed_out.exception(), http.HttpError))
+
+        waiter = asyncio.ensure_future(limiter.acquire())
+        loop.run_until_complete(asyncio.sleep(0))
+        limiter.release()
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(waiter)
+        # The slot handed over to the cancelled waiter is released
+        self.assertEqual((limiter.active, limiter.queue_depth), (0, 0))
+
+
+class LimitedResource(http.UrlResource):
+    limiter = concurrency.ConcurrencyLimiter('limited', 1)
+
+    @http.methods(['GET'])
+    @concurrency.limit_concurrency(limiter)
+    @asyncio.coroutine
+    def handle_request(self, req):
+        """Handle GET."""
+        self.active = self.limiter.active
+        resp = req.respond(204)
+        yield from resp.send()
+
+
+class TestLimitConcurrency(unittest.TestCase):
+    def test_decorator(self):
+        loop = asyncio.get_event_loop()
+        m = metrics.ServerMetrics()
+        m.watch_limiter(LimitedResource.limiter)
+        res = LimitedResource()
+        self.assertEqual(res.handle_request['GET'].__doc__, 'Handle GET.')
+
+        req = create_dummy_request()
+        req.method = 'GET'
+        loop.run_until_complete(res._do_handle_request(req))
+        self.assertEqual(res.active, 1)
+        self.assertEqual(LimitedResource.limiter.active, 0)
+        self.assertEqual(req.response.code, 204)
+
+        text = m.registry.render()
+        self.assertTrue('pyx_limiter_active{limiter="limited"} 0\n' in text)
+        self.assertTrue('pyx_limiter_rejected_total{limiter="limited",'
+                        'reason="timeout"} 0\n' in text)
@@ -0,0 +1,62 @@
+import unittest
+import pyx.http as http
+import pyx.hooks as hooks
+from .test_http import (create_dummy_connection, OkResource,
+                        serve_dummy_connection)
+
+
+class TestRequestHooks(unittest.TestCase):
+    def test_stages(self):
+        h = hooks.RequestHooks()
+        calls = []
+
+        class Recorder:
+            def on_request_parsed(self, req, t):
+                calls.append(('request_parsed', req.path, t))
+
+            def on_response_finished(self, req, t):
+                calls.append(('response_finished', req.path, t))
+
+        h.add(Recorder())
+        h.on_resource_resolved.append(
+            lambda req, t: calls.append(
+                ('resource_resolved', type(req.resource), t)))
+        h.on_response_started.append(
+            lambda req, t: calls.append(('response_started', req.path, t)))
+        h.on_response_started.append(lambda req, t: 1 / 0)
+
+        with self.assertLogs('pyx.RequestHooks', 'ERROR'):
+            serve_dummy_connection(b'GET / HTTP/1.1\r\n'
+                                   b'\r\n'
+                                   b'GET /missing HTTP/1.1\r\n'
+                                   b'\r\n',
+                                   hooks=h)
+
+        self.assertEqual([c[:2] for c in calls], [
+            ('request_parsed', '/'),
+            ('resource_resolved', OkResource),
+            ('response_started', '/'),
+            ('response_finished', '/'),
+            ('request_parsed', '/missing'),
+            ('response_started', '/missing'),
+            ('response_finished', '/missing'),
+        ])
+        stamps = [c[2] for c in calls]
+        self.assertEqual(stamps, sorted(stamps))
+
+
+class TestSlowRequestLogger(unittest.TestCase):
+    def test_threshold(self):
+        req = http.HttpRequest(create_dummy_connection())
+        req.method = 'GET'
+        req.path = '/slow'
+        req.timings = {'start': 1.0, 'request_parsed': 1.5,
+                       'response_started': 2.0}
+
+        logger = hooks.SlowRequestLogger(threshold=2)
+        with self.assertLogs('pyx.SlowRequestLogger', 'WARNING') as cm:
+            logger.on_response_finished(req, 2.5)
+            logger.on_response_finished(req, 3.5)
+        self.assertEqual(len(cm.output), 1)
+        self.assertTrue('GET /slow -> - in 2.500s (parse 0.500s, traverse -, '
+                        'handler -, send 1.500s)' in cm.output[0])
@@ -1,7 +1,12 @@
 import unittest
 import unittest.mock as mock
 import asyncio
+import os
+import socket
+import tempfile
 import pyx.http as http
+import pyx.cache as cache
+import pyx.manifest as manifest
 
 
 def create_dummy_message():
@@ -35,6 +40,39 @@ def create_dummy_request():
     return req
 
 
+class OkResource(http.UrlResource):
+    def get_child(self, key):
+        raise http.HttpError(404, key)
+
+    @http.methods(['GET'])
+    @asyncio.coroutine
+    def handle_request(self, req):
+        resp = req.respond(200)
+        resp.headers.append(http.HttpHeader('Content-Length', 2))
+        yield from resp.send()
+        yield from resp.send_body(b'ok')
+
+
+def serve_dummy_connection(data, req_cb=None, peer=None, eof=True,
+                           **kwargs):
+    """Serve the raw requests in ``data`` on a dummy connection, and return
+    the connection. Requests are handled by ``req_cb``, or ``OkResource``
+    by default. Other keyword arguments are passed to ``HttpConnectionCB``.
+    """
+    if req_cb is None:
+        req_cb = http.HttpRequestCB(lambda req: OkResource())
+    conn_cb = http.HttpConnectionCB(req_cb, **kwargs)
+    conn = create_dummy_connection()
+    if peer is not None:
+        conn.writer.get_extra_info.return_value = peer
+    conn.reader.feed_data(data)
+    if eof:
+        conn.reader.feed_eof()
+    asyncio.get_event_loop().run_until_complete(
+        conn_cb(conn.reader, conn.writer))
+    return conn
+
+
 class TestHttpMessage(unittest.TestCase):
     def test_get_header(self):
         msg = create_dummy_message()
@@ -143,6 +181,131 @@ class TestHttpRequest(unittest.TestCase):
                              http.HttpHeader('Pragma', 'Test'),
                          ])
 
+    def test_parse_limits(self):
+        loop = asyncio.get_event_loop()
+        limits = http.HttpRequestLimits(max_request_line=32,
+                                        max_header_line=32,
+                                        max_headers=2,
+                                        max_head_size=64)
+
+        conn = create_dummy_connection()
+        conn.reader.feed_data(b'GET /' + b'a' * 32 + b' HTTP/1.1\r\n\r\n')
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(http.HttpRequest.parse(conn, limits))
+        self.assertEqual(cm.exception.code, 414)
+
+        conn = create_dummy_connection()
+        conn.reader.feed_data(
+            b'GET / HTTP/1.1\r\n'
+            b'Cookie: ' + b'a' * 32 + b'\r\n'
+            b'\r\n')
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(http.HttpRequest.parse(conn, limits))
+        self.assertEqual(cm.exception.code, 431)
+
+        conn = create_dummy_connection()
+        conn.reader.feed_data(
+            b'GET / HTTP/1.1\r\n'
+            b'Host: localhost\r\n'
+            b'Pragma: Test\r\n'
+            b'Accept: */*\r\n'
+            b'\r\n')
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(http.HttpRequest.parse(conn, limits))
+        self.assertEqual(cm.exception.code, 431)
+
+        conn = create_dummy_connection()
+        conn.reader.feed_data(
+            b'GET / HTTP/1.1\r\n'
+            b'Host: localhost.localdomain\r\n'
+            b'Pragma: TestTestTestTest\r\n'
+            b'\r\n')
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(http.HttpRequest.parse(conn, limits))
+        self.assertEqual(cm.exception.code, 431)
+
+        conn = create_dummy_connection()
+        conn.reader.feed_data(
+            b'GET / HTTP/1.1\r\n'
+            b'Host: localhost\r\n'
+            b'\r\n')
+        req = loop.run_until_complete(http.HttpRequest.parse(conn, limits))
+        self.assertEqual(req.get_first_header('Host'), 'localhost')
+        self.assertTrue(limits.memory_ceiling() > 2 * limits.stream_limit)
+
+    def test_args(self):
+        req = create_dummy_request()
+
+        req._parse_req_line(b'GET /?a=1&b=2&a=3&c=&d=%20%2B+ HTTP/1.1\r\n')
+        self.assertEqual(req.args['a'], '1')
+        self.assertEqual(req.args.get_all('a'), ['1', '3'])
+        self.assertEqual(req.args['c'], '')
+        self.assertEqual(req.args['d'], ' + ')
+        self.assertTrue(req.args.get('e') is None)
+        self.assertTrue(req.args is req.args)
+
+        req._parse_req_line(b'GET / HTTP/1.1\r\n')
+        self.assertEqual(len(req.args), 0)
+
+    def test_read_form(self):
+        loop = asyncio.get_event_loop()
+        conn = create_dummy_connection()
+        body = b'a=1&b=%E4%BD%A0+%E5%A5%BD&a=3&flag'
+
+        conn.reader.feed_data(
+            b'POST / HTTP/1.1\r\n'
+            b'Content-Type: application/x-www-form-urlencoded\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+            b'\r\n' + body + b'GET / HTTP/1.1\r\n')
+
+        req = loop.run_until_complete(http.HttpRequest.parse(conn))
+        self.assertTrue(req.form is None)
+        form = loop.run_until_complete(req.read_form())
+        self.assertTrue(req.form is form)
+        self.assertEqual(form.get_all('a'), ['1', '3'])
+        self.assertEqual(form['b'], '\u4f60 \u597d')
+        self.assertEqual(form['flag'], '')
+
+        data = loop.run_until_complete(conn.reader.readline())
+        self.assertEqual(data, b'GET / HTTP/1.1\r\n')
+
+        req = create_dummy_request()
+        req.headers = [http.HttpHeader('Content-Type', 'text/plain')]
+        form = loop.run_until_complete(req.read_form())
+        self.assertEqual(len(form), 0)
+
+        req = create_dummy_request()
+        req.headers = [http.HttpHeader('Content-Type',
+                                       'application/x-www-form-urlencoded')]
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(req.read_form())
+        self.assertEqual(cm.exception.code, 411)
+
+        req.limits = http.HttpRequestLimits(max_form_size=4)
+        req.headers.append(http.HttpHeader('Content-Length', '5'))
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(req.read_form())
+        self.assertEqual(cm.exception.code, 413)
+
+    def test_parse_urlencoded_form_limits(self):
+        loop = asyncio.get_event_loop()
+
+        sr = asyncio.StreamReader(loop=loop)
+        sr.feed_data(b'a=1&b=2&c=3')
+        sr.feed_eof()
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(
+                http.parse_urlencoded_form(sr, max_fields=2))
+        self.assertEqual(cm.exception.code, 413)
+
+        sr = asyncio.StreamReader(loop=loop)
+        sr.feed_data(b'a=1&b=' + b'x' * 20000)
+        sr.feed_eof()
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(
+                http.parse_urlencoded_form(sr, max_field_size=10000))
+        self.assertEqual(cm.exception.code, 413)
+
     def test_respond(self):
         req = create_dummy_request()
 
@@ -157,6 +320,53 @@ class TestHttpRequest(unittest.TestCase):
         self.assertEqual(resp.version, (1, 0))
 
 
+class TestLazyHttpRequest(unittest.TestCase):
+    def test_parse(self):
+        loop = asyncio.get_event_loop()
+        conn = create_dummy_connection()
+
+        conn.reader.feed_data(
+            b'GET /?q=p&s=t HTTP/1.1\r\n'
+            b'Host: localhost\r\n'
+            b'Cookie: a\r\n'
+            b' : Test\r\n'
+            b'cookie:  b \r\n'
+            b'X-Latin: \xe9t\xe9\r\n'
+            b'\r\n')
+
+        req = loop.run_until_complete(http.LazyHttpRequest.parse(conn))
+
+        self.assertEqual(req.path, '/')
+        self.assertEqual(len(req.headers), 4)
+        self.assertEqual(req.get_first_header('HOST'), 'localhost')
+        self.assertEqual(req.get_header('Cookie'), ['a', 'b'])
+        self.assertEqual(req.get_header('Pragma'), [])
+        self.assertTrue(req.get_first_header('Pragma') is None)
+        self.assertEqual(req.get_first_header('x-latin'), '\xe9t\xe9')
+        self.assertTrue(req.get_first_header('X-\u20ac') is None)
+        self.assertEqual(req.get_header('X-\u20ac'), [])
+        self.assertEqual(req.headers[-1], http.HttpHeader('X-Latin', '\xe9t\xe9'))
+        self.assertEqual(list(req.headers),
+                         [
+                             http.HttpHeader('Host', 'localhost'),
+                             http.HttpHeader('Cookie', 'a'),
+                             http.HttpHeader('cookie', 'b'),
+                             http.HttpHeader('X-Latin', '\xe9t\xe9'),
+                         ])
+
+        req.headers = [http.HttpHeader('Host', 'example.com')]
+        self.assertEqual(req.get_first_header('host'), 'example.com')
+
+    def test_bad_header(self):
+        view = http.HttpHeaderView()
+        with self.assertRaises(http.BadHttpHeaderError):
+            view.append_line(b'Server\r\n')
+        with self.assertRaises(http.BadHttpHeaderError):
+            view.append_line(b' \t : pyx\r\n')
+        view.append_line(b'Server:\r\n')
+        self.assertEqual(list(view), [http.HttpHeader('Server', '')])
+
+
 class TestHttpResponse(unittest.TestCase):
     def test_write(self):
         resp = http.HttpResponse(200, None)
@@ -191,6 +401,21 @@ class TestHttpResponse(unittest.TestCase):
         resp.connection.writer.write.assert_called_with(str(resp).encode())
         self.assertTrue(req.responded)
 
+    def test_send_preencoded(self):
+        loop = asyncio.get_event_loop()
+        req = create_dummy_request()
+        resp = req.respond(200)
+        resp.headers = [http.HttpHeader('Server', 'Pyx')]
+
+        loop.run_until_complete(resp.send_preencoded(
+            b'Content-Length: 0\r\n\r\n'))
+        resp.connection.writer.write.assert_called_with(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Server: Pyx\r\n'
+            b'Content-Length: 0\r\n'
+            b'\r\n')
+        self.assertTrue(req.responded)
+
     def test_send_body(self):
         loop = asyncio.get_event_loop()
         req = create_dummy_request()
@@ -206,6 +431,116 @@ class TestHttpResponse(unittest.TestCase):
         resp.connection.writer.write.assert_called_with(b'This is another string body.')
 
 
+class TestDefaultHttpErrorHandler(unittest.TestCase):
+    def test_cached_response(self):
+        loop = asyncio.get_event_loop()
+        error_page = mock.Mock(return_value='Не найдено')
+        handler = http.DefaultHttpErrorHandler(error_page)
+
+        for version in [(1, 1), (1, 1), (1, 0)]:
+            req = create_dummy_request()
+            req.version = version
+            loop.run_until_complete(handler(http.HttpError(404), req))
+            self.assertTrue(req.responded)
+            self.assertEqual(req.response.code, 404)
+
+        self.assertEqual(error_page.call_count, 2)
+        data = req.connection.writer.write.call_args[0][0]
+        self.assertTrue(data.startswith(b'HTTP/1.0 404 Not Found\r\n'))
+        self.assertTrue(b'\r\nContent-Length: 19\r\n' in data)
+        self.assertTrue(data.endswith('\r\n\r\nНе найдено'.encode()))
+
+
+class TestHttpConnectionCB(unittest.TestCase):
+    def test_reject_large_head(self):
+        loop = asyncio.get_event_loop()
+        conn = create_dummy_connection()
+        limits = http.HttpRequestLimits(max_headers=1)
+        conn_cb = http.HttpConnectionCB(mock.Mock(), limits=limits)
+
+        conn.reader.feed_data(
+            b'GET / HTTP/1.1\r\n'
+            b'Host: localhost\r\n'
+            b'Pragma: Test\r\n'
+            b'\r\n')
+        loop.run_until_complete(conn_cb(conn.reader, conn.writer))
+
+        status_line = conn.writer.write.call_args_list[0][0][0]
+        self.assertTrue(status_line.startswith(b'HTTP/1.1 431 '))
+        conn.writer.close.assert_called_with()
+        self.assertFalse(conn_cb._request_cb.called)
+
+
+    def test_cancel_on_disconnect(self):
+        loop = asyncio.get_event_loop()
+        cancelled = []
+
+        class SlowResource(http.UrlResource):
+            @http.methods(['GET'])
+            @asyncio.coroutine
+            def handle_request(self, req):
+                try:
+                    yield from asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(req.path)
+                    raise
+
+        conn = create_dummy_connection()
+        conn_cb = http.HttpConnectionCB(
+            http.HttpRequestCB(lambda req: SlowResource()))
+        conn.reader.feed_data(b'GET / HTTP/1.1\r\n'
+                              b'\r\n')
+        protocol = conn.writer.transport.get_protocol.return_value
+
+        def lose_connection():
+            wrapper, = conn.writer.transport.set_protocol.call_args[0]
+            wrapper.connection_lost(ConnectionResetError())
+
+        loop.call_later(0.01, lose_connection)
+        loop.run_until_complete(
+            asyncio.wait_for(conn_cb(conn.reader, conn.writer), 1))
+
+        self.assertEqual(cancelled, ['/'])
+        protocol.connection_lost.assert_called_with(mock.ANY)
+        self.assertFalse(conn.writer.write.called)
+        conn.writer.close.assert_called_with()
+
+    def test_half_close(self):
+        loop = asyncio.get_event_loop()
+
+        class SlowResource(http.UrlResource):
+            @http.methods(['GET'])
+            @asyncio.coroutine
+            def handle_request(self, req):
+                yield from asyncio.sleep(0.05)
+                resp = req.respond(200)
+                resp.headers.append(http.HttpHeader('Content-Length', '2'))
+                yield from resp.send()
+                yield from resp.send_body(b'ok')
+
+        s1, s2 = socket.socketpair()
+        self.addCleanup(s2.close)
+        reader, writer = loop.run_until_complete(
+            asyncio.open_connection(sock=s1))
+        conn_cb = http.HttpConnectionCB(
+            http.HttpRequestCB(lambda req: SlowResource()))
+        s2.sendall(b'GET / HTTP/1.1\r\n'
+                   b'\r\n')
+        s2.shutdown(socket.SHUT_WR)
+        loop.run_until_complete(
+            asyncio.wait_for(conn_cb(reader, writer), 1))
+
+        s2.settimeout(1)
+        data = b''
+        while True:
+            chunk = s2.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(data.endswith(b'\r\n\r\nok'))
+
+
 class DummyResource(http.UrlResource):
     def get_child(self, key):
         if key == 'hello':
@@ -267,3 +602,309 @@ class TestStaticRootResource(unittest.TestCase):
         res = res.traverse('/some/%2e%2e%2f%2e%2e/dangerous/path')
         self.assertEqual(res._build_real_path(),
                          'local_root/dangerous/path')
+
+    def test_path_cache(self):
+        loop = asyncio.get_event_loop()
+        pc = cache.StaticPathCache()
+
+        def resolve(path):
+            res = http.StaticRootResource(root, path_cache=pc)
+            res = res.traverse(path)
+            try:
+                _rel_path, fd, _st = res._resolve()
+                os.close(fd)
+            except http.HttpError:
+                pass
+            return res._resolved
+
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, 'dir'))
+            with open(os.path.join(root, 'dir', 'index.html'), 'wb') as f:
+                f.write(b'index')
+            with open(os.path.join(root, 'file.txt'), 'wb') as f:
+                f.write(b'file')
+
+            self.assertEqual(resolve('/dir/'), (pc.INDEX, 'dir/index.html'))
+            self.assertEqual(resolve('/dir/../file.txt'), (pc.FILE, 'file.txt'))
+            self.assertEqual(resolve('/missing'), (pc.NOT_FOUND, 'missing'))
+
+            # Cached outcomes are used without touching the file system
+            with open(os.path.join(root, 'missing'), 'wb') as f:
+                f.write(b'')
+            os.unlink(os.path.join(root, 'file.txt'))
+
+            res = http.StaticRootResource(root, path_cache=pc)
+            res = res.traverse('/x/..//%6Dissing')
+            req = create_dummy_request()
+            req.method = 'GET'
+            with self.assertRaises(http.HttpError) as cm:
+                loop.run_until_complete(res._do_handle_request(req))
+            self.assertEqual(cm.exception.code, 404)
+
+            # Stale outcomes are replaced
+            self.assertEqual(resolve('/dir/../file.txt'),
+                             (pc.NOT_FOUND, 'file.txt'))
+
+            # All spellings share one entry, which invalidation clears
+            self.assertEqual(pc.get('missing'), (pc.NOT_FOUND, 'missing'))
+            self.assertTrue(pc.get('/missing') is None)
+            # As when reached through get_child() of another resource
+            res = http.StaticRootResource(root, path_cache=pc)
+            res = res.get_child('missing')
+            self.assertEqual(res._cached_outcome(), (pc.NOT_FOUND, 'missing'))
+            pc.invalidate('missing')
+            self.assertEqual(resolve('/missing'), (pc.FILE, 'missing'))
+
+    def test_root_fd(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, 'dir'))
+            with open(os.path.join(root, 'dir', 'index.htm'), 'wb') as f:
+                f.write(b'index')
+            with open(os.path.join(root, 'file.txt'), 'wb') as f:
+                f.write(b'file')
+            os.symlink('file.txt', os.path.join(root, 'link.txt'))
+
+            root_fd = os.open(root, os.O_RDONLY)
+            try:
+                res = http.StaticRootResource('/nowhere', root_fd=root_fd)
+                res = res.traverse('/dir')
+                rel_path, fd, st = res._resolve()
+                os.close(fd)
+                self.assertEqual(rel_path, 'dir/index.htm')
+                self.assertEqual(st.st_size, 5)
+
+                res = http.StaticRootResource('/nowhere', root_fd=root_fd)
+                res = res.traverse('/link.txt')
+                rel_path, fd, st = res._resolve()
+                os.close(fd)
+                self.assertEqual(st.st_size, 4)
+
+                res = http.StaticRootResource('/nowhere', root_fd=root_fd,
+                                              follow_symlinks=False)
+                res = res.traverse('/link.txt')
+                with self.assertRaises(http.HttpError) as cm:
+                    res._resolve()
+                self.assertEqual(cm.exception.code, 403)
+
+                res = http.StaticRootResource('/nowhere', root_fd=root_fd)
+                res = res.traverse('/file.txt/more')
+                with self.assertRaises(http.HttpError) as cm:
+                    res._resolve()
+                self.assertEqual(cm.exception.code, 404)
+            finally:
+                os.close(root_fd)
+
+    def test_special_files(self):
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as root:
+            os.mkfifo(os.path.join(root, 'fifo'))
+            os.mkdir(os.path.join(root, 'dir'))
+            os.mkfifo(os.path.join(root, 'dir', 'index.html'))
+
+            # Opening a FIFO for reading would block without O_NONBLOCK
+            for path in ['/fifo', '/dir/']:
+                res = http.StaticRootResource(root).traverse(path)
+                req = create_dummy_request()
+                req.method = 'GET'
+                with self.assertRaises(http.HttpError) as cm:
+                    loop.run_until_complete(res._do_handle_request(req))
+                self.assertEqual(cm.exception.code, 404)
+
+    def test_index_cache(self):
+        ic = cache.StaticIndexCache(min_age=0)
+
+        def find_index(path):
+            res = http.StaticRootResource(root, index_cache=ic)
+            res = res.traverse(path)
+            try:
+                rel_path, fd, _st = res._resolve()
+            except http.HttpError:
+                return None
+            os.close(fd)
+            return rel_path
+
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, 'dir'))
+            with open(os.path.join(root, 'dir', 'index.htm'), 'wb') as f:
+                f.write(b'index')
+            os.utime(os.path.join(root, 'dir'), (1, 1))
+
+            self.assertEqual(find_index('/dir'), 'dir/index.htm')
+            self.assertEqual((ic.hits, ic.misses), (0, 1))
+            self.assertEqual(find_index('/dir'), 'dir/index.htm')
+            self.assertEqual((ic.hits, ic.misses), (1, 1))
+
+            # Changes to the directory invalidate the cached entry
+            with open(os.path.join(root, 'dir', 'index.html'), 'wb') as f:
+                f.write(b'index')
+            self.assertEqual(find_index('/dir'), 'dir/index.html')
+            self.assertEqual((ic.hits, ic.misses), (1, 2))
+
+            os.unlink(os.path.join(root, 'dir', 'index.html'))
+            os.unlink(os.path.join(root, 'dir', 'index.htm'))
+            self.assertTrue(find_index('/dir') is None)
+            self.assertTrue(find_index('/dir') is None)
+            self.assertEqual((ic.hits, ic.misses), (2, 3))
+
+    def test_manifest(self):
+        loop = asyncio.get_event_loop()
+
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'app.js'), 'wb') as f:
+                f.write(b'var a = 1;')
+            with open(os.path.join(root, 'app.js.gz'), 'wb') as f:
+                f.write(b'compressed')
+            m = manifest.StaticManifest.scan(root)
+            entry = m.lookup('app.js')
+
+            req = create_dummy_request()
+            req.method = 'GET'
+            req.headers = [http.HttpHeader('Accept-Encoding', 'br;q=0, gzip'),
+                           http.HttpHeader('If-None-Match',
+                                           entry.variants['gzip'].etag)]
+            res = http.StaticRootResource(root, manifest=m)
+            res = res.traverse('/app.js')
+            loop.run_until_complete(res._do_handle_request(req))
+            status_line = req.connection.writer.write.call_args[0][0]
+            self.assertTrue(status_line.startswith(b'HTTP/1.1 304 '))
+
+            req = create_dummy_request()
+            req.method = 'GET'
+            req.headers = [http.HttpHeader('If-None-Match', entry.etag)]
+            res = http.StaticRootResource(root, manifest=m)
+            res = res.traverse('/app.js')
+            loop.run_until_complete(res._do_handle_request(req))
+            status_line = req.connection.writer.write.call_args[0][0]
+            self.assertTrue(status_line.startswith(b'HTTP/1.1 304 '))
+
+            # Files created after the scan are not served
+            with open(os.path.join(root, 'new.js'), 'wb') as f:
+                f.write(b'')
+            res = http.StaticRootResource(root, manifest=m)
+            res = res.traverse('/new.js')
+            with self.assertRaises(http.HttpError) as cm:
+                loop.run_until_complete(res._do_handle_request(req))
+            self.assertEqual(cm.exception.code, 404)
+
+    def test_file_cache(self):
+        loop = asyncio.get_event_loop()
+        pc = cache.StaticPathCache()
+        fc = cache.StaticFileCache(max_entry_size=8)
+
+        def serve(path):
+            req = create_dummy_request()
+            req.method = 'GET'
+            req.version = (1, 1)
+            res = http.StaticRootResource(root, path_cache=pc, file_cache=fc)
+            res = res.traverse(path)
+            loop.run_until_complete(res._do_handle_request(req))
+            return req.connection.writer.write.call_args_list
+
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'small.txt'), 'wb') as f:
+                f.write(b'small')
+
+            response = (b'HTTP/1.1 200 OK\r\n'
+                        b'Server: Pyx ' + http.__version__.encode() + b'\r\n'
+                        b'Content-Length: 5\r\n'
+                        b'Content-Type: text/plain\r\n'
+                        b'\r\n'
+                        b'small')
+            writes = serve('/small.txt')
+            self.assertEqual(writes, [mock.call(response)])
+            self.assertEqual((fc.hits, fc.misses), (0, 1))
+
+            # Served from memory, without opening the file
+            with mock.patch('os.open', side_effect=AssertionError):
+                writes = serve('/small.txt')
+            self.assertEqual(writes, [mock.call(response)])
+            self.assertEqual((fc.hits, fc.misses), (1, 1))
+
+            # Edited files are never served stale
+            with open(os.path.join(root, 'small.txt'), 'wb') as f:
+                f.write(b'edited')
+            writes = serve('/small.txt')
+            self.assertTrue(writes[-1][0][0].endswith(b'\r\n\r\nedited'))
+            self.assertEqual(fc.hits, 1)
+
+            # Even when the size stays the same
+            with open(os.path.join(root, 'small.txt'), 'wb') as f:
+                f.write(b'EDITED')
+            os.utime(os.path.join(root, 'small.txt'), ns=(0, 0))
+            writes = serve('/small.txt')
+            self.assertTrue(writes[-1][0][0].endswith(b'\r\n\r\nEDITED'))
+
+            # Missing files are not served from memory
+            os.unlink(os.path.join(root, 'small.txt'))
+            with self.assertRaises(http.HttpError) as cm:
+                serve('/small.txt')
+            self.assertEqual(cm.exception.code, 404)
+
+    def test_put(self):
+        loop = asyncio.get_event_loop()
+        pc = cache.StaticPathCache()
+
+        def put(path, body, writable=True, headers=(), **kwargs):
+            req = create_dummy_request()
+            req.method = 'PUT'
+            req.version = (1, 1)
+            req.headers = [http.HttpHeader('Content-Length', str(len(body)))]
+            req.headers.extend(headers)
+            req.connection.reader.feed_data(body)
+            res = http.StaticRootResource(root, path_cache=pc,
+                                          writable=writable, **kwargs)
+            res = res.traverse(path)
+            self.writes = req.connection.writer.write.call_args_list
+            loop.run_until_complete(res._do_handle_request(req))
+            return req.connection.writer.write.call_args[0][0]
+
+        def get(path):
+            req = create_dummy_request()
+            req.method = 'GET'
+            res = http.StaticRootResource(root, path_cache=pc)
+            res = res.traverse(path)
+            loop.run_until_complete(res._do_handle_request(req))
+
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, 'dir'))
+            with self.assertRaises(http.HttpError) as cm:
+                put('/dir/new.txt', b'new', writable=False)
+            self.assertEqual(cm.exception.code, 405)
+
+            # Cache a negative outcome
+            with self.assertRaises(http.HttpError) as cm:
+                get('/dir/new.txt')
+            self.assertEqual(cm.exception.code, 404)
+
+            status_line = put('/dir/new.txt', b'new')
+            self.assertTrue(status_line.startswith(b'HTTP/1.1 201 '))
+            # The negative outcome is invalidated
+            self.assertTrue(pc.get('dir/new.txt') is None)
+
+            status_line = put('/dir/new.txt', b'newer')
+            self.assertTrue(status_line.startswith(b'HTTP/1.1 204 '))
+            with open(os.path.join(root, 'dir', 'new.txt'), 'rb') as f:
+                self.assertEqual(f.read(), b'newer')
+            self.assertEqual(os.listdir(os.path.join(root, 'dir')),
+                             ['new.txt'])
+
+            for path in ('/dir', '/missing/new.txt'):
+                with self.assertRaises(http.HttpError) as cm:
+                    put(path, b'new')
+                self.assertEqual(cm.exception.code, 409)
+
+            # Clients waiting for 100 Continue get it before the body is read
+            expect = [http.HttpHeader('Expect', '100-continue')]
+            status_line = put('/dir/new.txt', b'newest', headers=expect)
+            self.assertEqual(self.writes[0][0][0],
+                             b'HTTP/1.1 100 Continue\r\n\r\n')
+            self.assertTrue(status_line.startswith(b'HTTP/1.1 204 '))
+
+            # But not when the upload is rejected
+            with self.assertRaises(http.HttpError) as cm:
+                put('/dir/new.txt', b'too large', headers=expect,
+                    max_upload_size=8)
+            self.assertEqual(cm.exception.code, 413)
+            self.assertEqual(self.writes, [])
+            with open(os.path.join(root, 'dir', 'new.txt'), 'rb') as f:
+                self.assertEqual(f.read(), b'newest')
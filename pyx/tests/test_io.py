@@ -1,6 +1,8 @@
 import unittest
 import tempfile
 import asyncio
+import os
+import socket
 import unittest.mock as mock
 import pyx.io as io
 
@@ -50,6 +52,28 @@ class TestAsyncFile(unittest.TestCase):
 
         self.assertTrue(f.closed)
 
+    def test_read_pending(self):
+        loop = asyncio.get_event_loop()
+        r, w = os.pipe()
+        in_use = io.default_buffer_pool.in_use
+
+        with io.AsyncFile(fileobj=os.fdopen(r, 'rb', buffering=0)) as af:
+            af.DEFAULT_BLOCK_SIZE = 4
+            task = asyncio.ensure_future(af.read(10))
+            loop.run_until_complete(asyncio.sleep(0))
+            os.write(w, b'dummy ')
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertFalse(task.done())
+            os.write(w, b'content')
+            data = loop.run_until_complete(task)
+            self.assertEqual(data, b'dummy cont')
+            self.assertEqual(io.default_buffer_pool.in_use, in_use)
+
+            task = asyncio.ensure_future(af.read())
+            loop.run_until_complete(asyncio.sleep(0.01))
+            os.close(w)
+            self.assertEqual(loop.run_until_complete(task), b'ent')
+
     def test_write(self):
         loop = asyncio.get_event_loop()
         f = create_dummy_file()
@@ -70,6 +94,22 @@ class TestAsyncFile(unittest.TestCase):
 
         self.assertTrue(f.closed)
 
+    def test_readinto(self):
+        loop = asyncio.get_event_loop()
+        f = create_dummy_file()
+        buf = bytearray(15)
+
+        with io.AsyncFile(fileobj=f) as af:
+            n = loop.run_until_complete(af.readinto(buf))
+            self.assertEqual(n, 15)
+            self.assertEqual(buf, b'dummy content\r\n')
+            af.seek(60)
+            n = loop.run_until_complete(af.readinto(buf))
+            self.assertEqual(n, 6)
+            self.assertEqual(buf[0:n], b'nt 4\r\n')
+            n = loop.run_until_complete(af.readinto(buf))
+            self.assertEqual(n, 0)
+
 
 class TestSendfileAsync(unittest.TestCase):
     def test_sendfile_async(self):
@@ -89,6 +129,230 @@ class TestSendfileAsync(unittest.TestCase):
                 data2 = loop.run_until_complete(af2.read())
                 self.assertEqual(data1, data2)
 
+    def test_cancel(self):
+        loop = asyncio.get_event_loop()
+        s1, s2 = socket.socketpair()
+        s1.setblocking(False)
+        size = 16 * 1024 * 1024
+
+        with tempfile.TemporaryFile() as f, s1, s2:
+            f.truncate(size)
+            task = asyncio.ensure_future(
+                io.sendfile_async(s1, f, 0, size, readahead=0))
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertFalse(task.done())
+
+            with mock.patch('os.close', wraps=os.close) as close:
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    loop.run_until_complete(task)
+            # The fd watched for writability is released
+            self.assertEqual(close.call_count, 1)
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'needs posix_fadvise')
+    def test_readahead(self):
+        loop = asyncio.get_event_loop()
+        f1 = create_dummy_file()
+        f2 = create_empty_file()
+        real_sendfile = os.sendfile
+
+        def short_sendfile(out_fd, in_fd, offset, nbytes):
+            return real_sendfile(out_fd, in_fd, offset, min(nbytes, 10))
+
+        with io.AsyncFile(fileobj=f1) as af1:
+            with io.AsyncFile(fileobj=f2) as af2:
+                with mock.patch('os.sendfile', side_effect=short_sendfile), \
+                        mock.patch('os.posix_fadvise') as fadvise:
+                    loop.run_until_complete(
+                        io.sendfile_async(af2, af1, 0, 66, readahead=16))
+
+                fd = af1.fileno()
+                self.assertEqual(fadvise.call_args_list[:3], [
+                    mock.call(fd, 0, 66, os.POSIX_FADV_SEQUENTIAL),
+                    mock.call(fd, 0, 32, os.POSIX_FADV_WILLNEED),
+                    mock.call(fd, 32, 20, os.POSIX_FADV_WILLNEED),
+                ])
+                ranges = [c[0][1:3] for c in fadvise.call_args_list[1:]]
+                self.assertEqual(sum(r[1] for r in ranges), 66)
+
+                af2.seek(0)
+                data = loop.run_until_complete(af2.read())
+                self.assertEqual(len(data), 66)
+
+
+class DummyClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume(self):
+        clock = DummyClock()
+        bucket = io.TokenBucket(100, burst=200, clock=clock)
+        self.assertEqual(bucket.consume(150), 0)
+        self.assertEqual(bucket.consume(100), 0.5)
+        self.assertEqual(bucket.tokens, -50)
+
+        clock.now = 1.0
+        self.assertEqual(bucket.tokens, 50)
+        bucket.refund(30)
+        self.assertEqual(bucket.tokens, 80)
+
+        clock.now = 10.0
+        self.assertEqual(bucket.tokens, 200)
+
+
+class TestBandwidthScheduler(unittest.TestCase):
+    def test_acquire(self):
+        loop = asyncio.get_event_loop()
+        clock = DummyClock()
+        scheduler = io.BandwidthScheduler(rate=1000, conn_rate=100,
+                                          small_size=10, chunk_size=50,
+                                          clock=clock)
+        throttle = scheduler.connection()
+
+        @asyncio.coroutine
+        def dummy_sleep(delay, result=None):
+            pass
+
+        # autospec keeps the signature of the real asyncio.sleep
+        with mock.patch('asyncio.sleep', autospec=True,
+                        side_effect=dummy_sleep) as sleep:
+            # Small transfers are never delayed nor split
+            granted = loop.run_until_complete(throttle.acquire(10, 10))
+            self.assertEqual(granted, 10)
+            self.assertFalse(sleep.called)
+
+            granted = loop.run_until_complete(throttle.acquire(300, 300))
+            self.assertEqual(granted, 50)
+            self.assertFalse(sleep.called)
+            granted = loop.run_until_complete(throttle.acquire(250, 300))
+            self.assertEqual(granted, 50)
+            self.assertFalse(sleep.called)
+            granted = loop.run_until_complete(throttle.acquire(200, 300))
+            self.assertEqual(granted, 50)
+            self.assertEqual(sleep.call_args[0][0], 0.5)
+
+        # Small transfers use up the total bandwidth too
+        self.assertEqual(scheduler._bucket.tokens, 1000 - 160)
+
+    def test_sendfile_async(self):
+        loop = asyncio.get_event_loop()
+        f1 = create_dummy_file()
+        f2 = create_empty_file()
+        scheduler = io.BandwidthScheduler(rate=1000000, small_size=10,
+                                          chunk_size=16)
+        throttle = scheduler.connection()
+
+        with io.AsyncFile(fileobj=f1) as af1:
+            with io.AsyncFile(fileobj=f2) as af2:
+                with mock.patch('os.sendfile', wraps=os.sendfile) as sendfile:
+                    loop.run_until_complete(
+                        io.sendfile_async(af2, af1, 0, 66, throttle=throttle))
+                self.assertEqual([c[0][3] for c in sendfile.call_args_list],
+                                 [16, 16, 16, 16, 2])
+
+                af2.seek(0)
+                data = loop.run_until_complete(af2.read())
+                self.assertEqual(len(data), 66)
+
+
+class TestSpliceToFile(unittest.TestCase):
+    def splice(self, payload, nbytes, extra_check=None, buffered=False):
+        loop = asyncio.get_event_loop()
+        s1, s2 = socket.socketpair()
+        f = create_empty_file()
+
+        @asyncio.coroutine
+        def receive():
+            reader, writer = yield from asyncio.open_connection(sock=s1)
+            # Make some of the data buffered by the reader
+            s2.sendall(payload[:10])
+            head = yield from reader.readexactly(2)
+            self.assertEqual(head, payload[:2])
+            if buffered:
+                # Data held by the wrapping reader must not be skipped
+                more = yield from reader.readexactly(3)
+                reader = io.BufferedReader(reader)
+                reader.put(more)
+            loop.call_soon(s2.sendall, payload[10:])
+            loop.call_soon(s2.shutdown, socket.SHUT_WR)
+            try:
+                yield from io.splice_to_file(reader, writer.transport, f,
+                                             nbytes)
+                if extra_check is not None:
+                    yield from extra_check(reader)
+            finally:
+                writer.close()
+
+        try:
+            loop.run_until_complete(receive())
+            f.seek(0)
+            return f.read()
+        finally:
+            s2.close()
+            f.close()
+
+    def test_splice_to_file(self):
+        payload = b''.join(bytes([i]) * 1000 for i in range(200))
+
+        @asyncio.coroutine
+        def check_rest(reader):
+            rest = yield from reader.read()
+            self.assertEqual(rest, payload[-100:])
+
+        data = self.splice(payload, len(payload) - 102, check_rest)
+        self.assertEqual(data, payload[2:-100])
+
+    def test_incomplete(self):
+        with self.assertRaises(asyncio.IncompleteReadError):
+            self.splice(b'x' * 100, 200)
+
+    def test_buffered_reader(self):
+        payload = bytes(range(256)) * 100
+        data = self.splice(payload, len(payload) - 2, buffered=True)
+        self.assertEqual(data, payload[2:])
+
+
+class TestWarmUpFiles(unittest.TestCase):
+    def test_warm_up_files(self):
+        f1 = create_dummy_file()
+        f2 = create_empty_file()
+        names = [f1.name, f2.name, f1.name + '.missing']
+        with self.assertLogs('pyx.warm_up_files', 'WARNING'):
+            self.assertEqual(io.warm_up_files(names), 66)
+        with self.assertLogs('pyx.warm_up_files', 'WARNING'):
+            self.assertEqual(
+                io.warm_up_files(names, pre_read=True,
+                                 pool=io.BufferPool(buffer_size=8)), 66)
+
+
+class TestBufferPool(unittest.TestCase):
+    def test_lease(self):
+        pool = io.BufferPool(buffer_size=16, max_free=1)
+
+        with pool.lease() as lease1:
+            self.assertEqual(len(lease1.buffer), 16)
+            buf1 = lease1.buffer
+            lease2 = pool.lease()
+            self.assertFalse(lease2.buffer is buf1)
+            self.assertEqual((pool.in_use, pool.high_water), (2, 2))
+        self.assertTrue(lease1.buffer is None)
+        self.assertEqual(len(pool), 1)
+
+        lease2.release()
+        lease2.release()
+        self.assertEqual((pool.in_use, pool.high_water), (0, 2))
+        # Only max_free buffers are kept
+        self.assertEqual(len(pool), 1)
+
+        with pool.lease() as lease3:
+            self.assertTrue(lease3.buffer is buf1)
+        self.assertEqual(pool.allocated, 2)
+
 
 class TestBufferedReader(unittest.TestCase):
     def test_read(self):
@@ -176,6 +440,22 @@ class TestBufferedReader(unittest.TestCase):
         data = loop.run_until_complete(br.readline())
         self.assertEqual(data, b'test data 3')
 
+    def test_readinto(self):
+        loop = asyncio.get_event_loop()
+        sr = asyncio.StreamReader(loop=loop)
+        br = io.BufferedReader(sr)
+        buf = bytearray(8)
+
+        sr.feed_data(b'stream data')
+        br.put(b'ed ')
+        br.put(b'buffer')
+        n = loop.run_until_complete(br.readinto(buf))
+        self.assertEqual(buf[0:n], b'buffered')
+        n = loop.run_until_complete(br.readinto(buf))
+        self.assertEqual(buf[0:n], b' ')
+        n = loop.run_until_complete(br.readinto(buf))
+        self.assertEqual(buf[0:n], b'stream d')
+
 
 class TestLengthReader(unittest.TestCase):
     def test_read(self):
@@ -245,6 +525,23 @@ class TestLengthReader(unittest.TestCase):
         data = loop.run_until_complete(lr.read())
         self.assertEqual(data, b'3 4 1 2 5 ')
 
+    def test_readinto(self):
+        loop = asyncio.get_event_loop()
+        sr = asyncio.StreamReader(loop=loop)
+        br = io.BufferedReader(sr)
+        buf = bytearray(8)
+
+        sr.feed_data(b'1 2 3 4 5 6 ')
+        lr = io.LengthReader(br, 10)
+        n = loop.run_until_complete(lr.readinto(buf))
+        self.assertEqual(buf[0:n], b'1 2 3 4 ')
+        n = loop.run_until_complete(lr.readinto(buf))
+        self.assertEqual(buf[0:n], b'5 ')
+        n = loop.run_until_complete(lr.readinto(buf))
+        self.assertEqual(n, 0)
+        data = loop.run_until_complete(br.read(2))
+        self.assertEqual(data, b'6 ')
+
 
 class TestBoundaryReader(unittest.TestCase):
     def test_read(self):
@@ -366,6 +663,60 @@ class TestBoundaryReader(unittest.TestCase):
         data = loop.run_until_complete(br.readline())
         self.assertEqual(data, b'padding')
 
+    def test_pooled_buffer(self):
+        loop = asyncio.get_event_loop()
+        sr = asyncio.StreamReader(loop=loop)
+        br = io.BufferedReader(sr)
+
+        # Stale data in a reused buffer must not be taken as a trailer
+        with io.default_buffer_pool.lease() as lease:
+            lease.buffer[16:19] = b'-\r\n'
+        in_use = io.default_buffer_pool.in_use
+
+        sr.feed_data(b'abc\r\n--boundary-')
+        sr.feed_eof()
+        lr = io.BoundaryReader(br, b'boundary')
+        data = loop.run_until_complete(lr.read(4))
+        self.assertEqual(data, b'abc')
+        self.assertEqual(io.default_buffer_pool.in_use, in_use)
+        data = loop.run_until_complete(br.read())
+        self.assertEqual(data, b'-')
+
+    def test_readinto(self):
+        loop = asyncio.get_event_loop()
+        sr = asyncio.StreamReader(loop=loop)
+        br = io.BufferedReader(sr)
+
+        sr.feed_data(b'hello\r\n--BND\r\nNEXT PART DATA')
+        sr.feed_eof()
+        lr = io.BoundaryReader(br, b'BND')
+        buf = bytearray(64)
+        n = loop.run_until_complete(lr.readinto(buf))
+        self.assertEqual(buf[0:n], b'hello')
+        n = loop.run_until_complete(lr.readinto(buf))
+        self.assertEqual(n, 0)
+        data = loop.run_until_complete(br.read())
+        self.assertEqual(data, b'NEXT PART DATA')
+
+        # Larger than a pooled buffer, and under a LengthReader
+        sr = asyncio.StreamReader(loop=loop)
+        br = io.BufferedReader(sr)
+        body = b'x' * (io.default_buffer_pool.buffer_size + 10)
+        sr.feed_data(body + b'\r\n--BND--\r\nNEXT')
+        sr.feed_eof()
+        lr = io.LengthReader(io.BoundaryReader(br, b'BND'), len(body) + 100)
+        buf = bytearray(len(body) + 100)
+        view = memoryview(buf)
+        filled = 0
+        while True:
+            n = loop.run_until_complete(lr.readinto(view[filled:]))
+            if n == 0:
+                break
+            filled += n
+        self.assertEqual(buf[0:filled], body)
+        data = loop.run_until_complete(br.read())
+        self.assertEqual(data, b'NEXT')
+
 
 class TestBaseWriter(unittest.TestCase):
     def setUp(self):
@@ -405,3 +756,16 @@ class TestChunkedWriter(unittest.TestCase):
 
         self.cw.write(b'')
         self.cw._writer.write.assert_called_with(b'0\r\n\r\n')
+
+
+class TestRecordingWriter(unittest.TestCase):
+    def test_write(self):
+        rw = io.RecordingWriter(create_dummy_writer(), max_size=8)
+        rw.write(b'dummy')
+        rw.write(bytearray(b'abc'))
+        rw._writer.write.assert_called_with(bytearray(b'abc'))
+        self.assertEqual(rw.data, b'dummyabc')
+
+        rw.write(b'!')
+        rw._writer.write.assert_called_with(b'!')
+        self.assertTrue(rw.data is None)
@@ -0,0 +1,60 @@
+import unittest
+import tempfile
+import os
+import pyx.manifest as manifest
+
+
+def create_dummy_tree(root):
+    os.mkdir(os.path.join(root, 'dir'))
+    with open(os.path.join(root, 'index.html'), 'wb') as f:
+        f.write(b'<html></html>')
+    with open(os.path.join(root, 'dir', 'app.js'), 'wb') as f:
+        f.write(b'var a = 1;')
+    with open(os.path.join(root, 'dir', 'app.js.gz'), 'wb') as f:
+        f.write(b'compressed')
+    os.utime(os.path.join(root, 'index.html'), (1400000000, 1400000000))
+
+
+class TestStaticManifest(unittest.TestCase):
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as root:
+            create_dummy_tree(root)
+            m = manifest.StaticManifest.scan(root)
+
+        self.assertEqual(len(m), 3)
+        self.assertTrue(m.lookup('missing') is None)
+        self.assertTrue(m.lookup('dir') is None)
+
+        entry = m.lookup('')
+        self.assertEqual(entry.rel_path, 'index.html')
+        self.assertEqual(entry.etag, '"53724e00-d"')
+        self.assertEqual(entry.header_block,
+                         b'Content-Length: 13\r\n'
+                         b'Content-Type: text/html\r\n'
+                         b'ETag: "53724e00-d"\r\n'
+                         b'Last-Modified: Tue, 13 May 2014 16:53:20 GMT\r\n'
+                         b'\r\n')
+
+        entry = m.lookup('dir/app.js')
+        self.assertEqual(entry.size, 10)
+        variant = entry.variants['gzip']
+        self.assertEqual(variant.rel_path, 'dir/app.js.gz')
+        self.assertEqual(variant.mimetype, entry.mimetype)
+        self.assertTrue(b'Content-Encoding: gzip\r\n' in variant.header_block)
+        self.assertTrue(b'Vary: Accept-Encoding\r\n' in variant.header_block)
+        self.assertTrue(b'Vary: Accept-Encoding\r\n' in entry.header_block)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as root:
+            create_dummy_tree(root)
+            m = manifest.StaticManifest.scan(root)
+            fname = os.path.join(root, 'manifest.json')
+            m.save(fname)
+            m2 = manifest.StaticManifest.load(fname)
+
+        self.assertEqual(len(m2), len(m))
+        for rel_path in ['', 'dir/app.js', 'dir/app.js.gz']:
+            self.assertEqual(m2.lookup(rel_path).header_block,
+                             m.lookup(rel_path).header_block)
+        self.assertEqual(m2.lookup('dir/app.js').variants.keys(),
+                         m.lookup('dir/app.js').variants.keys())
@@ -0,0 +1,82 @@
+import unittest
+import asyncio
+import pyx.http as http
+import pyx.metrics as metrics
+from .test_http import (create_dummy_request, OkResource,
+                        serve_dummy_connection)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_render(self):
+        reg = metrics.MetricsRegistry()
+        c = reg.register(metrics.Counter('c_total', 'A counter', ['a']))
+        g = reg.register(metrics.Gauge('g', 'A gauge', fn=lambda: 42))
+        h = reg.register(metrics.Histogram('h_seconds', 'A histogram',
+                                           buckets=[0.1, 1]))
+        with self.assertRaises(ValueError):
+            reg.register(metrics.Gauge('g', 'Duplicate'))
+
+        c.inc(labels=('x"\\\n',))
+        c.inc(2, labels=('y',))
+        c.inc(labels=('y',))
+        h.observe(0.1)
+        h.observe(0.5)
+        h.observe(5)
+
+        self.assertEqual(reg.render(),
+                         '# HELP c_total A counter\n'
+                         '# TYPE c_total counter\n'
+                         'c_total{a="x\\"\\\\\\n"} 1\n'
+                         'c_total{a="y"} 3\n'
+                         '# HELP g A gauge\n'
+                         '# TYPE g gauge\n'
+                         'g 42\n'
+                         '# HELP h_seconds A histogram\n'
+                         '# TYPE h_seconds histogram\n'
+                         'h_seconds_bucket{le="0.1"} 1\n'
+                         'h_seconds_bucket{le="1.0"} 2\n'
+                         'h_seconds_bucket{le="+Inf"} 3\n'
+                         'h_seconds_sum 5.6\n'
+                         'h_seconds_count 3\n')
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_requests(self):
+        m = metrics.ServerMetrics()
+        req_cb = http.HttpRequestCB(lambda req: OkResource(), metrics=m)
+        serve_dummy_connection(
+            b'GET / HTTP/1.1\r\n'
+            b'\r\n'
+            b'GET /missing HTTP/1.1\r\n'
+            b'\r\n'
+            b'BAD\r\n',
+            req_cb=req_cb, eof=False, metrics=m)
+
+        text = m.registry.render()
+        self.assertTrue('pyx_request_duration_seconds_count{code="200"} 1\n'
+                        in text)
+        self.assertTrue('pyx_request_duration_seconds_count{code="404"} 1\n'
+                        in text)
+        self.assertTrue('pyx_connections_total 1\n' in text)
+        self.assertTrue('pyx_connections_active 0\n' in text)
+        self.assertTrue('pyx_keepalive_reuse_ratio 0.5\n' in text)
+        self.assertTrue('pyx_parse_errors_total 1\n' in text)
+        self.assertTrue('pyx_response_bytes_total{via="write"}' in text)
+
+    def test_metrics_resource(self):
+        loop = asyncio.get_event_loop()
+        m = metrics.ServerMetrics()
+        cache = http.StaticIndexCache()
+        cache.hits = 3
+        m.watch_cache('index', cache)
+
+        req = create_dummy_request()
+        req.method = 'GET'
+        res = metrics.MetricsResource(m.registry)
+        loop.run_until_complete(res._do_handle_request(req))
+
+        writes = req.connection.writer.write.call_args_list
+        self.assertTrue(b'Content-Type: text/plain; version=0.0.4' in
+                        writes[0][0][0])
+        self.assertTrue(b'pyx_cache_hits_total{cache="index"} 3\n' in
+                        writes[1][0][0])
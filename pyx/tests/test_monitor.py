@@ -0,0 +1,108 @@
+import unittest
+import asyncio
+import time
+import pyx.http as http
+import pyx.metrics as metrics
+import pyx.monitor as monitor
+from .test_http import (create_dummy_connection, serve_dummy_connection)
+
+
+class TestLoopLagMonitor(unittest.TestCase):
+    def test_sample(self):
+        m = monitor.LoopLagMonitor(threshold=0.5)
+        with self.assertLogs('pyx.LoopLagMonitor', 'INFO') as cm:
+            m.sample(0.4)
+            self.assertFalse(m.overloaded)
+            m.sample(0.6)
+            self.assertTrue(m.overloaded)
+            m.sample(0.3)
+            self.assertTrue(m.overloaded)
+            m.sample(0.2)
+            self.assertFalse(m.overloaded)
+        self.assertEqual(len(cm.output), 2)
+
+        m = monitor.LoopLagMonitor()
+        m.sample(10)
+        self.assertFalse(m.overloaded)
+        self.assertEqual(m.lag, 10)
+
+    def test_measure(self):
+        loop = asyncio.get_event_loop()
+        m = monitor.LoopLagMonitor(loop=loop, interval=0.01)
+        lags = []
+        orig_sample = m.sample
+        m.sample = lambda lag: (lags.append(lag), orig_sample(lag))
+        m.start()
+        loop.call_soon(time.sleep, 0.05)
+        loop.run_until_complete(asyncio.sleep(0.1))
+        m.stop()
+        self.assertTrue(max(lags) >= 0.03)
+
+    def test_shed(self):
+        m = monitor.LoopLagMonitor(threshold=0.5, retry_after=3)
+        m.overloaded = True
+        sm = metrics.ServerMetrics()
+        sm.watch_loop(m)
+        conn = serve_dummy_connection(b'GET / HTTP/1.1\r\n'
+                                      b'\r\n',
+                                      metrics=sm, monitor=m)
+
+        data = conn.writer.write.call_args[0][0]
+        self.assertEqual(data, b'HTTP/1.1 503 Service Unavailable\r\n'
+                               b'Server: Pyx ' + http.__version__.encode() +
+                               b'\r\n'
+                               b'Retry-After: 3\r\n'
+                               b'Content-Length: 0\r\n'
+                               b'Connection: close\r\n'
+                               b'\r\n')
+        conn.writer.close.assert_called_with()
+        text = sm.registry.render()
+        self.assertTrue('pyx_requests_shed_total 1\n' in text)
+        self.assertFalse('pyx_requests_parsed_total 1\n' in text)
+        self.assertTrue('pyx_loop_lag_seconds 0.0\n' in text)
+
+
+class BlockingResource(http.UrlResource):
+    def get_child(self, key):
+        return self
+
+    @http.methods(['GET'])
+    @asyncio.coroutine
+    def handle_request(self, req):
+        time.sleep(0.2)
+        resp = req.respond(200)
+        yield from resp.send()
+
+
+class TestBlockingWatchdog(unittest.TestCase):
+    def test_blocking_handler(self):
+        loop = asyncio.get_event_loop()
+        watchdog = monitor.BlockingWatchdog(loop=loop, threshold=0.05)
+        req_cb = http.HttpRequestCB(lambda req: BlockingResource())
+        conn_cb = http.HttpConnectionCB(req_cb)
+        conn = create_dummy_connection()
+        conn.reader.feed_data(b'GET /blocking HTTP/1.1\r\n'
+                              b'\r\n')
+        conn.reader.feed_eof()
+
+        @asyncio.coroutine
+        def serve():
+            watchdog.start()
+            yield from asyncio.sleep(0.05)
+            yield from conn_cb(conn.reader, conn.writer)
+            yield from asyncio.sleep(0.1)
+            watchdog.stop()
+
+        with self.assertLogs('pyx.BlockingWatchdog', 'WARNING') as cm:
+            loop.run_until_complete(serve())
+        self.assertTrue('in handle_request\n    time.sleep(0.2)' in
+                        cm.output[0])
+
+        report = watchdog.report()
+        self.assertEqual(len(report), 1)
+        name, path, count, total, max_time, stack = report[0]
+        self.assertEqual((name, path, count), ('BlockingResource',
+                                               '/blocking', 1))
+        self.assertTrue(0.1 < total < 0.3)
+        self.assertTrue('BlockingResource (/blocking)' in
+                        watchdog.format_report())
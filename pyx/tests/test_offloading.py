@@ -0,0 +1,134 @@
+import unittest
+import asyncio
+import concurrent.futures
+import os
+import threading
+import pyx.http as http
+import pyx.offloading as offloading
+from .test_http import create_dummy_request
+
+
+process_pool = concurrent.futures.ProcessPoolExecutor(1)
+producer_stopped = threading.Event()
+
+
+def tearDownModule():
+    process_pool.shutdown()
+
+
+class OffloadedResource(http.UrlResource):
+    @http.methods(['GET'])
+    @offloading.offload(content_type='text/plain')
+    def handle_request(req):
+        n = int(req.args.get('n', '3'))
+        if n < 0:
+            raise http.HttpError(400, 'negative')
+        for i in range(n):
+            yield 'line {}\n'.format(i)
+        if req.args.get('fail'):
+            raise ValueError('oops')
+
+    @handle_request.methods(['POST'])
+    @offloading.offload(process_pool)
+    def handle_post(req):
+        yield b'x' * 100000
+        yield str(os.getpid())
+
+    @handle_request.methods(['PUT'])
+    @offloading.offload()
+    def handle_put(req):
+        try:
+            while True:
+                yield b'x' * 65536
+        finally:
+            producer_stopped.set()
+
+
+class TestOffload(unittest.TestCase):
+    def serve(self, method, query=None, version=(1, 1)):
+        req = create_dummy_request()
+        req.method = method
+        req.path = '/'
+        req.query = query
+        req.version = version
+        asyncio.get_event_loop().run_until_complete(
+            OffloadedResource()._do_handle_request(req))
+        writes = req.connection.writer.write.call_args_list
+        return req, [c[0][0] for c in writes]
+
+    def test_chunked(self):
+        req, writes = self.serve('GET')
+        self.assertTrue(writes[0].startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(b'\r\nContent-Type: text/plain\r\n' in writes[0])
+        self.assertTrue(b'\r\nTransfer-Encoding: chunked\r\n' in writes[0])
+        self.assertEqual(b''.join(writes[1:]),
+                         b'7\r\nline 0\n\r\n'
+                         b'7\r\nline 1\n\r\n'
+                         b'7\r\nline 2\n\r\n'
+                         b'0\r\n\r\n')
+        self.assertFalse(req.connection.closed)
+
+        req, writes = self.serve('GET', 'n=1', (1, 0))
+        self.assertTrue(b'\r\nConnection: close\r\n' in writes[0])
+        self.assertEqual(writes[1:], [b'line 0\n'])
+        self.assertTrue(req.connection.closed)
+
+    def test_process_pool(self):
+        req, writes = self.serve('POST', version=(1, 0))
+        body = b''.join(writes[1:])
+        self.assertEqual(body[0:100000], b'x' * 100000)
+        self.assertNotEqual(int(body[100000:]), os.getpid())
+        self.assertEqual(req.response.bytes_written,
+                         len(writes[0]) + len(body))
+
+    def test_errors(self):
+        with self.assertRaises(http.HttpError) as cm:
+            self.serve('GET', 'n=-1')
+        self.assertEqual(cm.exception.code, 400)
+
+        with self.assertRaises(Exception) as cm:
+            self.serve('GET', 'n=0&fail=1')
+        self.assertNotIsInstance(cm.exception, http.HttpError)
+        self.assertTrue('ValueError: oops' in str(cm.exception))
+
+        req = create_dummy_request()
+        req.method = 'GET'
+        req.path = '/'
+        req.query = 'n=2&fail=1'
+        req.version = (1, 1)
+        with self.assertRaisesRegex(Exception, 'ValueError: oops'):
+            asyncio.get_event_loop().run_until_complete(
+                OffloadedResource()._do_handle_request(req))
+        self.assertTrue(req.responded)
+        req.connection.writer.close.assert_called_with()
+
+    def test_traceback_logged(self):
+        req = create_dummy_request()
+        req.method = 'GET'
+        req.path = '/'
+        req.query = 'n=0&fail=1'
+        req.version = (1, 1)
+        req_cb = http.HttpRequestCB(lambda req: OffloadedResource())
+        with self.assertLogs('pyx.HttpRequestCB', 'DEBUG') as cm:
+            asyncio.get_event_loop().run_until_complete(req_cb(req))
+        self.assertTrue(any('ValueError: oops' in line and
+                            'handle_request' in line for line in cm.output))
+        self.assertEqual(req.response.code, 500)
+
+    def test_cancel(self):
+        loop = asyncio.get_event_loop()
+        producer_stopped.clear()
+        req = create_dummy_request()
+        req.method = 'PUT'
+        req.path = '/'
+        req.query = None
+        req.version = (1, 1)
+        task = asyncio.ensure_future(
+            OffloadedResource()._do_handle_request(req))
+        loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertTrue(req.responded)
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+        self.assertTrue(producer_stopped.wait(1))
@@ -0,0 +1,200 @@
+import unittest
+import asyncio
+import pyx.http as http
+import pyx.metrics as metrics
+import pyx.response_cache as response_cache
+from .test_http import create_dummy_request
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def create_counting_resource(cache, headers=()):
+    class CountingResource(http.UrlResource):
+        count = 0
+
+        @http.methods(['GET', 'HEAD'])
+        @response_cache.cache_response(cache)
+        @asyncio.coroutine
+        def handle_request(self, req):
+            CountingResource.count += 1
+            resp = req.respond(200)
+            body = 'count {}'.format(CountingResource.count).encode()
+            resp.headers.append(http.HttpHeader('Content-Length', len(body)))
+            resp.headers.extend(headers)
+            yield from resp.send()
+            yield from resp.send_body(body)
+
+    return CountingResource()
+
+
+def create_get_request(path='/', headers=()):
+    req = create_dummy_request()
+    req.method = 'GET'
+    req.path = path
+    req.query = None
+    req.protocol = 'HTTP'
+    req.version = (1, 1)
+    req.headers = list(headers)
+    return req
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _handle(self, res, req):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(res._do_handle_request(req))
+        return b''.join(c[1][0] for c in
+                        req.connection.writer.write.mock_calls)
+
+    def test_hit(self):
+        cache = response_cache.ResponseCache(ttl=10, clock=self.clock)
+        res = create_counting_resource(cache)
+
+        data = self._handle(res, create_get_request())
+        self.assertTrue(data.endswith(b'\r\n\r\ncount 1'))
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 1, 1))
+        self.assertEqual(cache.size, len(data))
+
+        req = create_get_request()
+        self.assertEqual(self._handle(res, req), data)
+        req.connection.writer.write.assert_called_once_with(data)
+        self.assertEqual(req.response.code, 200)
+        self.assertEqual(req.response.bytes_written, len(data))
+        self.assertEqual(res.count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Expired entries are regenerated
+        self.clock.now = 10
+        self.assertTrue(self._handle(res, create_get_request())
+                        .endswith(b'count 2'))
+        self.assertEqual(res.count, 2)
+
+        # Other paths have their own entries
+        self._handle(res, create_get_request('/other'))
+        self.assertEqual((res.count, len(cache)), (3, 2))
+
+    def test_stale_while_revalidate(self):
+        loop = asyncio.get_event_loop()
+        cache = response_cache.ResponseCache(ttl=10, stale_ttl=10,
+                                             clock=self.clock)
+        res = create_counting_resource(cache)
+        self._handle(res, create_get_request())
+
+        self.clock.now = 15
+        # Only one revalidation for concurrent stale hits
+        reqs = [create_get_request(), create_get_request()]
+        loop.run_until_complete(asyncio.gather(
+            *[res._do_handle_request(r) for r in reqs]))
+        for r in reqs:
+            self.assertTrue(r.connection.writer.write.call_args[0][0]
+                            .endswith(b'count 1'))
+        self.assertEqual(cache.stale_hits, 2)
+
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(res.count, 2)
+        self.assertTrue(self._handle(res, create_get_request())
+                        .endswith(b'count 2'))
+        self.assertEqual(res.count, 2)
+
+        # Too old to be served
+        self.clock.now = 40
+        self.assertTrue(self._handle(res, create_get_request())
+                        .endswith(b'count 3'))
+
+    def test_clear_cancels_revalidation(self):
+        loop = asyncio.get_event_loop()
+        cache = response_cache.ResponseCache(ttl=10, stale_ttl=10,
+                                             clock=self.clock)
+        cancelled = []
+
+        class SlowResource(http.UrlResource):
+            @http.methods(['GET'])
+            @response_cache.cache_response(cache)
+            @asyncio.coroutine
+            def handle_request(self, req):
+                if len(cache) > 0:
+                    try:
+                        yield from asyncio.sleep(10)
+                    except asyncio.CancelledError:
+                        cancelled.append(req.path)
+                        raise
+                resp = req.respond(200)
+                resp.headers.append(http.HttpHeader('Content-Length', 0))
+                yield from resp.send()
+
+        res = SlowResource()
+        self._handle(res, create_get_request())
+        self.clock.now = 15
+        self._handle(res, create_get_request())
+        self.assertEqual(len(cache._revalidating), 1)
+        task, = cache._revalidating.values()
+
+        cache.clear()
+        self.assertEqual(cache._revalidating, {})
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertTrue(task.cancelled())
+        self.assertEqual(cancelled, ['/'])
+        self.assertEqual(len(cache), 0)
+
+    def test_vary(self):
+        cache = response_cache.ResponseCache(vary=['Accept-Encoding'],
+                                             clock=self.clock)
+        res = create_counting_resource(cache)
+        gzip = [http.HttpHeader('Accept-Encoding', 'gzip')]
+
+        self._handle(res, create_get_request(headers=gzip))
+        self._handle(res, create_get_request())
+        self._handle(res, create_get_request(headers=gzip))
+        self.assertEqual(res.count, 2)
+
+    def test_uncacheable(self):
+        cache = response_cache.ResponseCache(clock=self.clock)
+        for headers in ([http.HttpHeader('Set-Cookie', 'a=b')],
+                        [http.HttpHeader('Cache-Control',
+                                         'private, max-age=0')]):
+            res = create_counting_resource(cache, headers)
+            self._handle(res, create_get_request())
+            self._handle(res, create_get_request())
+            self.assertEqual(res.count, 2)
+            self.assertEqual(len(cache), 0)
+
+    def test_size_limit(self):
+        res = create_counting_resource(response_cache.ResponseCache())
+        size = len(self._handle(res, create_get_request()))
+
+        cache = response_cache.ResponseCache(max_size=size * 2,
+                                             max_entry_size=size,
+                                             clock=self.clock)
+        res = create_counting_resource(cache)
+        for path in ['/a', '/b', '/a', '/c']:
+            self._handle(res, create_get_request(path))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, size * 2)
+        # '/b' is the least recently used one
+        self._handle(res, create_get_request('/a'))
+        self._handle(res, create_get_request('/b'))
+        self.assertEqual(res.count, 4)
+
+        cache.max_entry_size = size - 1
+        cache.clear()
+        self._handle(res, create_get_request('/a'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_metrics(self):
+        cache = response_cache.ResponseCache(clock=self.clock)
+        res = create_counting_resource(cache)
+        m = metrics.ServerMetrics()
+        m.watch_cache('response', cache)
+        self._handle(res, create_get_request())
+        self._handle(res, create_get_request())
+        text = m.registry.render()
+        self.assertIn('pyx_cache_hits_total{cache="response"} 1', text)
+        self.assertIn('pyx_cache_misses_total{cache="response"} 1', text)
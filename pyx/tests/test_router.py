@@ -0,0 +1,117 @@
+import unittest
+import asyncio
+import pyx.http as http
+import pyx.router as router
+from .test_http import create_dummy_request
+
+
+class DummyResource(http.UrlResource):
+    def __init__(self, name):
+        self.name = name
+        self.handled = []
+
+    @http.methods(['GET'])
+    @asyncio.coroutine
+    def handle_request(self, req):
+        self.handled.append(('GET', req.route_params))
+
+    @handle_request.methods(['POST'])
+    @asyncio.coroutine
+    def handle_post(self, req):
+        self.handled.append(('POST', req.route_params))
+
+
+class AnyMethodResource(http.UrlResource):
+    @asyncio.coroutine
+    def handle_request(self, req):
+        self.method = req.method
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.index = DummyResource('index')
+        self.users = DummyResource('users')
+        self.user = DummyResource('user')
+        self.new_user = DummyResource('new_user')
+        self.edit_user = DummyResource('edit_user')
+        self.status = AnyMethodResource()
+        self.router = router.Router({
+            '': self.index,
+            'users': {
+                '': self.users,
+                'new': self.new_user,
+                '{user_id}': self.user,
+                '{user_id}/edit': self.edit_user,
+            },
+            'api/v1/status': self.status,
+            'static': router.mount(lambda: http.StaticRootResource('local_root')),
+        }, cache_size=2)
+
+    def test_traverse(self):
+        self.assertTrue(self.router.traverse('/').resource is self.index)
+        self.assertTrue(self.router.traverse('').resource is self.index)
+        self.assertTrue(self.router.traverse('/users/').resource is self.users)
+        self.assertTrue(
+            self.router.traverse('/users/new').resource is self.new_user)
+        self.assertTrue(
+            self.router.traverse('/api/v1/status').resource is self.status)
+
+        match = self.router.traverse('/users/some%20one')
+        self.assertTrue(match.resource is self.user)
+        self.assertEqual(match.params, {'user_id': 'some one'})
+
+        match = self.router.traverse('/users/new/edit')
+        self.assertTrue(match.resource is self.edit_user)
+        self.assertEqual(match.params, {'user_id': 'new'})
+
+        with self.assertRaises(http.HttpError):
+            self.router.traverse('/users/some/thing/else')
+        with self.assertRaises(http.HttpError):
+            self.router.traverse('/api/v1')
+
+        sres = self.router.traverse('/static/some/../path')
+        self.assertEqual(sres._build_real_path(), 'local_root/path')
+
+    def test_cache(self):
+        match = self.router.traverse('/users')
+        self.assertTrue(self.router.traverse('/users') is match)
+        self.router.traverse('/users/1')
+        self.assertEqual(len(self.router._cache), 1)
+        self.router.traverse('/')
+        self.router.traverse('/users/new')
+        self.assertEqual(list(self.router._cache.keys()), ['/', '/users/new'])
+
+    def test_cached_params(self):
+        loop = asyncio.get_event_loop()
+        for _ in range(2):
+            req = create_dummy_request()
+            req.method = 'GET'
+            loop.run_until_complete(
+                self.router.traverse('/users')._do_handle_request(req))
+            self.assertEqual(req.route_params, {})
+            # Mutations by a handler must not leak into later requests
+            req.route_params['leaked'] = True
+
+    def test_dispatch(self):
+        loop = asyncio.get_event_loop()
+
+        req = create_dummy_request()
+        req.method = 'POST'
+        match = self.router.traverse('/users/42')
+        loop.run_until_complete(match._do_handle_request(req))
+        self.assertEqual(self.user.handled, [('POST', {'user_id': '42'})])
+
+        req.method = 'PUT'
+        with self.assertRaises(http.HttpError) as cm:
+            loop.run_until_complete(match._do_handle_request(req))
+        self.assertEqual(cm.exception.code, 501)
+
+        match = self.router.traverse('/api/v1/status')
+        loop.run_until_complete(match._do_handle_request(req))
+        self.assertEqual(self.status.method, 'PUT')
+
+    def test_bad_tree(self):
+        with self.assertRaises(TypeError):
+            router.Router({'a': 'b'})
+        with self.assertRaises(ValueError):
+            router.Router({'{a}': {'': self.index}, '{b}/c': self.index})
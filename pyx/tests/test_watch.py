@@ -0,0 +1,56 @@
+import unittest
+import tempfile
+import asyncio
+import os
+import pyx.watch as watch
+
+
+class TestInotifyWatcher(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        os.mkdir(os.path.join(self.root, 'dir'))
+
+        self.events = []
+        self.watcher = watch.InotifyWatcher(self.root, loop=self.loop)
+        self.watcher.subscribe(
+            lambda rel_path, is_dir: self.events.append((rel_path, is_dir)))
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmp_dir.cleanup()
+
+    def wait_for_events(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def test_file_events(self):
+        with open(os.path.join(self.root, 'dir', 'a.txt'), 'wb') as f:
+            f.write(b'a')
+        os.rename(os.path.join(self.root, 'dir', 'a.txt'),
+                  os.path.join(self.root, 'b.txt'))
+        os.unlink(os.path.join(self.root, 'b.txt'))
+        self.wait_for_events()
+
+        self.assertTrue(('dir/a.txt', False) in self.events)
+        self.assertTrue(('b.txt', False) in self.events)
+        self.assertEqual(self.events[-1], ('b.txt', False))
+
+    def test_new_dir(self):
+        os.mkdir(os.path.join(self.root, 'dir', 'new'))
+        self.wait_for_events()
+        self.assertEqual(self.events, [('dir/new', True)])
+
+        with open(os.path.join(self.root, 'dir', 'new', 'c.txt'), 'wb') as f:
+            f.write(b'c')
+        self.wait_for_events()
+        self.assertEqual(self.events[-1], ('dir/new/c.txt', False))
+
+        os.rename(os.path.join(self.root, 'dir'),
+                  os.path.join(self.root, 'moved'))
+        self.wait_for_events()
+        del self.events[:]
+        os.unlink(os.path.join(self.root, 'moved', 'new', 'c.txt'))
+        self.wait_for_events()
+        self.assertEqual(self.events, [('moved/new/c.txt', False)])
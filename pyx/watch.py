@@ -0,0 +1,192 @@
+"""
+File system watching, for keeping caches of static files fresh.
+
+The watcher talks to the Linux inotify API through ``ctypes``, so no
+external dependency is needed::
+
+    path_cache = StaticPathCache(ttl=None, negative_ttl=None)
+    watcher = InotifyWatcher('/some/where')
+    watcher.subscribe(path_cache.invalidate)
+    watcher.start()
+
+"""
+
+
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from .log import logger
+
+
+__all__ = ['InotifyWatcher']
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE |
+               IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+               IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = \
+            [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def _check_call(res):
+    if res < 0:
+        errcode = ctypes.get_errno()
+        raise OSError(errcode, os.strerror(errcode))
+    return res
+
+
+class InotifyWatcher:
+    """Watch a directory tree, and report changes to subscribers.
+
+    ``root`` is the directory to watch. All its subdirectories are watched
+    too, including those created after the watcher is started.
+
+    Subscribers are called as ``cb(rel_path, is_dir)``, where ``rel_path``
+    is the changed path relative to ``root``, and ``is_dir`` tells whether
+    it's a directory. Changes inside a directory that's moved or deleted
+    are reported only once, for the directory itself. If the kernel event
+    queue overflows, subscribers are called with ``rel_path`` set to None,
+    meaning anything may have changed. The ``invalidate`` methods of the
+    caches in ``pyx.cache`` can be used as subscribers directly.
+    """
+
+    READ_SIZE = 65536
+
+    def __init__(self, root, loop=None):
+        self.root = root
+        self._loop = loop or asyncio.get_event_loop()
+        self._fd = None
+        self._watches = {}
+        self._subscribers = []
+
+    def subscribe(self, cb):
+        """Add a subscriber."""
+        self._subscribers.append(cb)
+
+    def unsubscribe(self, cb):
+        """Remove a subscriber added by ``subscribe``."""
+        self._subscribers.remove(cb)
+
+    def start(self):
+        """Start watching. May raise ``OSError``."""
+        libc = _get_libc()
+        self._fd = _check_call(
+            libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+        self._add_tree('')
+        self._loop.add_reader(self._fd, self._read_events)
+        logger('InotifyWatcher').debug(
+            'Watching %d directories under %r', len(self._watches), self.root)
+
+    def close(self):
+        """Stop watching."""
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._watches.clear()
+
+    def _add_watch(self, rel_dir):
+        path = os.path.join(self.root, rel_dir)
+        try:
+            wd = _check_call(_get_libc().inotify_add_watch(
+                self._fd, os.fsencode(path), _WATCH_MASK))
+        except OSError as e:
+            # The directory may be gone already
+            logger('InotifyWatcher').debug('Failed to watch %r: %s', path, e)
+            return
+        self._watches[wd] = rel_dir
+
+    def _add_tree(self, rel_dir):
+        self._add_watch(rel_dir)
+        top = os.path.join(self.root, rel_dir)
+        for dir_path, dir_names, _file_names in os.walk(top):
+            for name in dir_names:
+                self._add_watch(
+                    os.path.relpath(os.path.join(dir_path, name), self.root))
+
+    def _notify(self, rel_path, is_dir):
+        for cb in self._subscribers:
+            try:
+                cb(rel_path, is_dir)
+            except Exception:
+                logger('InotifyWatcher').exception(
+                    'Subscriber failed for %r', rel_path)
+
+    def _read_events(self):
+        while True:
+            try:
+                buf = os.read(self._fd, self.READ_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not buf:
+                return
+            self._handle_events(buf)
+
+    def _handle_events(self, buf):
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _cookie, length = \
+                _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:(offset+length)].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger('InotifyWatcher').warning('inotify queue overflowed')
+                self._notify(None, True)
+                continue
+
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Reported by the parent directory already, except for root
+                if rel_dir == '':
+                    self._notify(None, True)
+                continue
+
+            rel_path = os.path.join(rel_dir, os.fsdecode(name))
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # Watch the new subtree before reporting, so that changes
+                # made in between are covered by this notification
+                self._add_tree(rel_path)
+            self._notify(rel_path, is_dir)
@@ -48,5 +48,7 @@ setup(
     entry_points='''
     [console_scripts]
     {0} = {0}.cmd:main
+    {0}-manifest = {0}.cmd:manifest_main
+    {0}-pack = {0}.cmd:pack_main
     '''.format(PACKAGE_NAME),
 )